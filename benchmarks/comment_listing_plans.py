@@ -0,0 +1,152 @@
+''' Shows query plans for the comment listing hot path with and without
+the composite and partial comment indexes.
+
+Usage:
+
+    python benchmarks/comment_listing_plans.py \\
+        postgresql://postgres@localhost/unicore_comments_bench
+
+The database is dropped and recreated, so don't point this at
+anything you care about. Its server needs the pg_trgm extension
+(PostgreSQL contrib), which creating the tables installs.
+'''
+import sys
+import hashlib
+import argparse
+from uuid import UUID
+
+from psycopg2.extras import register_uuid
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import postgresql
+
+from unicore.comments.service.models import metadata, Comment
+from unicore.comments.service.views import pagination
+from unicore.comments.service.views.comments import comment_filters
+
+
+APP_UUID = UUID('bbc0035128b34ed48bdacab1799087c5')
+NEW_INDEXES = (
+    'comment_app_content_submit_datetime_index',
+    'comment_visible_app_content_submit_datetime_index',
+    'comment_flagged_app_submit_datetime_index',
+)
+
+
+def populate(connection, num_comments, num_streams):
+    query = text('''
+        INSERT INTO comments (
+            uuid, user_uuid, content_uuid, app_uuid, comment, user_name,
+            submit_datetime, content_type, content_title, content_url,
+            locale, flag_count, is_removed, moderation_state, reply_count,
+            path)
+        SELECT
+            uuid, user_uuid, content_uuid, app_uuid, comment, user_name,
+            submit_datetime, content_type, content_title, content_url,
+            locale, flag_count, is_removed, moderation_state, 0,
+            -- top-level paths, as in Comment.get_path_component
+            lpad(to_hex(floor(extract(epoch FROM submit_datetime)
+                              * 1000000)::bigint), 13, '0') ||
+            replace(uuid::text, '-', '')
+        FROM (
+            SELECT
+                md5(random()::text)::uuid AS uuid,
+                md5('user' || (i % 5000))::uuid AS user_uuid,
+                md5('stream' || (i % :num_streams))::uuid AS content_uuid,
+                CAST(:app_uuid AS uuid) AS app_uuid,
+                'comment ' || i AS comment,
+                'user ' || (i % 5000) AS user_name,
+                now() - (i || ' seconds')::interval AS submit_datetime,
+                'page' AS content_type,
+                'title' AS content_title,
+                'http://example.com/' AS content_url,
+                'eng_ZA' AS locale,
+                CASE WHEN i % 500 = 0 THEN 1 + i % 7 ELSE 0 END
+                    AS flag_count,
+                false AS is_removed,
+                CASE WHEN i % 20 = 0 THEN 'removed_by_moderator'
+                     ELSE 'visible' END AS moderation_state
+            FROM generate_series(1, :num_comments) AS i) AS generated
+        ''')
+    connection.execute(
+        query, num_comments=num_comments, num_streams=num_streams,
+        app_uuid=APP_UUID.hex)
+    connection.execute('ANALYZE comments')
+
+
+def get_queries():
+    columns = Comment.__table__.c
+    order_columns = (columns.submit_datetime, columns.uuid)
+    stream = {
+        'app_uuid': [APP_UUID.hex],
+        'content_uuid': [get_stream_uuid(1).hex]}
+    visible = dict(stream, moderation_state=['visible'])
+    flagged = {'app_uuid': [APP_UUID.hex], 'flag_count_gte': ['1']}
+
+    for name, args in (('stream', stream),
+                       ('visible stream', visible),
+                       ('moderation queue', flagged)):
+        query = Comment.__table__ \
+            .select() \
+            .where(comment_filters.get_filter_expression(args, columns))
+        query, _ = pagination.paginate_cursor(
+            args, query, order_columns, 'secret')
+        yield name, query
+
+
+def get_stream_uuid(i):
+    return UUID(hashlib.md5('stream%d' % i).hexdigest())
+
+
+def explain(connection, query):
+    compiled = query.compile(dialect=postgresql.dialect())
+    result = connection.execute(
+        'EXPLAIN (ANALYZE, BUFFERS) %s' % compiled, compiled.params)
+    return '\n'.join(row[0] for row in result)
+
+
+def show_plans(connection, title):
+    print '=' * 78
+    print title
+    print '=' * 78
+    for name, query in get_queries():
+        print '--- %s' % name
+        print explain(connection, query)
+        print
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database_url')
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--streams', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    register_uuid()
+    engine = create_engine(args.database_url)
+    connection = engine.connect()
+    metadata.drop_all(connection)
+    metadata.create_all(connection)
+    populate(connection, args.comments, args.streams)
+
+    # the indexes before the composite and partial indexes were added
+    for name in NEW_INDEXES:
+        connection.execute('DROP INDEX %s' % name)
+    connection.execute(
+        'CREATE INDEX comment_app_content_index '
+        'ON comments (app_uuid, content_uuid)')
+    connection.execute('ANALYZE comments')
+    show_plans(connection, 'before')
+
+    connection.execute('DROP INDEX comment_app_content_index')
+    for index in Comment.__table__.indexes:
+        if index.name in NEW_INDEXES:
+            index.create(connection)
+    connection.execute('ANALYZE comments')
+    show_plans(connection, 'after')
+
+    metadata.drop_all(connection)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,143 @@
+''' Compares the cost of row objects with cached column metadata and
+`__slots__` against the implementation they replaced.
+
+Usage:
+
+    python benchmarks/row_objects.py
+
+No database is needed.
+'''
+import sys
+import timeit
+import argparse
+from uuid import uuid4
+from datetime import datetime
+
+import pytz
+from sqlalchemy import and_
+from sqlalchemy.inspection import inspect
+
+from unicore.comments.service.models import Comment, Flag
+
+
+class LegacyRowObject(object):
+    ''' RowObjectMixin's data handling before column metadata
+    was cached.
+    '''
+
+    def __init__(self, connection, row):
+        self.connection = connection
+        self.row_dict = dict((k, v) for k, v in row.items())
+
+    @classmethod
+    def _pk_expression(cls, data):
+        expressions = [
+            (c == data[c.name])
+            for c in inspect(cls.__table__).primary_key]
+        return and_(*expressions)
+
+    @property
+    def pk_expression(self):
+        return self.__class__._pk_expression(self.row_dict)
+
+    def to_dict(self):
+        return dict(
+            (c.name, self.row_dict[c.name]) for c in self.__table__.c)
+
+    def get(self, attr):
+        if attr not in self.__table__.c:
+            raise KeyError('%r is not a column name' % attr)
+
+        return self.row_dict.get(attr, None)
+
+    def set(self, attr, value):
+        if attr not in self.__table__.c:
+            raise KeyError('%r is not a column name' % attr)
+
+        self.row_dict[attr] = value
+
+
+class LegacyComment(LegacyRowObject):
+    __table__ = Comment.__table__
+
+
+class LegacyFlag(LegacyRowObject):
+    __table__ = Flag.__table__
+
+
+def get_rows(count):
+    now = datetime.now(pytz.utc)
+    comment = {
+        'uuid': uuid4(),
+        'user_uuid': uuid4(),
+        'content_uuid': uuid4(),
+        'app_uuid': uuid4(),
+        'comment': u'x' * 500,
+        'user_name': u'foo',
+        'submit_datetime': now,
+        'content_type': u'page',
+        'content_title': u'title',
+        'content_url': u'http://example.com/',
+        'locale': u'eng_ZA',
+        'flag_count': 0,
+        'is_removed': False,
+        'moderation_state': u'visible',
+        'parent_uuid': None,
+        'reply_count': 0,
+        'ip_address': None}
+    comment['path'] = Comment.get_path(comment)
+    flag = {
+        'comment_uuid': comment['uuid'],
+        'user_uuid': uuid4(),
+        'app_uuid': comment['app_uuid'],
+        'submit_datetime': now}
+    return [comment] * count, [flag] * count
+
+
+def page(cls, rows):
+    # what a view does with a page of rows
+    objects = [cls(None, row) for row in rows]
+    for obj in objects:
+        obj.get('app_uuid')
+        obj.set('submit_datetime', obj.get('submit_datetime'))
+        obj.pk_expression
+        obj.to_dict()
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj) + sys.getsizeof(obj.row_dict)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    if getattr(obj, '_dirty', None) is not None:
+        size += sys.getsizeof(obj._dirty)
+    return size
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    comment_rows, flag_rows = get_rows(args.rows)
+    print '%d rows per page, best of 3 x %d pages' % (
+        args.rows, args.repeat)
+    print '%-10s %12s %12s %12s' % (
+        'model', 'legacy ms', 'current ms', 'bytes/row')
+
+    for name, legacy, current, rows in (
+            ('Comment', LegacyComment, Comment, comment_rows),
+            ('Flag', LegacyFlag, Flag, flag_rows)):
+        timings = []
+        for cls in (legacy, current):
+            timer = timeit.Timer(lambda: page(cls, rows))
+            best = min(timer.repeat(3, args.repeat))
+            timings.append(best * 1000 / args.repeat)
+        sizes = [instance_size(cls(None, rows[0]))
+                 for cls in (legacy, current)]
+        print '%-10s %12.3f %12.3f %5d -> %4d' % (
+            name, timings[0], timings[1], sizes[0], sizes[1])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,84 @@
+''' Compares colander's serialize with the compiled serializers used by
+the listing views, for pages of rows.
+
+Usage:
+
+    python benchmarks/serializers.py
+
+No database is needed.
+'''
+import sys
+import timeit
+import argparse
+from uuid import uuid4
+from datetime import datetime
+
+import pytz
+
+from unicore.comments.service.schema import Comment, Flag, StreamMetadata
+from unicore.comments.service.serializers import compile_serializer
+
+
+def get_rows(count):
+    now = datetime.now(pytz.utc)
+    comments = [{
+        'uuid': uuid4(),
+        'user_uuid': uuid4(),
+        'content_uuid': uuid4(),
+        'app_uuid': uuid4(),
+        'comment': u'x' * 500,
+        'user_name': u'foo',
+        'submit_datetime': now,
+        'content_type': u'page',
+        'content_title': u'title',
+        'content_url': u'http://example.com/',
+        'locale': u'eng_ZA',
+        'flag_count': 0,
+        'is_removed': False,
+        'moderation_state': u'visible',
+        'parent_uuid': uuid4(),
+        'reply_count': 0,
+        'ip_address': None} for i in range(count)]
+    flags = [{
+        'comment_uuid': uuid4(),
+        'user_uuid': uuid4(),
+        'app_uuid': uuid4(),
+        'submit_datetime': now} for i in range(count)]
+    streams = [{
+        'app_uuid': uuid4(),
+        'content_uuid': uuid4(),
+        'metadata': {'state': 'open', 'X-foo': 'bar'}} for i in range(count)]
+    return comments, flags, streams
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    comments, flags, streams = get_rows(args.rows)
+    print '%d rows per page, best of 3 x %d pages' % (
+        args.rows, args.repeat)
+    print '%-16s %12s %12s %8s' % (
+        'schema', 'colander ms', 'compiled ms', 'speedup')
+
+    for name, schema, rows in (
+            ('Comment (all)', Comment(include_all=True), comments),
+            ('Flag', Flag(), flags),
+            ('StreamMetadata', StreamMetadata(), streams)):
+        serialize = compile_serializer(schema)
+        assert [serialize(row) for row in rows] == \
+            [schema.serialize(row) for row in rows]
+
+        timings = []
+        for func in (schema.serialize, serialize):
+            timer = timeit.Timer(lambda: [func(row) for row in rows])
+            best = min(timer.repeat(3, args.repeat))
+            timings.append(best * 1000 / args.repeat)
+        print '%-16s %12.3f %12.3f %7.1fx' % (
+            name, timings[0], timings[1], timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
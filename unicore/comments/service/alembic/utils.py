@@ -0,0 +1,10 @@
+from __future__ import absolute_import
+
+from alembic import op
+
+
+def end_transaction():
+    ''' Commits the migration's transaction, since CREATE/DROP INDEX
+    CONCURRENTLY can't run inside one.
+    '''
+    op.execute('COMMIT')
@@ -0,0 +1,26 @@
+"""comment count versions
+
+Revision ID: 3a4c1d9e8b72
+Revises: e4b707279979
+Create Date: 2026-10-17 14:02:37.640128
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a4c1d9e8b72'
+down_revision = 'e4b707279979'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('comment_counts', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'))
+    op.alter_column('comment_counts', 'version', server_default=None)
+
+
+def downgrade():
+    op.drop_column('comment_counts', 'version')
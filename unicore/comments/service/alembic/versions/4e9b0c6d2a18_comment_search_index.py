@@ -0,0 +1,55 @@
+"""comment search index
+
+Revision ID: 4e9b0c6d2a18
+Revises: c7a2e94d1f06
+Create Date: 2026-10-17 22:31:47.602913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e9b0c6d2a18'
+down_revision = 'c7a2e94d1f06'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+from unicore.comments.service.alembic.utils import end_transaction
+
+
+# text search configurations by the language part of comment locales,
+# as in models.SEARCH_CONFIGS
+SEARCH_CONFIGS = (
+    ('dan', 'danish'),
+    ('deu', 'german'),
+    ('eng', 'english'),
+    ('fin', 'finnish'),
+    ('fra', 'french'),
+    ('hun', 'hungarian'),
+    ('ita', 'italian'),
+    ('nld', 'dutch'),
+    ('nor', 'norwegian'),
+    ('por', 'portuguese'),
+    ('ron', 'romanian'),
+    ('rus', 'russian'),
+    ('spa', 'spanish'),
+    ('swe', 'swedish'),
+    ('tur', 'turkish'),
+)
+# must be the same expression as Comment.get_search_vector, or the
+# index won't be used
+SEARCH_VECTOR = (
+    "to_tsvector(CASE %s ELSE 'simple'::regconfig END, comment)" %
+    ' '.join("WHEN (left(locale, 3) = '%s') THEN '%s'::regconfig" % config
+             for config in SEARCH_CONFIGS))
+
+
+def upgrade():
+    end_transaction()
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS comment_search_index '
+               'ON comments USING gin (%s)' % SEARCH_VECTOR)
+
+
+def downgrade():
+    end_transaction()
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS comment_search_index')
@@ -0,0 +1,30 @@
+"""flag count deltas table
+
+Revision ID: 5b2e7f1c9a30
+Revises: 3a4c1d9e8b72
+Create Date: 2026-10-17 19:41:08.215730
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2e7f1c9a30'
+down_revision = '3a4c1d9e8b72'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+
+def upgrade():
+    op.create_table('flag_count_deltas',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('comment_uuid', sqlalchemy_utils.types.uuid.UUIDType(binary=False), nullable=False),
+    sa.Column('delta', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('flag_count_deltas')
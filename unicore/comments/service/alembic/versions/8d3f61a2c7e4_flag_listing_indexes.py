@@ -0,0 +1,48 @@
+"""flag listing indexes
+
+Revision ID: 8d3f61a2c7e4
+Revises: 5b2e7f1c9a30
+Create Date: 2026-10-17 20:15:52.904417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d3f61a2c7e4'
+down_revision = '5b2e7f1c9a30'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+from unicore.comments.service.alembic.utils import end_transaction
+
+
+NEW_INDEXES = (
+    ('flag_submit_datetime_pk_index',
+     '(submit_datetime DESC, comment_uuid DESC, user_uuid DESC)'),
+    ('flag_app_submit_datetime_index',
+     '(app_uuid, submit_datetime DESC, comment_uuid DESC, user_uuid DESC)'),
+)
+OLD_INDEXES = (
+    ('flag_submit_datetime_index', '(submit_datetime)'),
+    ('flag_app_index', '(app_uuid)'),
+)
+
+
+def upgrade():
+    end_transaction()
+    for name, definition in NEW_INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s '
+                   'ON flags %s' % (name, definition))
+    # the old indexes are prefixes of the new ones
+    for name, _ in OLD_INDEXES:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+
+
+def downgrade():
+    end_transaction()
+    for name, definition in OLD_INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s '
+                   'ON flags %s' % (name, definition))
+    for name, _ in reversed(NEW_INDEXES):
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
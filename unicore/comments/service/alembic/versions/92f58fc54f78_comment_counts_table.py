@@ -0,0 +1,38 @@
+"""comment counts table
+
+Revision ID: 92f58fc54f78
+Revises: 1bd67c605fbe
+Create Date: 2026-10-17 09:12:41.503214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '92f58fc54f78'
+down_revision = '1bd67c605fbe'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+
+def upgrade():
+    op.create_table('comment_counts',
+    sa.Column('app_uuid', sqlalchemy_utils.types.uuid.UUIDType(binary=False), nullable=False),
+    sa.Column('content_uuid', sqlalchemy_utils.types.uuid.UUIDType(binary=False), nullable=False),
+    sa.Column('moderation_state', sa.Unicode(length=255), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('app_uuid', 'content_uuid', 'moderation_state')
+    )
+    # populate counts for existing comments
+    op.execute(
+        'INSERT INTO comment_counts '
+        '(app_uuid, content_uuid, moderation_state, count) '
+        'SELECT app_uuid, content_uuid, moderation_state, count(*) '
+        'FROM comments '
+        'GROUP BY app_uuid, content_uuid, moderation_state')
+
+
+def downgrade():
+    op.drop_table('comment_counts')
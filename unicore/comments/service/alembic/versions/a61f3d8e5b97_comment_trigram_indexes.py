@@ -0,0 +1,52 @@
+"""comment trigram indexes
+
+Revision ID: a61f3d8e5b97
+Revises: 4e9b0c6d2a18
+Create Date: 2026-10-17 23:12:05.281736
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a61f3d8e5b97'
+down_revision = '4e9b0c6d2a18'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+from unicore.comments.service.alembic.utils import end_transaction
+
+
+NEW_INDEXES = (
+    ('comment_content_title_trgm_index',
+     'USING gin (content_title gin_trgm_ops)'),
+    ('comment_user_name_trgm_index',
+     'USING gin (user_name gin_trgm_ops)'),
+)
+
+
+def upgrade():
+    is_available = op.get_bind().execute(
+        "SELECT exists(SELECT 1 FROM pg_available_extensions "
+        "WHERE name = 'pg_trgm')").scalar()
+    if not is_available:
+        # like filters on user_name and content_title rely on these
+        # indexes, so they can't be left out
+        raise RuntimeError(
+            'The pg_trgm extension is required but not available. It is '
+            'part of PostgreSQL contrib (e.g. the postgresql-contrib '
+            'package).')
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    end_transaction()
+    for name, definition in NEW_INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s '
+                   'ON comments %s' % (name, definition))
+
+
+def downgrade():
+    # the extension is left installed, since other database objects
+    # may use it
+    end_transaction()
+    for name, _ in reversed(NEW_INDEXES):
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
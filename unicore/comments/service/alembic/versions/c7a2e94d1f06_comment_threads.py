@@ -0,0 +1,57 @@
+"""comment threads
+
+Revision ID: c7a2e94d1f06
+Revises: 8d3f61a2c7e4
+Create Date: 2026-10-17 21:40:11.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7a2e94d1f06'
+down_revision = '8d3f61a2c7e4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+from unicore.comments.service.alembic.utils import end_transaction
+
+
+NEW_INDEXES = (
+    ('comment_path_index', '(path)'),
+    ('comment_parent_path_index', '(parent_uuid, path)'),
+)
+
+
+def upgrade():
+    op.add_column('comments', sa.Column(
+        'parent_uuid', sqlalchemy_utils.types.uuid.UUIDType(binary=False),
+        nullable=True))
+    op.add_column('comments', sa.Column(
+        'reply_count', sa.Integer(), nullable=False, server_default='0'))
+    op.alter_column('comments', 'reply_count', server_default=None)
+    op.add_column('comments', sa.Column(
+        'path', sa.Unicode(collation='C'), nullable=True))
+    # existing comments are top-level, so their path is their own
+    # component, as in Comment.get_path_component
+    op.execute(
+        "UPDATE comments SET path = "
+        "lpad(to_hex(greatest(0, floor(extract(epoch FROM submit_datetime) "
+        "* 1000000))::bigint), 13, '0') || replace(uuid::text, '-', '')")
+    op.alter_column('comments', 'path', nullable=False)
+
+    end_transaction()
+    for name, definition in NEW_INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s '
+                   'ON comments %s' % (name, definition))
+
+
+def downgrade():
+    end_transaction()
+    for name, _ in reversed(NEW_INDEXES):
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+    op.drop_column('comments', 'path')
+    op.drop_column('comments', 'reply_count')
+    op.drop_column('comments', 'parent_uuid')
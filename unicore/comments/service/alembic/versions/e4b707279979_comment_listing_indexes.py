@@ -0,0 +1,49 @@
+"""comment listing indexes
+
+Revision ID: e4b707279979
+Revises: 92f58fc54f78
+Create Date: 2026-10-17 11:40:03.117962
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e4b707279979'
+down_revision = '92f58fc54f78'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+from unicore.comments.service.alembic.utils import end_transaction
+
+
+NEW_INDEXES = (
+    ('comment_app_content_submit_datetime_index',
+     '(app_uuid, content_uuid, submit_datetime DESC, uuid DESC)'),
+    ('comment_visible_app_content_submit_datetime_index',
+     '(app_uuid, content_uuid, submit_datetime DESC, uuid DESC) '
+     'WHERE moderation_state = \'visible\''),
+    ('comment_flagged_app_submit_datetime_index',
+     '(app_uuid, submit_datetime DESC, uuid DESC) '
+     'WHERE flag_count > 0'),
+)
+
+
+def upgrade():
+    end_transaction()
+    for name, definition in NEW_INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s '
+                   'ON comments %s' % (name, definition))
+    # comment_app_content_index is a prefix of
+    # comment_app_content_submit_datetime_index
+    op.execute(
+        'DROP INDEX CONCURRENTLY IF EXISTS comment_app_content_index')
+
+
+def downgrade():
+    end_transaction()
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+               'comment_app_content_index '
+               'ON comments (app_uuid, content_uuid)')
+    for name, _ in reversed(NEW_INDEXES):
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
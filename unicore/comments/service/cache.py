@@ -0,0 +1,237 @@
+import functools
+from collections import OrderedDict
+
+from sqlalchemy import tuple_, literal
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+
+from unicore.comments.service import app
+from unicore.comments.service.models import BannedUser, StreamMetadata
+
+
+class CacheStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+    def to_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else None
+        }
+
+
+class BannedUserCache(object):
+    ''' Holds the whole ban list in memory, since it is small and
+    rarely changes. The list is reloaded when it is older than `ttl`
+    seconds, which bounds how long other processes take to see a
+    change. A `ttl` of 0 disables the cache.
+    '''
+
+    def __init__(self, ttl, clock):
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self.generation = 0
+        self.invalidate()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def invalidate(self, keys=None):
+        # a load that is in progress is discarded
+        self.generation += 1
+        self.banned = None
+        self.loaded_at = None
+
+    def is_fresh(self):
+        return (self.banned is not None and
+                self.clock.seconds() - self.loaded_at < self.ttl)
+
+    @inlineCallbacks
+    def load(self, connection):
+        cols = BannedUser.__table__.c
+        query = BannedUser.__table__.select() \
+            .with_only_columns([cols.user_uuid, cols.app_uuid])
+        generation = self.generation
+        loaded_at = self.clock.seconds()
+        result = yield connection.execute(query)
+        result = yield result.fetchall()
+        banned = set((row['user_uuid'], row['app_uuid']) for row in result)
+
+        if generation == self.generation:
+            self.banned = banned
+            self.loaded_at = loaded_at
+        returnValue(banned)
+
+    def get_banned(self, connection):
+        ''' Returns the set of (user_uuid, app_uuid) pairs in the ban
+        list. app_uuid is None for users banned from all apps.
+        '''
+        if self.is_fresh():
+            self.stats.hit()
+            return succeed(self.banned)
+        self.stats.miss()
+        return self.load(connection)
+
+    @inlineCallbacks
+    def is_banned(self, connection, user_uuid, app_uuid):
+        banned = yield self.get_banned(connection)
+        returnValue((user_uuid, app_uuid) in banned or
+                    (user_uuid, None) in banned)
+
+    def to_dict(self):
+        data = self.stats.to_dict()
+        data.update({
+            'ttl': self.ttl,
+            'size': len(self.banned) if self.banned is not None else None
+        })
+        return data
+
+
+class StreamMetadataCache(object):
+    ''' A bounded LRU read-through cache of stream metadata, keyed by
+    (app_uuid, content_uuid). Streams without a row are cached too.
+    Entries expire after `ttl` seconds, which bounds how long other
+    processes take to see a change. A `ttl` of 0 disables the cache.
+
+    Cached metadata is shared and must not be modified.
+    '''
+
+    def __init__(self, size, ttl, clock):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self.generation = 0
+        self.entries = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.size > 0
+
+    def invalidate(self, keys=None):
+        # loads that are in progress are discarded
+        self.generation += 1
+        if keys is None:
+            self.entries.clear()
+            return
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def get_fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.clock.seconds() - entry[1] >= self.ttl:
+            del self.entries[key]
+            return None
+        # move to the most recently used position
+        del self.entries[key]
+        self.entries[key] = entry
+        return entry
+
+    def store(self, key, metadata, loaded_at):
+        self.entries.pop(key, None)
+        self.entries[key] = (metadata, loaded_at)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    @inlineCallbacks
+    def get_many(self, connection, keys):
+        ''' Returns a dict mapping each (app_uuid, content_uuid) in
+        `keys` to the stream's metadata, or None if the stream isn't in
+        the database. Streams that aren't cached are selected with one
+        query.
+        '''
+        found = {}
+        missing = set()
+        for key in set(keys):
+            entry = self.get_fresh(key) if self.enabled else None
+            if entry is not None:
+                self.stats.hit()
+                found[key] = entry[0]
+            else:
+                if self.enabled:
+                    self.stats.miss()
+                missing.add(key)
+
+        if not missing:
+            returnValue(found)
+
+        generation = self.generation
+        loaded_at = self.clock.seconds()
+        cols = StreamMetadata.__table__.c
+        # only the missing streams are read, with the primary key index
+        query = StreamMetadata.__table__.select().where(
+            tuple_(cols.app_uuid, cols.content_uuid).in_([
+                tuple_(literal(app_uuid, type_=cols.app_uuid.type),
+                       literal(content_uuid, type_=cols.content_uuid.type))
+                for app_uuid, content_uuid in missing]))
+        result = yield connection.execute(query)
+        result = yield result.fetchall()
+        rows = dict(
+            ((row['app_uuid'], row['content_uuid']), row['metadata'])
+            for row in result)
+
+        for key in missing:
+            found[key] = rows.get(key)
+            if self.enabled and generation == self.generation:
+                self.store(key, found[key], loaded_at)
+        returnValue(found)
+
+    def get_metadata(self, connection, app_uuid, content_uuid):
+        ''' Returns the stream's metadata, or None if the stream
+        isn't in the database.
+        '''
+        key = (app_uuid, content_uuid)
+        d = self.get_many(connection, [key])
+        d.addCallback(lambda found: found[key])
+        return d
+
+    def to_dict(self):
+        data = self.stats.to_dict()
+        data.update({
+            'ttl': self.ttl,
+            'max_size': self.size,
+            'size': len(self.entries)
+        })
+        return data
+
+
+def invalidates(cache_name, get_keys=None):
+    ''' Invalidates `app.<cache_name>` once the decorated view has
+    succeeded. Used above `db.in_transaction`, this happens after the
+    transaction is committed, so that the cache can't be reloaded with
+    data from before the change.
+
+    `get_keys` is called with the view's arguments and returns the keys
+    to invalidate, or None to invalidate everything.
+    '''
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            def invalidate(result):
+                keys = get_keys(*args, **kwargs) if get_keys else None
+                getattr(app, cache_name).invalidate(keys)
+                return result
+
+            d = func(*args, **kwargs)
+            d.addCallback(invalidate)
+            return d
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,79 @@
+import json
+from uuid import UUID
+from datetime import date, datetime
+from collections import OrderedDict
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+AUTO = 'auto'
+
+
+def default(obj):
+    ''' Encodes UUIDs and datetimes the same way as the schemas.
+    '''
+    if isinstance(obj, UUID):
+        return obj.hex
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % (obj, ))
+
+
+class JSONCodec(object):
+    ''' Encodes and decodes JSON request and response bodies. `dumps`
+    returns a `str`.
+    '''
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<JSONCodec %s>' % self.name
+
+
+def json_dumps(data):
+    return json.dumps(data, default=default)
+
+
+def simplejson_dumps(data):
+    return simplejson.dumps(data, default=default)
+
+
+def ujson_dumps(data):
+    try:
+        return ujson.dumps(data, escape_forward_slashes=False)
+    except (TypeError, OverflowError):
+        # ujson has no default hook
+        return json_dumps(data)
+
+
+# in order of preference
+CODECS = OrderedDict()
+if ujson is not None:
+    CODECS['ujson'] = JSONCodec('ujson', ujson_dumps, ujson.loads)
+if simplejson is not None:
+    CODECS['simplejson'] = JSONCodec(
+        'simplejson', simplejson_dumps, simplejson.loads)
+CODECS['json'] = JSONCodec('json', json_dumps, json.loads)
+
+
+def get_codec(name):
+    ''' Returns the named codec. `auto` is the fastest one
+    that is installed.
+    '''
+    if name == AUTO:
+        return next(CODECS.itervalues())
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('JSON codec %r is not available' % (name, ))
@@ -1,11 +1,62 @@
 from confmodel import Config as ConfigBase
-from confmodel.fields import ConfigText, ConfigInt
+from confmodel.fields import ConfigText, ConfigInt, ConfigBool
 
 
 class Config(ConfigBase):
     database_url = ConfigText(
         'The URL specifying the database to use',
         required=True)
+    database_pool_size = ConfigInt(
+        'The number of database connections to keep open',
+        default=10)
+    database_max_overflow = ConfigInt(
+        'The number of database connections that may be opened in '
+        'addition to database_pool_size during bursts',
+        default=10)
+    database_pool_recycle = ConfigInt(
+        'The number of seconds after which database connections are '
+        'replaced. -1 disables recycling.',
+        default=3600)
+    database_pool_pre_ping = ConfigBool(
+        'Whether to check that database connections are alive before '
+        'using them. This costs a round trip per checkout, and otherwise '
+        'database_pool_recycle limits how stale connections can get.',
+        default=False)
+    threadpool_size = ConfigInt(
+        'The maximum size of the reactor threadpool, which runs database '
+        'queries. Defaults to database_pool_size + database_max_overflow.')
+    banned_user_cache_ttl = ConfigInt(
+        'The number of seconds the ban list is cached for. Other '
+        'processes may take this long to see changes. 0 disables '
+        'the cache.',
+        default=60)
+    stream_metadata_cache_size = ConfigInt(
+        'The maximum number of streams whose metadata is cached',
+        default=10000)
+    stream_metadata_cache_ttl = ConfigInt(
+        'The number of seconds stream metadata is cached for. Other '
+        'processes may take this long to see changes. 0 disables '
+        'the cache.',
+        default=60)
+    community_moderation_threshold = ConfigInt(
+        'The number of flags at which a visible comment is removed by the '
+        'community, for streams without flag_threshold metadata. If not '
+        'set, comments are only removed by the community on streams that '
+        'have a flag_threshold.')
+    flag_count_interval = ConfigInt(
+        'If set, flags record changes to flag counts instead of updating '
+        'comments, and the changes are applied every this many seconds. '
+        'flag_count, and filtering on it, may then be this many seconds '
+        'out of date, but flags on the same comment do not wait for '
+        'each other.')
+    json_codec = ConfigText(
+        'The JSON library used for request and response bodies: json, '
+        'simplejson, ujson or auto, which picks the fastest one installed',
+        default='auto')
     port = ConfigInt(
         'The port to listen on',
         default=8080)
+    cursor_secret = ConfigText(
+        'The secret used to sign pagination cursors. If not set, a random '
+        'secret is generated at startup, so cursors are not valid after a '
+        'restart or in other processes.')
@@ -0,0 +1,50 @@
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from unicore.comments.service import app
+from unicore.comments.service.views.flags import fold_flag_counts
+
+
+class FlagCountAggregator(object):
+    ''' Applies the flag counts recorded by flags to comments every
+    `interval` seconds, when flag counts are deferred. A fold that
+    fails is logged and retried at the next interval. Several
+    processes can run aggregators at the same time.
+    '''
+
+    def __init__(self, interval, clock):
+        self.interval = interval
+        self.clock = clock
+        self.call = None
+        self.folded = 0
+
+    def start(self):
+        self.call = LoopingCall(self.fold)
+        self.call.clock = self.clock
+        return self.call.start(self.interval, now=False)
+
+    def stop(self):
+        if self.call is not None and self.call.running:
+            self.call.stop()
+
+    def fold(self):
+        d = self._fold()
+        d.addErrback(log.err, 'Error folding flag counts')
+        return d
+
+    @inlineCallbacks
+    def _fold(self):
+        connection = yield app.db_engine.connect()
+        try:
+            count = yield fold_flag_counts(connection)
+        finally:
+            yield connection.close()
+        self.folded += count
+        returnValue(count)
+
+    def to_dict(self):
+        return {
+            'interval': self.interval,
+            'folded': self.folded
+        }
@@ -1,15 +1,69 @@
+import json
 import functools
 
 from alchimia import TWISTED_STRATEGY
 from sqlalchemy import create_engine
-from twisted.internet.defer import inlineCallbacks, returnValue
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
 
 from unicore.comments.service import app
 
 
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    ''' Raising DisconnectionError on checkout makes the pool
+    replace the connection and retry.
+    '''
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+
 def get_engine(config, reactor):
+    pool_events = []
+    if config.database_pool_pre_ping:
+        pool_events.append((ping_connection, 'checkout'))
+
     return create_engine(
-        config.database_url, reactor=reactor, strategy=TWISTED_STRATEGY)
+        config.database_url, reactor=reactor, strategy=TWISTED_STRATEGY,
+        pool_size=config.database_pool_size,
+        max_overflow=config.database_max_overflow,
+        pool_recycle=config.database_pool_recycle,
+        pool_events=pool_events)
+
+
+def get_threadpool_size(config):
+    ''' Every database connection in the pool needs a thread,
+    otherwise queries wait for threads rather than connections.
+    '''
+    if config.threadpool_size is not None:
+        return config.threadpool_size
+    return config.database_pool_size + config.database_max_overflow
+
+
+def warm_up(engine, count):
+    ''' Opens `count` connections and returns them to the pool, so
+    that early requests don't wait for connection setup.
+    '''
+    d = DeferredList(
+        [engine.connect() for i in range(count)], consumeErrors=True)
+    d.addCallback(lambda results: DeferredList(
+        [connection.close() for success, connection in results if success]))
+    return d
+
+
+def fetchmany(result, size):
+    ''' Fetches up to `size` rows of `result` in a thread. alchimia's
+    result proxies don't provide fetchmany, so this uses its internals,
+    which is why alchimia is pinned and DBTestCase.test_fetchmany exists.
+    '''
+    return result._engine._defer_to_thread(
+        result._result_proxy.fetchmany, size)
 
 
 def in_transaction(func):
@@ -33,3 +87,27 @@ def in_transaction(func):
         returnValue(returnVal)
 
     return wrapper
+
+
+class Explain(Executable, ClauseElement):
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) %s' % compiler.process(
+        element.statement, **kwargs)
+
+
+@inlineCallbacks
+def estimate_count(connection, query):
+    ''' Returns the planner's estimate of the number of rows
+    `query` will return, without running it.
+    '''
+    result = yield connection.execute(Explain(query))
+    plan = yield result.scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    returnValue(int(plan[0]['Plan']['Plan Rows']))
@@ -1,10 +1,12 @@
+import os
 import sys
 import argparse
 
 import yaml
 from twisted.internet import reactor
 
-from unicore.comments.service import db, app, views  # noqa
+from unicore.comments.service import (  # noqa
+    db, app, cache, codec, counters, views)
 from unicore.comments.service.config import Config
 
 
@@ -19,11 +21,27 @@ def configure_app():
 
     if args.port:
         config.port = args.port
+    if not config.cursor_secret:
+        config.cursor_secret = os.urandom(32).encode('hex')
 
+    reactor.suggestThreadPoolSize(db.get_threadpool_size(config))
     db_engine = db.get_engine(config, reactor)
+    reactor.callWhenRunning(
+        db.warm_up, db_engine, config.database_pool_size)
 
     app.db_engine = db_engine
     app.config = config
+    app.banned_user_cache = cache.BannedUserCache(
+        config.banned_user_cache_ttl, reactor)
+    app.stream_metadata_cache = cache.StreamMetadataCache(
+        config.stream_metadata_cache_size,
+        config.stream_metadata_cache_ttl, reactor)
+    app.json_codec = codec.get_codec(config.json_codec)
+    app.flag_count_aggregator = None
+    if config.flag_count_interval:
+        app.flag_count_aggregator = counters.FlagCountAggregator(
+            config.flag_count_interval, reactor)
+        reactor.callWhenRunning(app.flag_count_aggregator.start)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,14 @@
-from uuid import uuid4
+from uuid import uuid4, UUID
+from datetime import datetime
 
+import pytz
+import iso8601
 from sqlalchemy import (Column, Integer, Unicode, MetaData, Table, Index,
-                        DateTime, ForeignKey, Boolean, and_, UniqueConstraint)
+                        DateTime, ForeignKey, Boolean, and_, UniqueConstraint,
+                        BigInteger, DDL, event)
 from sqlalchemy.inspection import inspect
-from sqlalchemy.sql import func, exists
+from sqlalchemy.sql import func, exists, literal, literal_column, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy_utils import UUIDType, URLType, JSONType
 from twisted.internet.defer import inlineCallbacks, returnValue
 
@@ -17,6 +22,32 @@ COMMENT_MODERATION_STATES = (
     (u'removed_by_community', u'Removed by community'),
     (u'removed_for_profanity', u'Removed for profanity'))
 COMMENT_STREAM_STATES = (u'open', u'closed', u'disabled')
+PATH_SEPARATOR = u'.'
+# each level of a path adds 46 characters, and the paths' btree index
+# rows can't be larger than about 2700 bytes
+MAX_REPLY_DEPTH = 32
+# text search configurations by the language part of comment locales.
+# Other languages use the 'simple' configuration, which doesn't stem.
+SEARCH_CONFIGS = (
+    ('dan', 'danish'),
+    ('deu', 'german'),
+    ('eng', 'english'),
+    ('fin', 'finnish'),
+    ('fra', 'french'),
+    ('hun', 'hungarian'),
+    ('ita', 'italian'),
+    ('nld', 'dutch'),
+    ('nor', 'norwegian'),
+    ('por', 'portuguese'),
+    ('ron', 'romanian'),
+    ('rus', 'russian'),
+    ('spa', 'spanish'),
+    ('swe', 'swedish'),
+    ('tur', 'turkish'))
+DEFAULT_SEARCH_CONFIG = 'simple'
+# comment columns with trigram indexes, which like filters can use
+COMMENT_TRIGRAM_COLUMNS = ('content_title', 'user_name')
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
 
 FLAG_TABLE_NAME = 'flags'
 
@@ -24,8 +55,35 @@ BANNED_USERS_TABLE_NAME = 'banned_users'
 
 STREAM_METADATA_TABLE_NAME = 'stream_metadata'
 
+COMMENT_COUNT_TABLE_NAME = 'comment_counts'
+
+FLAG_COUNT_DELTA_TABLE_NAME = 'flag_count_deltas'
+
 
 metadata = MetaData()
+# the trigram indexes on comments need pg_trgm, which is required, as
+# in the comment_trigram_indexes migration
+event.listen(metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+class RowObjectMeta(type):
+    ''' Gives row object classes empty `__slots__`, so that instances
+    don't have a `__dict__`, and caches their table's column names and
+    primary key columns when the class is created.
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        table = namespace.get('__table__')
+        if table is not None:
+            namespace['column_names'] = tuple(c.name for c in table.c)
+            namespace['column_name_set'] = frozenset(
+                namespace['column_names'])
+            namespace['pk_columns'] = tuple(inspect(table).primary_key)
+            namespace['pk_names'] = frozenset(
+                c.name for c in namespace['pk_columns'])
+        return super(RowObjectMeta, mcs).__new__(mcs, name, bases, namespace)
 
 
 class RowObjectMixin(object):
@@ -37,19 +95,31 @@ class RowObjectMixin(object):
     a new row, update an existing row or select a row by primary key.
 
     The `get` and `set` methods update the underlying row data. Altered
-    data can be saved by calling `update`.
+    data can be saved by calling `update`, which only writes the columns
+    that have changed since the row was selected or saved. All the data
+    of an instance constructed by the caller counts as changed.
 
     '''
+    __metaclass__ = RowObjectMeta
+    __slots__ = ('connection', 'row_dict', '_dirty')
 
     def __init__(self, connection, row):
         self.connection = connection
-        self.row_dict = dict((k, v) for k, v in row.items())
+        self.row_dict = dict(row.items())
+        # None means that all of row_dict is dirty
+        self._dirty = None
+
+    @property
+    def dirty(self):
+        ''' The names of the columns that haven't been saved.
+        '''
+        if self._dirty is None:
+            return frozenset(self.row_dict)
+        return self._dirty
 
     @classmethod
     def _pk_expression(cls, data):
-        expressions = [
-            (c == data[c.name])
-            for c in inspect(cls.__table__).primary_key]
+        expressions = [(c == data[c.name]) for c in cls.pk_columns]
         return and_(*expressions)
 
     @property
@@ -62,30 +132,53 @@ class RowObjectMixin(object):
                       for k, v in kwargs.iteritems()]
         return and_(*expression)
 
+    @classmethod
+    def with_defaults(cls, data):
+        ''' Returns a copy of `data` with Python-side column defaults
+        filled in, for queries that SQLAlchemy can't apply them to.
+        '''
+        data = dict(data)
+        for c in cls.__table__.c:
+            if c.name in data or c.default is None:
+                continue
+            if c.default.is_callable:
+                data[c.name] = c.default.arg(None)
+            elif c.default.is_scalar:
+                data[c.name] = c.default.arg
+        return data
+
     def to_dict(self):
-        return dict(
-            (c.name, self.row_dict[c.name]) for c in self.__table__.c)
+        row_dict = self.row_dict
+        return dict((name, row_dict[name]) for name in self.column_names)
 
     def get(self, attr):
-        if attr not in self.__table__.c:
+        if attr not in self.column_name_set:
             raise KeyError('%r is not a column name' % attr)
 
         return self.row_dict.get(attr, None)
 
     def set(self, attr, value):
-        if attr not in self.__table__.c:
+        if attr not in self.column_name_set:
             raise KeyError('%r is not a column name' % attr)
 
+        if self._dirty is not None and (
+                attr not in self.row_dict or self.row_dict[attr] != value):
+            self._dirty = self._dirty.union((attr, ))
         self.row_dict[attr] = value
 
     @inlineCallbacks
-    def _query_and_refresh(self, query):
-        query = query.returning(*self.__table__.c)
+    def _query_and_refresh(self, query, returning=None):
+        if returning is None:
+            returning = self.__table__.c
+        if returning:
+            query = query.returning(*returning)
         result = yield self.connection.execute(query)
-        # update data with auto-generated defaults
         if result.rowcount:
-            returned = yield result.fetchone()
-            self.row_dict = dict((k, v) for k, v in returned.items())
+            self._dirty = frozenset()
+            # update data with auto-generated defaults
+            if returning:
+                returned = yield result.fetchone()
+                self.row_dict.update(returned.items())
 
         returnValue(result)
 
@@ -98,16 +191,23 @@ class RowObjectMixin(object):
         returnValue(result.rowcount)
 
     @inlineCallbacks
-    def update(self):
-        data_without_pk = self.row_dict.copy()
-        for c in inspect(self.__table__).primary_key:
-            del data_without_pk[c.name]
+    def update(self, returning=None):
+        ''' Saves the changed columns. The columns in `returning` are
+        refreshed from the database, which is all of them by default.
+        '''
+        changed = dict(
+            (name, self.row_dict[name])
+            for name in self.dirty if name not in self.pk_names)
+
+        if not changed:
+            found = yield self.exists(self.connection, self.pk_expression)
+            returnValue(int(found))
 
         query = self.__table__ \
             .update() \
-            .values(**data_without_pk) \
+            .values(**changed) \
             .where(self.pk_expression)
-        result = yield self._query_and_refresh(query)
+        result = yield self._query_and_refresh(query, returning=returning)
         returnValue(result.rowcount)
 
     @inlineCallbacks
@@ -132,17 +232,21 @@ class RowObjectMixin(object):
 
     @classmethod
     @inlineCallbacks
-    def get_one(cls, connection, expression=None, **kwargs):
+    def get_one(cls, connection, expression=None, for_update=False,
+                **kwargs):
         if expression is None:
             expression = cls.match_all_expression(**kwargs)
 
         query = cls.__table__ \
             .select() \
             .where(expression)
+        if for_update:
+            query = query.with_for_update()
         result = yield connection.execute(query)
         result = yield result.first()
         if result is not None:
             result = cls(connection, result)
+            result._dirty = frozenset()
         returnValue(result)
 
     @classmethod
@@ -179,15 +283,133 @@ class Comment(RowObjectMixin):
         Column(
             'moderation_state', Unicode(255), default=u'visible',
             nullable=False),
+        # Threading
+        Column('parent_uuid', UUIDType(binary=False)),
+        # the path components of the comment's ancestors and itself,
+        # separated by '.'. A subtree's paths share a prefix and so are
+        # a range in the path index.
+        Column('path', Unicode(collation='C'), nullable=False),
+        Column('reply_count', Integer, default=0, nullable=False),
         # Not required data
         Column('ip_address', Unicode(15)),
         # Indexes
-        Index('comment_app_content_index', 'app_uuid', 'content_uuid'),
         Index('comment_user_index', 'user_uuid'),
-        Index('comment_submit_datetime_index', 'submit_datetime')
+        Index('comment_submit_datetime_index', 'submit_datetime'),
+        Index('comment_path_index', 'path'),
+        Index('comment_parent_path_index', 'parent_uuid', 'path')
     )
     __table__ = comments
 
+    @staticmethod
+    def get_path_component(data):
+        ''' Returns the path component of the comment in `data`. These
+        sort by submit_datetime, then uuid, so that replies are ordered
+        by submission.
+        '''
+        submit_datetime, uuid = data['submit_datetime'], data['uuid']
+        # the values may also be strings, as when inserting a comment
+        if not isinstance(submit_datetime, datetime):
+            submit_datetime = iso8601.parse_date(submit_datetime)
+        if not isinstance(uuid, UUID):
+            uuid = UUID(uuid)
+        delta = submit_datetime - EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+            delta.microseconds
+        return u'%013x%s' % (max(micros, 0), uuid.hex)
+
+    @classmethod
+    def get_path(cls, data, parent_path=None):
+        component = cls.get_path_component(data)
+        if parent_path is None:
+            return component
+        return u'%s%s%s' % (parent_path, PATH_SEPARATOR, component)
+
+    @staticmethod
+    def get_depth(path):
+        ''' Returns how deeply the comment with `path` is nested, which
+        is 0 for top-level comments.
+        '''
+        return path.count(PATH_SEPARATOR)
+
+    @classmethod
+    def with_defaults(cls, data):
+        ''' Also fills in the path of top-level comments. The path of a
+        reply depends on its parent's and must be provided.
+        '''
+        data = super(Comment, cls).with_defaults(data)
+        if data.get('path') is None and data.get('parent_uuid') is None:
+            data['path'] = cls.get_path(data)
+        return data
+
+    def insert(self):
+        self.row_dict = self.with_defaults(self.row_dict)
+        return super(Comment, self).insert()
+
+    @staticmethod
+    def get_search_config(name):
+        return literal_column("'%s'::regconfig" % name)
+
+    @classmethod
+    def get_search_vector(cls):
+        ''' Returns the text search vector of comments, which is in the
+        language of the comment's locale. This is the expression of the
+        comment_search_index and mustn't be changed without it.
+        '''
+        columns = cls.__table__.c
+        language = func.left(columns.locale, 3)
+        config = case(
+            [(language == literal_column("'%s'" % code),
+              cls.get_search_config(name))
+             for code, name in SEARCH_CONFIGS],
+            else_=cls.get_search_config(DEFAULT_SEARCH_CONFIG))
+        return func.to_tsvector(config, columns.comment)
+
+    @classmethod
+    def get_search_query(cls, text):
+        ''' Returns a text search query for `text` in all languages that
+        comments can be in, which can be matched against any comment's
+        search vector.
+        '''
+        text = literal(text, type_=Unicode)
+        names = sorted(set(
+            [name for _, name in SEARCH_CONFIGS] + [DEFAULT_SEARCH_CONFIG]))
+        queries = [func.plainto_tsquery(cls.get_search_config(name), text)
+                   for name in names]
+        return reduce(lambda a, b: a.op('||')(b), queries)
+
+
+# These indexes match the default ordering of comment listings, so
+# that a stream's comments can be read in order without sorting.
+Index('comment_app_content_submit_datetime_index',
+      Comment.comments.c.app_uuid,
+      Comment.comments.c.content_uuid,
+      Comment.comments.c.submit_datetime.desc(),
+      Comment.comments.c.uuid.desc())
+Index('comment_visible_app_content_submit_datetime_index',
+      Comment.comments.c.app_uuid,
+      Comment.comments.c.content_uuid,
+      Comment.comments.c.submit_datetime.desc(),
+      Comment.comments.c.uuid.desc(),
+      postgresql_where=Comment.comments.c.moderation_state == u'visible')
+Index('comment_flagged_app_submit_datetime_index',
+      Comment.comments.c.app_uuid,
+      Comment.comments.c.submit_datetime.desc(),
+      Comment.comments.c.uuid.desc(),
+      postgresql_where=Comment.comments.c.flag_count > 0)
+Index('comment_search_index',
+      Comment.get_search_vector(),
+      postgresql_using='gin')
+# These need the pg_trgm extension, which metadata creates. Like filters
+# are only allowed on the columns in COMMENT_TRIGRAM_COLUMNS.
+Index('comment_content_title_trgm_index',
+      Comment.comments.c.content_title,
+      postgresql_using='gin',
+      postgresql_ops={'content_title': 'gin_trgm_ops'})
+Index('comment_user_name_trgm_index',
+      Comment.comments.c.user_name,
+      postgresql_using='gin',
+      postgresql_ops={'user_name': 'gin_trgm_ops'})
+
 
 class Flag(RowObjectMixin):
     flags = Table(
@@ -199,14 +421,24 @@ class Flag(RowObjectMixin):
         Column('user_uuid', UUIDType(binary=False), primary_key=True),
         # Other required data
         Column('app_uuid', UUIDType(binary=False), nullable=False),
-        Column('submit_datetime', DateTime(timezone=True), nullable=False),
-        # Indexes
-        Index('flag_submit_datetime_index', 'submit_datetime'),
-        Index('flag_app_index', 'app_uuid')
+        Column('submit_datetime', DateTime(timezone=True), nullable=False)
     )
     __table__ = flags
 
 
+# These indexes match the ordering of flag listings, so that flags can
+# be paged by cursor without sorting.
+Index('flag_submit_datetime_pk_index',
+      Flag.flags.c.submit_datetime.desc(),
+      Flag.flags.c.comment_uuid.desc(),
+      Flag.flags.c.user_uuid.desc())
+Index('flag_app_submit_datetime_index',
+      Flag.flags.c.app_uuid,
+      Flag.flags.c.submit_datetime.desc(),
+      Flag.flags.c.comment_uuid.desc(),
+      Flag.flags.c.user_uuid.desc())
+
+
 class BannedUser(RowObjectMixin):
     banned_users = Table(
         BANNED_USERS_TABLE_NAME, metadata,
@@ -234,3 +466,101 @@ class StreamMetadata(RowObjectMixin):
         Column('metadata', JSONType())
     )
     __table__ = stream_metadata
+
+
+class CommentCount(RowObjectMixin):
+    ''' Maintains the number of comments per stream and moderation state,
+    so that listing totals don't require counting the comments table.
+    '''
+
+    comment_counts = Table(
+        COMMENT_COUNT_TABLE_NAME, metadata,
+        # Identifiers
+        Column('app_uuid', UUIDType(binary=False), primary_key=True),
+        Column('content_uuid', UUIDType(binary=False), primary_key=True),
+        Column('moderation_state', Unicode(255), primary_key=True),
+        # Other
+        Column('count', Integer, default=0, nullable=False),
+        # incremented whenever a comment with this key changes
+        Column('version', Integer, default=1, nullable=False)
+    )
+    __table__ = comment_counts
+
+    @classmethod
+    def upsert_query(cls, query):
+        ''' Adds `count` to the existing row and increments its version
+        when `query`, an insert into this table, conflicts with it.
+        '''
+        cols = cls.__table__.c
+        return query.on_conflict_do_update(
+            index_elements=[c.name for c in cls.pk_columns],
+            set_={'count': cols.count + query.excluded.count,
+                  'version': cols.version + 1})
+
+    @classmethod
+    def increment_from_select(cls, select_query):
+        ''' Returns a query that increments the counts for the
+        (app_uuid, content_uuid, moderation_state, count) rows
+        returned by `select_query`.
+        '''
+        # column defaults aren't applied to inserts nested in CTEs
+        query = pg_insert(cls.__table__).from_select(
+            ['app_uuid', 'content_uuid', 'moderation_state', 'count',
+             'version'],
+            select_query.column(literal(1)))
+        return cls.upsert_query(query)
+
+    @classmethod
+    def increment(cls, connection, app_uuid, content_uuid, moderation_state,
+                  amount=1):
+        query = pg_insert(cls.__table__).values(
+            app_uuid=app_uuid,
+            content_uuid=content_uuid,
+            moderation_state=moderation_state,
+            count=amount)
+        return connection.execute(cls.upsert_query(query))
+
+    @classmethod
+    def increment_many(cls, connection, amounts):
+        ''' Increments the count of each (app_uuid, content_uuid,
+        moderation_state) key in the dict `amounts` by its value,
+        with one query.
+        '''
+        query = pg_insert(cls.__table__).values([
+            {'app_uuid': app_uuid,
+             'content_uuid': content_uuid,
+             'moderation_state': moderation_state,
+             'count': amount}
+            for (app_uuid, content_uuid, moderation_state), amount
+            in amounts.iteritems()])
+        return connection.execute(cls.upsert_query(query))
+
+    @classmethod
+    def decrement(cls, connection, app_uuid, content_uuid, moderation_state,
+                  amount=1):
+        return cls.increment(
+            connection, app_uuid, content_uuid, moderation_state,
+            amount=-amount)
+
+    @classmethod
+    def touch(cls, connection, app_uuid, content_uuid, moderation_state):
+        ''' Increments the version without changing the count, for
+        changes to comments that don't affect the count.
+        '''
+        return cls.increment(
+            connection, app_uuid, content_uuid, moderation_state, amount=0)
+
+
+class FlagCountDelta(RowObjectMixin):
+    ''' Changes to comments' flag counts that haven't been applied yet,
+    when flag counts are deferred. Rows are only ever inserted and
+    deleted, so flags never wait for each other.
+    '''
+
+    flag_count_deltas = Table(
+        FLAG_COUNT_DELTA_TABLE_NAME, metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('comment_uuid', UUIDType(binary=False), nullable=False),
+        Column('delta', Integer, nullable=False)
+    )
+    __table__ = flag_count_deltas
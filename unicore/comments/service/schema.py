@@ -6,10 +6,18 @@ from unicore.comments.service import validators as vlds
 
 
 class UUIDType(object):
+    ''' If `null_is_missing` is True, an explicit null is deserialized
+    like a missing value, as for comments without parents.
+    '''
+
+    def __init__(self, null_is_missing=False):
+        self.null_is_missing = null_is_missing
 
     def deserialize(self, node, cstruct):
         if cstruct == colander.null:
-            return cstruct
+            return colander.null
+        if cstruct is None and self.null_is_missing:
+            return colander.null
 
         try:
             return uuid.UUID(cstruct)
@@ -73,17 +81,41 @@ class Comment(colander.MappingSchema):
         validator=vlds.ip_address_validator,
         missing=colander.drop,
         default='None')
+    parent_uuid = colander.SchemaNode(
+        UUIDType(null_is_missing=True),
+        missing=colander.drop,
+        default=colander.drop)
 
     def __init__(self, *args, **kwargs):
         super(Comment, self).__init__(*args, **kwargs)
 
-        # Add flag_count only if include_all is True.
-        # Flag count should only be updated via the Flag API.
+        # Add flag_count and reply_count only if include_all is True.
+        # Flag count should only be updated via the Flag API, and reply
+        # count when replies are created or deleted.
         if kwargs.get('include_all', False):
             self.add(colander.SchemaNode(
                 colander.Integer(),
                 name='flag_count',
                 missing=colander.drop))
+            self.add(colander.SchemaNode(
+                colander.Integer(),
+                name='reply_count',
+                missing=colander.drop))
+
+
+class CommentModeration(colander.MappingSchema):
+    is_removed = colander.SchemaNode(
+        colander.Boolean(),
+        missing=colander.drop)
+    moderation_state = colander.SchemaNode(
+        colander.String(),
+        validator=vlds.moderation_state_validator,
+        missing=colander.drop)
+
+    def validator(self, node, value):
+        if not value:
+            raise colander.Invalid(
+                node, 'is_removed or moderation_state is required')
 
 
 class Flag(colander.MappingSchema):
@@ -98,6 +130,18 @@ class Flag(colander.MappingSchema):
         colander.DateTime())
 
 
+class FlagSummary(colander.MappingSchema):
+    comment_uuid = colander.SchemaNode(UUIDType())
+    count = colander.SchemaNode(colander.Integer())
+    first_submit_datetime = colander.SchemaNode(colander.DateTime())
+    last_submit_datetime = colander.SchemaNode(colander.DateTime())
+    user_uuids = colander.SchemaNode(
+        colander.Sequence(),
+        colander.SchemaNode(UUIDType()),
+        missing=colander.drop,
+        default=colander.drop)
+
+
 class BannedUser(colander.MappingSchema):
     user_uuid = colander.SchemaNode(
         UUIDType(),
@@ -117,6 +161,11 @@ class KnownStreamMetadata(colander.MappingSchema):
         missing=colander.drop,
         default=colander.drop,
         validator=vlds.stream_state_validator)
+    flag_threshold = colander.SchemaNode(
+        colander.Integer(),
+        missing=colander.drop,
+        default=colander.drop,
+        validator=colander.Range(min=1))
 
     def split(self, value):
         external = {}
@@ -0,0 +1,140 @@
+from datetime import date, datetime
+
+import colander
+from colander import null, drop, deferred
+
+from unicore.comments.service.schema import UUIDType
+
+
+def serialize_string(typ):
+    if typ.encoding:
+        return None
+
+    def serialize(value):
+        if value is null or value.__class__ is unicode:
+            return value
+        return unicode(value)
+
+    return serialize
+
+
+def serialize_number(typ):
+    num = typ.num
+
+    def serialize(value):
+        if value is null:
+            return null
+        return str(num(value))
+
+    return serialize
+
+
+def serialize_boolean(typ):
+    true_val = typ.true_val
+    false_val = typ.false_val
+
+    def serialize(value):
+        if value is null:
+            return null
+        return value and true_val or false_val
+
+    return serialize
+
+
+def serialize_datetime(typ):
+    default_tzinfo = typ.default_tzinfo
+
+    def serialize(value):
+        if not value:
+            return null
+        if value.__class__ is date:
+            value = datetime.combine(value, datetime.min.time())
+        elif not isinstance(value, datetime):
+            raise ValueError(value)
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=default_tzinfo)
+        return value.isoformat()
+
+    return serialize
+
+
+def serialize_uuid(typ):
+
+    def serialize(value):
+        if value is null or value is None:
+            return None
+        return value.hex
+
+    return serialize
+
+
+TYPE_SERIALIZERS = {
+    colander.String: serialize_string,
+    colander.Integer: serialize_number,
+    colander.Float: serialize_number,
+    colander.Boolean: serialize_boolean,
+    colander.DateTime: serialize_datetime,
+    UUIDType: serialize_uuid,
+}
+
+
+def overrides_serialize(node):
+    return (type(node).serialize.__func__ is not
+            colander.SchemaNode.serialize.__func__)
+
+
+def compile_node(node):
+    ''' Returns a function that serializes a value like `node.serialize`,
+    or None if `node` can't be specialized.
+    '''
+    if overrides_serialize(node):
+        return None
+    get_serializer = TYPE_SERIALIZERS.get(type(node.typ))
+    if get_serializer is None:
+        return None
+    return get_serializer(node.typ)
+
+
+def compile_serializer(schema):
+    ''' Returns a function that serializes a mapping (e.g. a RowProxy)
+    exactly like `schema.serialize`, but with each child's type
+    resolved once, ahead of time. Children of types that aren't
+    known are serialized by the child node.
+
+    If specialized serialization fails, the value is serialized by
+    `schema`, so that errors are the same too.
+    '''
+    if (type(schema.typ) is not colander.Mapping or
+            schema.typ.unknown != 'ignore' or
+            overrides_serialize(schema)):
+        return schema.serialize
+
+    fields = []
+    for node in schema.children:
+        default = node.default
+        if isinstance(default, deferred):
+            default = null
+        fields.append((node.name, default, node.default is drop,
+                       compile_node(node) or node.serialize))
+    fields = tuple(fields)
+
+    def serialize(value):
+        try:
+            result = {}
+            for name, default, drop_null, serialize_value in fields:
+                try:
+                    subvalue = value[name]
+                except KeyError:
+                    subvalue = null
+                if subvalue is drop or (subvalue is null and drop_null):
+                    continue
+                if subvalue is null:
+                    subvalue = default
+                subresult = serialize_value(subvalue)
+                if subresult is not drop:
+                    result[name] = subresult
+            return result
+        except Exception:
+            return schema.serialize(value)
+
+    return serialize
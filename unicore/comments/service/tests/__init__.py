@@ -4,12 +4,14 @@ from urlparse import urlparse, parse_qs
 
 from alembic.config import Config as AlembicConfig
 from sqlalchemy.schema import CreateTable, DropTable
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 from aludel.tests.doubles import FakeReactorThreads
 from klein.test.test_resource import requestMock as baseRequestMock, _render
 
 from unicore.comments.service.config import Config
-from unicore.comments.service import db, app, resource, views  # noqa
+from unicore.comments.service import (  # noqa
+    db, app, resource, cache, codec, views)
 from unicore.comments.service.models import metadata
 
 
@@ -19,7 +21,7 @@ test_dir = os.path.dirname(__file__)
 def requestMock(path, method="GET", body=None, headers=None):
     parts = urlparse(path)
     request = baseRequestMock(parts.path, method, body=body, headers=headers)
-    request.args = parse_qs(parts.query)
+    request.args = parse_qs(parts.query, keep_blank_values=True)
     request.path = parts.path
     return request
 
@@ -27,7 +29,8 @@ def requestMock(path, method="GET", body=None, headers=None):
 def mk_config(**overrides):
     defaults = {
         'database_url':
-            'postgresql://postgres@localhost/unicore_comments_test'
+            'postgresql://postgres@localhost/unicore_comments_test',
+        'cursor_secret': 'secret'
     }
     defaults.update(overrides)
     return Config(defaults)
@@ -75,6 +78,14 @@ class ViewTestCase(BaseTestCase):
         super(ViewTestCase, self).setUp()
         app.db_engine = self.engine
         app.config = self.config
+        self.clock = Clock()
+        app.banned_user_cache = cache.BannedUserCache(
+            self.config.banned_user_cache_ttl, self.clock)
+        app.stream_metadata_cache = cache.StreamMetadataCache(
+            self.config.stream_metadata_cache_size,
+            self.config.stream_metadata_cache_ttl, self.clock)
+        app.json_codec = codec.get_codec(self.config.json_codec)
+        app.flag_count_aggregator = None
 
     def request(self, method, path, body=None, headers=None):
         if headers is None:
@@ -83,7 +94,7 @@ class ViewTestCase(BaseTestCase):
             if not isinstance(headers[name], (tuple, list)):
                 headers[name] = [headers[name]]
 
-        if isinstance(body, dict):
+        if isinstance(body, (dict, list)):
             body = json.dumps(body)
             headers['Content-Type'] = ['application/json']
 
@@ -111,6 +122,10 @@ class ViewTestCase(BaseTestCase):
         super(ViewTestCase, self).tearDown()
         del app.db_engine
         del app.config
+        del app.banned_user_cache
+        del app.stream_metadata_cache
+        del app.json_codec
+        del app.flag_count_aggregator
 
 
 __all__ = [
@@ -0,0 +1,112 @@
+import json
+from uuid import UUID
+from datetime import datetime
+from unittest import TestCase
+
+import pytz
+
+from unicore.comments.service import app, codec
+from unicore.comments.service.models import Comment
+from unicore.comments.service.tests import ViewTestCase
+from unicore.comments.service.tests.test_models import comment_data
+from unicore.comments.service.tests.test_schema import (
+    comment_data as comment_request_data)
+
+
+bodies = (
+    u'plain ascii',
+    u'caf\xe9 na\xefve \u2603 \u4e2d\u6587',
+    u'\U0001f600 astral',
+    u'quotes " and \\ backslashes / slashes',
+    u'control \n\r\t\x00\x1f characters',
+    u'</script><script>alert(1)</script>',
+    u'\u2028\u2029 separators',
+    u'')
+
+
+class CodecTestCase(TestCase):
+
+    def test_get_codec(self):
+        self.assertEqual(
+            codec.get_codec('auto'), codec.CODECS.values()[0])
+        self.assertEqual(codec.get_codec('json').name, 'json')
+        self.assertRaises(ValueError, codec.get_codec, 'foo')
+
+    def test_parity(self):
+        data = {
+            'objects': [
+                {'comment': body, 'user_name': body, 'flag_count': '3'}
+                for body in bodies],
+            'total': 10,
+            'big': 2 ** 62,
+            'negative': -1.5,
+            'flags': [True, False, None],
+            'nested': {'metadata': {'X-list': [1, 2, 3]}}}
+
+        for json_codec in codec.CODECS.itervalues():
+            encoded = json_codec.dumps(data)
+            self.assertIsInstance(encoded, str, json_codec)
+            self.assertEqual(json.loads(encoded), data, json_codec)
+            self.assertEqual(
+                json_codec.loads(json.dumps(data)), data, json_codec)
+            self.assertEqual(
+                json_codec.loads(encoded), data, json_codec)
+
+    def test_uuids_and_datetimes(self):
+        uuid = UUID('d269f09c4672400da4250342d9d7e1e4')
+        dt = datetime(2015, 5, 1, 12, 30, 15, 123456, tzinfo=pytz.utc)
+        naive_dt = datetime(2015, 5, 1, 12, 30)
+        data = {'uuid': uuid, 'datetimes': [dt, naive_dt, dt.date()]}
+        expected = {
+            'uuid': 'd269f09c4672400da4250342d9d7e1e4',
+            'datetimes': [
+                '2015-05-01T12:30:15.123456+00:00',
+                '2015-05-01T12:30:00',
+                '2015-05-01']}
+
+        for json_codec in codec.CODECS.itervalues():
+            self.assertEqual(
+                json.loads(json_codec.dumps(data)), expected, json_codec)
+            self.assertRaises(TypeError, json_codec.dumps, {'a': object()})
+
+    def test_invalid_json(self):
+        for json_codec in codec.CODECS.itervalues():
+            for body in ('', '{', '{"a": }', 'nope'):
+                self.assertRaises(ValueError, json_codec.loads, body)
+
+
+class CodecViewTestCase(ViewTestCase):
+
+    def test_views(self):
+        # comments can't be empty, and PostgreSQL can't store NUL
+        db_bodies = [body.replace(u'\x00', u'') or u'x' for body in bodies]
+        for body in db_bodies:
+            data = comment_data.copy()
+            del data['uuid']
+            data['comment'] = body
+            self.successResultOf(Comment(self.connection, data).insert())
+
+        responses = []
+        for json_codec in codec.CODECS.itervalues():
+            app.json_codec = json_codec
+            request = self.get('/comments/?limit=100')
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('Content-Length'),
+                [str(len(request.getWrittenData()))])
+            responses.append(json.loads(request.getWrittenData()))
+
+        for response in responses:
+            self.assertEqual(response, responses[0])
+        self.assertEqual(
+            sorted(o['comment'] for o in responses[0]['objects']),
+            sorted(db_bodies))
+
+        # request bodies
+        for json_codec in codec.CODECS.itervalues():
+            app.json_codec = json_codec
+            data = dict(comment_request_data, comment=bodies[1])
+            del data['uuid']
+            request = self.post('/comments/', data)
+            self.assertEqual(request.code, 201)
+            self.assertEqual(
+                json.loads(request.getWrittenData())['comment'], bodies[1])
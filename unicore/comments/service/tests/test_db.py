@@ -1,6 +1,9 @@
 import mock
 
-from unicore.comments.service.tests import BaseTestCase
+from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy import text
+
+from unicore.comments.service.tests import BaseTestCase, mk_config
 from unicore.comments.service import db, app
 
 
@@ -47,3 +50,46 @@ class DBTestCase(BaseTestCase):
         connection.close.assert_called()
 
         patch_connect.stop()
+
+    def test_get_engine(self):
+        config = mk_config(
+            database_pool_size=3,
+            database_max_overflow=2,
+            database_pool_recycle=60)
+        engine = db.get_engine(config, FakeReactorThreads())
+        pool = engine._engine.pool
+        self.assertEqual(pool.size(), 3)
+        self.assertEqual(pool._max_overflow, 2)
+        self.assertEqual(pool._recycle, 60)
+        self.assertEqual(db.get_threadpool_size(config), 5)
+
+        config = mk_config(threadpool_size=20)
+        self.assertEqual(db.get_threadpool_size(config), 20)
+
+    def test_pre_ping(self):
+        # off by default, since it costs a round trip per checkout
+        engine = db.get_engine(mk_config(), FakeReactorThreads())
+        self.assertFalse(engine._engine.pool.dispatch.checkout)
+
+        engine = db.get_engine(
+            mk_config(database_pool_pre_ping=True), FakeReactorThreads())
+        self.assertEqual(
+            list(engine._engine.pool.dispatch.checkout),
+            [db.ping_connection])
+
+    def test_warm_up(self):
+        self.successResultOf(db.warm_up(self.engine, 3))
+        self.assertEqual(self.engine._engine.pool.checkedin(), 3)
+
+    def test_fetchmany(self):
+        # fetchmany relies on these alchimia internals
+        result = self.successResultOf(self.connection.execute(
+            text('SELECT i FROM generate_series(1, 5) AS i')))
+        self.assertTrue(hasattr(result, '_result_proxy'))
+        self.assertTrue(hasattr(result._engine, '_defer_to_thread'))
+
+        chunks = [self.successResultOf(db.fetchmany(result, 2))
+                  for i in range(4)]
+        self.assertEqual(
+            [[row[0] for row in chunk] for chunk in chunks],
+            [[1, 2], [3, 4], [5], []])
@@ -127,3 +127,27 @@ class FilterTestCase(TestCase):
         expression = comment_filters.get_filter_expression(
             query, Comment.__table__.c)
         self.assertEqual(len(expression.clauses), 6)
+
+    def test_indexed_like(self):
+        filters = TestFilters(
+            filter_spec=default_spec, indexed_like=('other', ))
+        self.assertIn('string_like', set(n.name for n in filters))
+        try:
+            filters.deserialize({'string_like': 'foo'})
+            self.fail('Expected colander.Invalid to be raised')
+        except colander.Invalid as e:
+            self.assertIn('not indexed', e.asdict()['string_like'])
+
+        filters = TestFilters(
+            filter_spec=default_spec, indexed_like=('string', ))
+        self.assertEqual(
+            filters.deserialize({'string_like': 'foo'}),
+            {'string_like': 'foo'})
+
+        self.assertEqual(
+            comment_filters.deserialize(
+                {'user_name_like': 'foo', 'content_title_like': 'bar'}),
+            {'user_name_like': 'foo', 'content_title_like': 'bar'})
+        self.assertRaises(
+            colander.Invalid, comment_filters.deserialize,
+            {'content_type_like': 'page'})
@@ -20,7 +20,9 @@ from unicore.comments.service.tests.test_models import (
 def simple_serialize(data):
     for key in data.keys():
         value = data[key]
-        if isinstance(value, bool):
+        if value is None:
+            continue
+        elif isinstance(value, bool):
             data[key] = 'true' if value else 'false'
         elif isinstance(value, int):
             data[key] = str(value)
@@ -41,6 +43,8 @@ streammetadata_data = streammetadata_model_data.copy()
 
 for data in (comment_data, flag_data, banneduser_data, streammetadata_data):
     simple_serialize(data)
+# paths aren't part of the API
+del comment_data['path']
 
 
 class CommentTestCase(TestCase):
@@ -55,7 +59,9 @@ class CommentTestCase(TestCase):
         self.assertIsInstance(clean.pop('submit_datetime'), datetime)
         self.assertEqual(clean.pop('is_removed'), False)
 
-        self.assertEqual(len(clean), len(comment_model_data) - 3)
+        # flag_count, reply_count, parent_uuid (None) and path aren't
+        # deserialized
+        self.assertEqual(len(clean), len(comment_model_data) - 6)
         self.assertDictContainsSubset(clean, comment_model_data)
 
         # check that missing required fields raise an exception
@@ -85,6 +91,14 @@ class CommentTestCase(TestCase):
         for field in fields_with_model_default:
             self.assertNotIn(field, clean)
 
+        # an explicit null only means no parent for parent_uuid
+        clean = schema.deserialize(dict(comment_data, parent_uuid=None))
+        self.assertNotIn('parent_uuid', clean)
+        for field in ('uuid', 'app_uuid'):
+            self.assertRaises(
+                colander.Invalid, schema.deserialize,
+                dict(comment_data, **{field: None}))
+
     def test_serialize(self):
         schema = Comment(include_all=True).bind()
         clean = schema.serialize(comment_model_data)
@@ -0,0 +1,102 @@
+from datetime import date, datetime
+from unittest import TestCase
+
+import colander
+
+from unicore.comments.service.models import Comment as CommentModel
+from unicore.comments.service.schema import (
+    Comment, Flag, BannedUser, StreamMetadata, UUIDType)
+from unicore.comments.service.serializers import compile_serializer
+from unicore.comments.service.tests import BaseTestCase
+from unicore.comments.service.tests.test_models import (
+    comment_data, flag_data, banneduser_data, streammetadata_data)
+
+
+schemas_and_data = (
+    (Comment(include_all=True), comment_data),
+    (Comment(), comment_data),
+    (Flag(), flag_data),
+    (BannedUser(), banneduser_data),
+    (StreamMetadata(), streammetadata_data))
+
+
+class CompileSerializerTestCase(TestCase):
+
+    def assertSameSerialization(self, schema, value):
+        serialize = compile_serializer(schema)
+        try:
+            expected = schema.serialize(value)
+        except colander.Invalid as e:
+            with self.assertRaises(colander.Invalid) as cm:
+                serialize(value)
+            self.assertEqual(cm.exception.asdict(), e.asdict())
+        except Exception as e:
+            self.assertRaises(type(e), serialize, value)
+        else:
+            self.assertEqual(serialize(value), expected)
+
+    def test_schemas(self):
+        for schema in (s for s, _ in schemas_and_data):
+            for bound in (schema, schema.bind()):
+                self.assertNotEqual(
+                    compile_serializer(bound), bound.serialize)
+
+        for schema, data in schemas_and_data:
+            self.assertSameSerialization(schema, data)
+            self.assertSameSerialization(schema.bind(), data)
+
+            # missing and None values, and unknown keys
+            for name in data:
+                partial = data.copy()
+                del partial[name]
+                self.assertSameSerialization(schema, partial)
+                partial[name] = None
+                self.assertSameSerialization(schema, partial)
+            self.assertSameSerialization(schema, dict(data, foo='bar'))
+            self.assertSameSerialization(schema, {})
+
+    def test_values(self):
+        schema = Comment(include_all=True)
+        for name, value in (
+                ('submit_datetime', datetime(2015, 1, 1, 12, 30)),
+                ('submit_datetime', date(2015, 1, 1)),
+                ('submit_datetime', 'not a datetime'),
+                ('flag_count', 3L),
+                ('flag_count', '3'),
+                ('flag_count', 'not a number'),
+                ('is_removed', True),
+                ('is_removed', 0),
+                ('comment', 'bytes'),
+                ('comment', u'\u2603'),
+                ('comment', 42),
+                ('uuid', 'not a uuid')):
+            self.assertSameSerialization(
+                schema, dict(comment_data, **{name: value}))
+
+        for value in (colander.null, None, [], 'string'):
+            self.assertSameSerialization(schema, value)
+
+    def test_uncompilable_schemas(self):
+        schema = colander.SchemaNode(
+            colander.Mapping(unknown='preserve'),
+            colander.SchemaNode(UUIDType(), name='uuid'))
+        self.assertEqual(compile_serializer(schema), schema.serialize)
+
+        schema = StreamMetadata()
+        # metadata has its own serialize method
+        self.assertSameSerialization(schema, dict(
+            streammetadata_data, metadata={'state': 'open', 'X-foo': 1}))
+
+
+class CompileSerializerRowTestCase(BaseTestCase):
+
+    def test_rows(self):
+        obj = CommentModel(self.connection, comment_data)
+        self.successResultOf(obj.insert())
+        query = CommentModel.__table__.select()
+        result = self.successResultOf(self.connection.execute(query))
+        row = self.successResultOf(result.first())
+
+        schema = Comment(include_all=True)
+        self.assertEqual(
+            compile_serializer(schema)(row), schema.serialize(row))
@@ -4,13 +4,23 @@ import pytz
 import uuid
 from unittest import SkipTest
 
+import mock
+
 from sqlalchemy import and_
 from sqlalchemy.inspection import inspect
+from sqlalchemy.schema import CreateTable, DropTable
 from sqlalchemy.sql.expression import exists
+from twisted.internet.defer import Deferred, CancelledError
 
 from unicore.comments.service.models import (
-    Comment, Flag, BannedUser, StreamMetadata)
-from unicore.comments.service.tests import ViewTestCase
+    Comment, Flag, BannedUser, StreamMetadata, CommentCount, FlagCountDelta,
+    MAX_REPLY_DEPTH)
+from unicore.comments.service import app, cache
+from unicore.comments.service.counters import FlagCountAggregator
+from unicore.comments.service.views.flags import fold_flag_counts
+from unicore.comments.service.views import comments as comment_views
+from unicore.comments.service.views.base import ResultProducer
+from unicore.comments.service.tests import ViewTestCase, mk_config
 from unicore.comments.service.tests.test_schema import (
     comment_data, flag_data, banneduser_data, streammetadata_data)
 from unicore.comments.service.schema import (
@@ -133,6 +143,13 @@ class ListTests(object):
         self.assertEqual(data['count'], 5)
         self.assertEqual(len(data['objects']), 5)
 
+        for name, value in (('limit', '0'), ('limit', 'abc'),
+                            ('offset', '-1'), ('offset', 'abc')):
+            request = self.get('%s?%s=%s' % (self.base_url, name, value))
+            self.assertEqual(request.code, 400)
+            self.assertIn(
+                name, json.loads(request.getWrittenData())['error_dict'])
+
     def test_ordering(self):
         sorted_by_date = sorted(
             self.objects, key=lambda o: o.get('submit_datetime'),
@@ -163,12 +180,15 @@ class CommentCRUDTestCase(ViewTestCase, CRUDTests):
         }
         user = BannedUser(self.connection, user_data)
         self.successResultOf(user.insert())
+        # the ban list cache only sees changes made through the API
+        app.banned_user_cache.invalidate()
 
         request = self.post(self.base_url, comment_data)
         self.assertEqual(request.code, 403)
 
         user.set('app_uuid', None)
         self.successResultOf(user.update())
+        app.banned_user_cache.invalidate()
 
         request = self.post(self.base_url, comment_data)
         self.assertEqual(request.code, 403)
@@ -177,6 +197,7 @@ class CommentCRUDTestCase(ViewTestCase, CRUDTests):
         metadata = StreamMetadata(self.connection, streammetadata_data)
         self.successResultOf(metadata.insert())
         self.successResultOf(user.delete())  # remove ban
+        app.banned_user_cache.invalidate()
 
         request = self.post(self.base_url, comment_data)
         self.assertEqual(request.code, 201)
@@ -184,9 +205,348 @@ class CommentCRUDTestCase(ViewTestCase, CRUDTests):
         for state in ('closed', 'disabled'):
             metadata.set('metadata', {'state': state})
             self.successResultOf(metadata.update())
+            app.stream_metadata_cache.invalidate()
             request = self.post(self.base_url, comment_data)
             self.assertEqual(request.code, 403)
 
+    def test_create_without_caches(self):
+        # bans and stream states are then checked by the insert query
+        app.banned_user_cache = cache.BannedUserCache(0, self.clock)
+        app.stream_metadata_cache = cache.StreamMetadataCache(
+            0, 0, self.clock)
+        self.test_create()
+
+        comment_data = self.without_pk_fields(self.instance_data)
+        count = self.get_count(comment_data)
+        request = self.post(self.base_url, dict(
+            comment_data, content_uuid=uuid.uuid4().hex,
+            parent_uuid=uuid.uuid4().hex))
+        self.assertEqual(request.code, 400)
+        self.assertIn(
+            'parent_uuid', json.loads(request.getWrittenData())['error_dict'])
+        self.assertEqual(self.get_count(comment_data), count)
+
+    def get_count(self, data):
+        count = self.successResultOf(CommentCount.get_by_pk(
+            self.connection,
+            app_uuid=data['app_uuid'],
+            content_uuid=data['content_uuid'],
+            moderation_state=data['moderation_state']))
+        return count.get('count') if count else 0
+
+    def test_comment_counts(self):
+        data = self.without_pk_fields(self.instance_data)
+        request = self.post(self.base_url, data)
+        data = json.loads(request.getWrittenData())
+        self.assertEqual(self.get_count(data), 1)
+
+        old_data = data.copy()
+        data['moderation_state'] = 'removed_by_moderator'
+        self.put(self.get_detail_url(data), data)
+        self.assertEqual(self.get_count(old_data), 0)
+        self.assertEqual(self.get_count(data), 1)
+
+        self.delete(self.get_detail_url(data))
+        self.assertEqual(self.get_count(data), 0)
+
+
+class CommentBatchTestCase(ViewTestCase):
+    url = '/comments/batch/'
+
+    def setUp(self):
+        super(CommentBatchTestCase, self).setUp()
+        self.comment_data = comment_data.copy()
+        del self.comment_data['uuid']
+
+    def get_count(self):
+        count = self.successResultOf(CommentCount.get_by_pk(
+            self.connection,
+            app_uuid=self.comment_data['app_uuid'],
+            content_uuid=self.comment_data['content_uuid'],
+            moderation_state=self.comment_data['moderation_state']))
+        return count.get('count') if count else 0
+
+    def test_create(self):
+        banned_user_uuid = uuid.uuid4().hex
+        self.post('/bannedusers/', {'user_uuid': banned_user_uuid})
+        closed_stream_uuid = uuid.uuid4().hex
+        self.put('/streammetadata/%s/%s/' % (
+            self.comment_data['app_uuid'], closed_stream_uuid), {
+            'app_uuid': self.comment_data['app_uuid'],
+            'content_uuid': closed_stream_uuid,
+            'metadata': {'state': 'closed'}})
+
+        items = [
+            self.comment_data,
+            dict(self.comment_data, comment=''),
+            dict(self.comment_data, user_uuid=banned_user_uuid),
+            dict(self.comment_data, content_uuid=closed_stream_uuid),
+            dict(self.comment_data, comment='second')]
+        request = self.post(self.url, items)
+        self.assertEqual(request.code, 200)
+        data = json.loads(request.getWrittenData())
+
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(
+            [o['status'] for o in data['objects']],
+            ['created', 'error', 'error', 'error', 'created'])
+        self.assertEqual(
+            [o.get('error_code') for o in data['objects']],
+            [None, 'BAD_FIELDS', 'USER_BANNED', 'STREAM_NOT_OPEN', None])
+        self.assertIn('comment', data['objects'][1]['error_dict'])
+        self.assertEqual(
+            [data['objects'][i]['object']['comment'] for i in (0, 4)],
+            [self.comment_data['comment'], 'second'])
+
+        for i in (0, 4):
+            self.assertEqual(self.successResultOf(Comment.exists(
+                self.connection,
+                uuid=uuid.UUID(data['objects'][i]['object']['uuid']))), True)
+        self.assertEqual(self.get_count(), 2)
+
+    def test_create_without_caches(self):
+        app.banned_user_cache = cache.BannedUserCache(0, self.clock)
+        app.stream_metadata_cache = cache.StreamMetadataCache(
+            0, 0, self.clock)
+        self.test_create()
+
+    def test_duplicate_uuids(self):
+        existing_uuid = uuid.uuid4().hex
+        self.post('/comments/', dict(self.comment_data, uuid=existing_uuid))
+        new_uuid = uuid.uuid4().hex
+
+        items = [
+            dict(self.comment_data, uuid=new_uuid),
+            dict(self.comment_data, uuid=new_uuid, comment='again'),
+            dict(self.comment_data, uuid=existing_uuid),
+            self.comment_data]
+        request = self.post(self.url, items)
+        self.assertEqual(request.code, 200)
+        data = json.loads(request.getWrittenData())
+
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(
+            [o.get('error_code') for o in data['objects']],
+            [None, 'DUPLICATE_UUID', 'DUPLICATE_UUID', None])
+        self.assertEqual(
+            data['objects'][0]['object']['comment'],
+            self.comment_data['comment'])
+        self.assertEqual(self.get_count(), 3)
+
+    def test_bad_requests(self):
+        request = self.post(self.url, self.comment_data)
+        self.assertEqual(request.code, 400)
+        self.assertEqual(
+            json.loads(request.getWrittenData())['error_code'], 'NOT_LIST')
+
+        request = self.post(self.url, [self.comment_data] * 1001)
+        self.assertEqual(request.code, 400)
+        self.assertEqual(
+            json.loads(request.getWrittenData())['error_code'],
+            'BATCH_TOO_LARGE')
+
+        request = self.post(self.url, [])
+        self.assertEqual(
+            json.loads(request.getWrittenData()),
+            {'count': 0, 'created': 0, 'objects': []})
+
+
+class CommentReplyTestCase(ViewTestCase):
+
+    def setUp(self):
+        super(CommentReplyTestCase, self).setUp()
+        self.comment_data = comment_data.copy()
+        del self.comment_data['uuid']
+        self.now = datetime.now(pytz.utc)
+        self.root = self.create()
+
+    def create(self, parent=None, minutes=0, **kwargs):
+        data = dict(
+            self.comment_data,
+            submit_datetime=(
+                self.now + timedelta(minutes=minutes)).isoformat(),
+            **kwargs)
+        if parent is not None:
+            data['parent_uuid'] = parent['uuid']
+        request = self.post('/comments/', data)
+        self.assertEqual(request.code, 201)
+        return json.loads(request.getWrittenData())
+
+    def get_comment(self, comment):
+        return self.successResultOf(Comment.get_by_pk(
+            self.connection, uuid=uuid.UUID(comment['uuid'])))
+
+    def get_count(self):
+        return self.successResultOf(CommentCount.get_by_pk(
+            self.connection,
+            app_uuid=self.comment_data['app_uuid'],
+            content_uuid=self.comment_data['content_uuid'],
+            moderation_state=self.comment_data['moderation_state']))
+
+    def test_create(self):
+        version = self.get_count().get('version')
+        reply = self.create(self.root, minutes=1)
+        self.assertEqual(reply['parent_uuid'], self.root['uuid'])
+        self.assertEqual(reply['reply_count'], '0')
+        self.create(self.root, minutes=2)
+        self.create(reply, minutes=3)
+
+        self.assertEqual(self.get_comment(self.root).get('reply_count'), 2)
+        self.assertEqual(self.get_comment(reply).get('reply_count'), 1)
+        self.assertEqual(self.get_comment(reply).get('path'), '.'.join(
+            self.get_comment(c).get('path').split('.')[-1]
+            for c in (self.root, reply)))
+        count = self.get_count()
+        self.assertEqual(count.get('count'), 4)
+        self.assertEqual(count.get('version'), version + 3)
+
+        # parents must exist in the same stream
+        for parent_uuid in (uuid.uuid4().hex, self.root['uuid']):
+            request = self.post('/comments/', dict(
+                self.comment_data, parent_uuid=parent_uuid,
+                content_uuid=(
+                    self.comment_data['content_uuid']
+                    if parent_uuid != self.root['uuid']
+                    else uuid.uuid4().hex)))
+            self.assertEqual(request.code, 400)
+            self.assertIn(
+                'parent_uuid',
+                json.loads(request.getWrittenData())['error_dict'])
+        self.assertEqual(self.get_count().get('count'), 4)
+
+    def test_batch(self):
+        items = [
+            dict(self.comment_data, parent_uuid=self.root['uuid']),
+            dict(self.comment_data, parent_uuid=self.root['uuid']),
+            dict(self.comment_data, parent_uuid=uuid.uuid4().hex),
+            dict(self.comment_data)]
+        request = self.post('/comments/batch/', items)
+        data = json.loads(request.getWrittenData())
+        self.assertEqual(
+            [o['status'] for o in data['objects']],
+            ['created', 'created', 'error', 'created'])
+        self.assertIn('parent_uuid', data['objects'][2]['error_dict'])
+        self.assertEqual(
+            data['objects'][0]['object']['parent_uuid'], self.root['uuid'])
+        self.assertEqual(
+            data['objects'][3]['object']['parent_uuid'], None)
+        self.assertEqual(self.get_comment(self.root).get('reply_count'), 2)
+        self.assertEqual(self.get_count().get('count'), 4)
+
+    def test_max_depth(self):
+        parent = self.root
+        for depth in range(MAX_REPLY_DEPTH):
+            parent = self.create(parent, minutes=depth + 1)
+        self.assertEqual(
+            Comment.get_depth(self.get_comment(parent).get('path')),
+            MAX_REPLY_DEPTH)
+
+        request = self.post('/comments/', dict(
+            self.comment_data, parent_uuid=parent['uuid']))
+        self.assertEqual(request.code, 400)
+        self.assertIn(
+            'parent_uuid', json.loads(request.getWrittenData())['error_dict'])
+
+        request = self.post('/comments/batch/', [dict(
+            self.comment_data, parent_uuid=parent['uuid'])])
+        data = json.loads(request.getWrittenData())
+        self.assertEqual(data['created'], 0)
+        self.assertEqual(data['objects'][0]['error_code'], 'BAD_FIELDS')
+        self.assertIn('parent_uuid', data['objects'][0]['error_dict'])
+        self.assertEqual(self.get_comment(parent).get('reply_count'), 0)
+        self.assertEqual(self.get_count().get('count'), MAX_REPLY_DEPTH + 1)
+
+    def test_replies_after_update(self):
+        url = '/comments/%s/replies/' % self.root['uuid']
+        replies = [self.create(self.root, minutes=i + 1) for i in range(3)]
+        # paths, and so the order of replies, don't change with
+        # submit_datetime
+        request = self.put('/comments/%s/' % replies[0]['uuid'], dict(
+            self.comment_data, parent_uuid=self.root['uuid'],
+            submit_datetime=(self.now + timedelta(minutes=10)).isoformat()))
+        self.assertEqual(request.code, 200)
+
+        uuids = []
+        data = self.get_json(url + '?limit=1')
+        while True:
+            uuids.extend(o['uuid'] for o in data['objects'])
+            if data['next_cursor'] is None:
+                break
+            data = self.get_json(
+                url + '?limit=1&cursor=%s' % data['next_cursor'])
+        self.assertEqual(uuids, [r['uuid'] for r in replies])
+
+    def test_update_and_delete(self):
+        reply = self.create(self.root, minutes=1)
+        url = '/comments/%s/' % reply['uuid']
+        data = dict(self.comment_data, parent_uuid=self.root['uuid'])
+
+        request = self.put(url, dict(data, comment=u'edited'))
+        self.assertEqual(request.code, 200)
+        request = self.put(url, dict(data, parent_uuid=uuid.uuid4().hex))
+        self.assertEqual(request.code, 400)
+        self.assertEqual(self.get_comment(reply).get('parent_uuid').hex,
+                         self.root['uuid'])
+
+        version = self.get_count().get('version')
+        request = self.delete(url)
+        self.assertEqual(request.code, 200)
+        self.assertEqual(self.get_comment(self.root).get('reply_count'), 0)
+        count = self.get_count()
+        self.assertEqual(count.get('count'), 1)
+        self.assertEqual(count.get('version'), version + 1)
+
+    def test_replies(self):
+        url = '/comments/%s/replies/' % self.root['uuid']
+        first = self.create(self.root, minutes=2)
+        second = self.create(self.root, minutes=1)
+        first_reply = self.create(first, minutes=3)
+        nested_reply = self.create(first_reply, minutes=4)
+        # comments outside the subtree aren't included
+        other = self.create(minutes=5)
+        self.create(other, minutes=6)
+
+        data = self.get_json(url)
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['next_cursor'], None)
+        self.assertEqual(
+            [o['uuid'] for o in data['objects']],
+            [second['uuid'], first['uuid'], first_reply['uuid'],
+             nested_reply['uuid']])
+
+        # pages are made up of whole threads
+        data = self.get_json(url + '?limit=1')
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(
+            [o['uuid'] for o in data['objects']], [second['uuid']])
+        data = self.get_json(url + '?limit=1&cursor=%s' % data['next_cursor'])
+        self.assertEqual(
+            [o['uuid'] for o in data['objects']],
+            [first['uuid'], first_reply['uuid'], nested_reply['uuid']])
+        data = self.get_json(url + '?limit=1&cursor=%s' % data['next_cursor'])
+        self.assertEqual(data['count'], 0)
+        self.assertEqual(data['objects'], [])
+        self.assertEqual(data['next_cursor'], None)
+
+        self.assertEqual(self.get_json(
+            '/comments/%s/replies/' % nested_reply['uuid'])['objects'], [])
+        request = self.get('/comments/%s/replies/' % uuid.uuid4().hex)
+        self.assertEqual(request.code, 404)
+        request = self.get(url + '?cursor=foo')
+        self.assertEqual(request.code, 400)
+        for limit in ('0', '-1', 'abc'):
+            request = self.get(url + '?limit=%s' % limit)
+            self.assertEqual(request.code, 400)
+            self.assertIn(
+                'limit', json.loads(request.getWrittenData())['error_dict'])
+
+        # replies can be filtered on in comment listings
+        data = self.get_json('/comments/?parent_uuid=%s' % first['uuid'])
+        self.assertEqual(
+            [o['uuid'] for o in data['objects']], [first_reply['uuid']])
+
 
 class FlagCRUDTestCase(ViewTestCase, CRUDTests):
     base_url = '/flags/'
@@ -209,12 +569,23 @@ class FlagCRUDTestCase(ViewTestCase, CRUDTests):
             self.connection, uuid=self.comment.get('uuid')))
         self.assertEqual(comment.get('flag_count'), 1)
 
+        count_key = dict(
+            (name, comment.get(name))
+            for name in ('app_uuid', 'content_uuid', 'moderation_state'))
+        # flags that don't remove the comment don't touch its count
+        self.assertIsNone(self.successResultOf(
+            CommentCount.get_by_pk(self.connection, **count_key)))
+
         # check that inserting duplicate fails
         request = self.post(self.base_url, self.instance_data)
         comment = self.successResultOf(Comment.get_by_pk(
             self.connection, uuid=self.comment.get('uuid')))
         self.assertEqual(request.code, 200)
         self.assertEqual(comment.get('flag_count'), 1)
+        self.assertEqual(
+            json.loads(request.getWrittenData()), self.instance_data)
+        self.assertIsNone(self.successResultOf(
+            CommentCount.get_by_pk(self.connection, **count_key)))
 
         # check that inserting flag without existing comment fails
         data = self.instance_data.copy()
@@ -230,6 +601,162 @@ class FlagCRUDTestCase(ViewTestCase, CRUDTests):
             self.connection, uuid=self.comment.get('uuid')))
         self.assertEqual(comment.get('flag_count'), -1)
 
+    def test_community_moderation(self):
+        comment_uuid = self.comment.get('uuid')
+        key = dict(
+            app_uuid=self.comment.get('app_uuid'),
+            content_uuid=self.comment.get('content_uuid'))
+
+        def flag():
+            request = self.post(self.base_url, dict(
+                self.instance_data, user_uuid=uuid.uuid4().hex))
+            self.assertEqual(request.code, 201)
+            return self.successResultOf(
+                Comment.get_by_pk(self.connection, uuid=comment_uuid))
+
+        def get_count(moderation_state):
+            count = self.successResultOf(CommentCount.get_by_pk(
+                self.connection, moderation_state=moderation_state, **key))
+            return count.get('count') if count else 0
+
+        # no threshold
+        self.assertEqual(flag().get('moderation_state'), 'visible')
+
+        request = self.put(
+            '/streammetadata/%s/%s/' % (
+                key['app_uuid'].hex, key['content_uuid'].hex),
+            {'app_uuid': key['app_uuid'].hex,
+             'content_uuid': key['content_uuid'].hex,
+             'metadata': {'flag_threshold': 0}})
+        self.assertEqual(request.code, 400)
+        request = self.put(
+            '/streammetadata/%s/%s/' % (
+                key['app_uuid'].hex, key['content_uuid'].hex),
+            {'app_uuid': key['app_uuid'].hex,
+             'content_uuid': key['content_uuid'].hex,
+             'metadata': {'flag_threshold': 3}})
+        self.assertEqual(request.code, 200)
+
+        self.assertEqual(flag().get('moderation_state'), 'visible')
+        self.assertEqual(get_count('removed_by_community'), 0)
+        comment = flag()
+        self.assertEqual(comment.get('flag_count'), 3)
+        self.assertEqual(
+            comment.get('moderation_state'), 'removed_by_community')
+        self.assertEqual(get_count('visible'), -1)
+        self.assertEqual(get_count('removed_by_community'), 1)
+        comment = flag()
+        self.assertEqual(
+            comment.get('moderation_state'), 'removed_by_community')
+        self.assertEqual(get_count('removed_by_community'), 1)
+
+        # the config threshold applies to streams without one, and
+        # comments that were moderated aren't changed
+        other = Comment(self.connection, dict(
+            comment_data, uuid=uuid.uuid4(), content_uuid=uuid.uuid4(),
+            moderation_state='removed_by_moderator'))
+        self.successResultOf(other.insert())
+        self.comment = other
+        comment_uuid = other.get('uuid')
+        self.instance_data = dict(
+            self.instance_data, comment_uuid=comment_uuid.hex)
+        app.config = mk_config(community_moderation_threshold=1)
+        self.assertEqual(
+            flag().get('moderation_state'), 'removed_by_moderator')
+
+        other.set('moderation_state', 'visible')
+        self.successResultOf(other.update())
+        self.assertEqual(
+            flag().get('moderation_state'), 'removed_by_community')
+
+
+class DeferredFlagCountTestCase(ViewTestCase):
+
+    def setUp(self):
+        super(DeferredFlagCountTestCase, self).setUp()
+        app.config = mk_config(
+            flag_count_interval=10, community_moderation_threshold=3)
+        self.aggregator = FlagCountAggregator(10, self.clock)
+        app.flag_count_aggregator = self.aggregator
+        self.aggregator.start()
+        self.addCleanup(self.aggregator.stop)
+
+        self.comment = Comment(self.connection, comment_data)
+        self.successResultOf(self.comment.insert())
+        self.successResultOf(CommentCount.increment(
+            self.connection, *[self.comment.get(name) for name in (
+                'app_uuid', 'content_uuid', 'moderation_state')]))
+        self.user_uuids = [uuid.uuid4().hex for i in range(4)]
+
+    def get_comment(self):
+        return self.successResultOf(Comment.get_by_pk(
+            self.connection, uuid=self.comment.get('uuid')))
+
+    def get_deltas(self):
+        query = FlagCountDelta.__table__.select()
+        result = self.successResultOf(self.connection.execute(query))
+        return self.successResultOf(result.fetchall())
+
+    def test_flag_counts(self):
+        for user_uuid in self.user_uuids:
+            request = self.post('/flags/', dict(
+                flag_data, user_uuid=user_uuid))
+            self.assertEqual(request.code, 201)
+        request = self.post('/flags/', dict(
+            flag_data, user_uuid=self.user_uuids[0]))
+        self.assertEqual(request.code, 200)
+        request = self.delete('/flags/%s/%s/' % (
+            flag_data['comment_uuid'], self.user_uuids[0]))
+        self.assertEqual(request.code, 200)
+
+        # nothing is applied until the aggregator runs
+        self.assertEqual(len(self.get_deltas()), 5)
+        self.assertEqual(self.get_comment().get('flag_count'), 0)
+        data = self.get_json('/comments/?flag_count_gte=1')
+        self.assertEqual(data['count'], 0)
+        count = self.successResultOf(CommentCount.get_by_pk(
+            self.connection, app_uuid=self.comment.get('app_uuid'),
+            content_uuid=self.comment.get('content_uuid'),
+            moderation_state=u'visible'))
+
+        self.clock.advance(10)
+        self.assertEqual(self.get_deltas(), [])
+        comment = self.get_comment()
+        self.assertEqual(comment.get('flag_count'), 3)
+        self.assertEqual(
+            comment.get('moderation_state'), 'removed_by_community')
+        data = self.get_json('/comments/?flag_count_gte=3')
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(self.get_json('/stats/')['flag_counts'], {
+            'interval': 10,
+            'folded': 5})
+        new_count = self.successResultOf(CommentCount.get_by_pk(
+            self.connection, app_uuid=self.comment.get('app_uuid'),
+            content_uuid=self.comment.get('content_uuid'),
+            moderation_state=u'visible'))
+        self.assertEqual(new_count.get('count'), count.get('count') - 1)
+        self.assertGreater(new_count.get('version'), count.get('version'))
+
+    def test_batches(self):
+        for user_uuid in self.user_uuids:
+            self.post('/flags/', dict(flag_data, user_uuid=user_uuid))
+        folded = self.successResultOf(
+            fold_flag_counts(self.connection, batch_size=3))
+        self.assertEqual(folded, 4)
+        self.assertEqual(self.get_comment().get('flag_count'), 4)
+        self.assertEqual(
+            self.successResultOf(fold_flag_counts(self.connection)), 0)
+
+    def test_errors(self):
+        self.successResultOf(self.connection.execute(
+            DropTable(FlagCountDelta.__table__)))
+        self.clock.advance(10)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertTrue(self.aggregator.call.running)
+        self.successResultOf(self.connection.execute(
+            CreateTable(FlagCountDelta.__table__)))
+
 
 class BannedUserCRUDTestCase(ViewTestCase, CRUDTests):
     base_url = '/bannedusers/'
@@ -263,6 +790,7 @@ class StreamMetadataCRUDTestCase(ViewTestCase, CRUDTests):
 
         obj = self.model_class(self.connection, self.instance_data)
         self.successResultOf(obj.insert())
+        app.stream_metadata_cache.invalidate()
         request = self.get(self.get_detail_url(self.instance_data))
 
         self.assertEqual(request.code, 200)
@@ -270,6 +798,21 @@ class StreamMetadataCRUDTestCase(ViewTestCase, CRUDTests):
             self.schema.deserialize(self.instance_data),
             self.schema.deserialize(json.loads(request.getWrittenData())))
 
+    def test_etag(self):
+        url = self.get_detail_url(self.instance_data)
+        request = self.get(url)
+        etag = request.responseHeaders.getRawHeaders('ETag')[0]
+
+        request = self.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(request.code, 304)
+        self.assertEqual(request.getWrittenData(), '')
+
+        self.put(url, self.instance_data)
+        request = self.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(request.code, 200)
+        self.assertNotEqual(
+            request.responseHeaders.getRawHeaders('ETag')[0], etag)
+
     def test_update(self):
         data = self.instance_data.copy()
         request = self.put(self.get_detail_url(data), data)
@@ -290,6 +833,7 @@ class StreamMetadataCRUDTestCase(ViewTestCase, CRUDTests):
 
 class CommentListTestCase(ViewTestCase, ListTests):
     base_url = '/comments/'
+    schema = CommentSchema(include_all=True).bind()
 
     def setUp(self):
         super(CommentListTestCase, self).setUp()
@@ -301,6 +845,9 @@ class CommentListTestCase(ViewTestCase, ListTests):
                 datetime.now(pytz.utc) + timedelta(hours=i))
             obj = Comment(self.connection, data)
             self.successResultOf(obj.insert())
+            self.successResultOf(CommentCount.increment(
+                self.connection, data['app_uuid'], data['content_uuid'],
+                data['moderation_state']))
             self.objects.append(obj)
 
     def test_before_after(self):
@@ -333,6 +880,77 @@ class CommentListTestCase(ViewTestCase, ListTests):
             self.successResultOf(obj.update())
         check_before_and_after(objects_sorted)
 
+    def test_cursor_pagination(self):
+        objects_sorted = sorted(
+            self.objects,
+            key=lambda o: (o.get('submit_datetime'), o.get('uuid').hex),
+            reverse=True)
+
+        uuids = []
+        data = self.get_json('/comments/?cursor=&limit=4')
+        while True:
+            self.assertEqual(data['total'], 10)
+            self.assertEqual(data['count'], len(data['objects']))
+            self.assertNotIn('start', data)
+            uuids.extend(o['uuid'] for o in data['objects'])
+            if data['next_cursor'] is None:
+                break
+            data = self.get_json('/comments/?cursor=%s&limit=4' % (
+                data['next_cursor'], ))
+
+        self.assertEqual(
+            [o.get('uuid').hex for o in objects_sorted], uuids)
+
+        # cursor with identical submit_datetimes
+        dt = datetime.now(pytz.utc)
+        for obj in self.objects:
+            obj.set('submit_datetime', dt)
+            self.successResultOf(obj.update())
+        data = self.get_json('/comments/?cursor=&limit=5')
+        data_next = self.get_json('/comments/?cursor=%s&limit=5' % (
+            data['next_cursor'], ))
+        self.assertEqual(
+            sorted([o.get('uuid').hex for o in self.objects], reverse=True),
+            [o['uuid'] for o in data['objects'] + data_next['objects']])
+
+        # tampered cursor
+        request = self.get('/comments/?cursor=%s' % (
+            data['next_cursor'][:-2], ))
+        self.assertEqual(request.code, 400)
+        self.assertEqual(
+            json.loads(request.getWrittenData())['error_code'], 'BAD_CURSOR')
+
+        for limit in ('-1', 'abc'):
+            request = self.get('/comments/?cursor=&limit=%s' % limit)
+            self.assertEqual(request.code, 400)
+            self.assertIn(
+                'limit', json.loads(request.getWrittenData())['error_dict'])
+
+    def test_totals(self):
+        app_uuid = self.objects[0].get('app_uuid').hex
+        # read from comment_counts
+        self.successResultOf(self.connection.execute(
+            Comment.__table__.delete().where(
+                Comment.__table__.c.uuid == self.objects[0].get('uuid'))))
+        for url in ('/comments/',
+                    '/comments/?total=exact&app_uuid=%s' % app_uuid,
+                    '/comments/?total=estimate&moderation_state_in=visible'):
+            data = self.get_json(url)
+            self.assertEqual(data['total'], 10)
+
+        # not answerable by comment_counts
+        data = self.get_json('/comments/?user_name=foo')
+        self.assertEqual(data['total'], 9)
+        data = self.get_json('/comments/?total=estimate&user_name=foo')
+        self.assertIsInstance(data['total'], int)
+
+        data = self.get_json('/comments/?total=none')
+        self.assertEqual(data['total'], None)
+        self.assertEqual(data['count'], 9)
+
+        request = self.get('/comments/?total=foo')
+        self.assertEqual(request.code, 400)
+
     def test_metadata(self):
         app_uuid = self.objects[0].get('app_uuid').hex
         content_uuid = self.objects[0].get('content_uuid').hex
@@ -348,11 +966,375 @@ class CommentListTestCase(ViewTestCase, ListTests):
 
         metadata = StreamMetadata(self.connection, streammetadata_data)
         self.successResultOf(metadata.insert())
+        app.stream_metadata_cache.invalidate()
 
         data = self.get_json('/comments/?app_uuid=%s&content_uuid=%s' % (
             app_uuid, content_uuid))
         self.assertIn('metadata', data)
         self.assertEqual(data['metadata'], metadata.get('metadata'))
+        self.assertEqual(data['stream_metadata'], {
+            app_uuid: {content_uuid: metadata.get('metadata')}})
+
+        # metadata of several streams is keyed by stream
+        other_uuid = uuid.uuid4().hex
+        data = self.get_json('/comments/?app_uuid=%s&content_uuid_in=%s,%s' % (
+            app_uuid, content_uuid, other_uuid))
+        self.assertEqual(data['metadata'], {})
+        self.assertEqual(data['stream_metadata'], {
+            app_uuid: {
+                content_uuid: metadata.get('metadata'),
+                other_uuid: {}}})
+        self.assertEqual(self.get_json('/comments/')['stream_metadata'], {})
+
+        # metadata isn't read for listings of too many streams
+        data = self.get_json('/comments/?app_uuid=%s&content_uuid_in=%s' % (
+            app_uuid, ','.join(
+                [content_uuid] + [uuid.uuid4().hex for i in range(100)])))
+        self.assertEqual(data['count'], self.get_json(
+            '/comments/?app_uuid=%s&content_uuid=%s' % (
+                app_uuid, content_uuid))['count'])
+        self.assertEqual(data['metadata'], {})
+        self.assertNotIn('stream_metadata', data)
+
+    def test_etag(self):
+        comment = self.objects[0]
+        app_uuid = comment.get('app_uuid').hex
+        urls = ('/comments/?app_uuid=%s' % app_uuid,
+                '/comments/?app_uuid=%s&content_uuid=%s' % (
+                    app_uuid, comment.get('content_uuid').hex),
+                '/comments/?cursor=&moderation_state=visible&'
+                'app_uuid_in=%s' % app_uuid)
+
+        # unscoped listings would need the version of every stream
+        for url in ('/comments/', '/comments/?moderation_state=visible'):
+            request = self.get(url)
+            self.assertEqual(request.code, 200)
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('ETag'), None)
+
+        def get_etags():
+            return [self.get(url).responseHeaders.getRawHeaders('ETag')[0]
+                    for url in urls]
+
+        def assertNotModified(etags):
+            for url, etag in zip(urls, etags):
+                request = self.get(url, headers={
+                    'If-None-Match': 'W/"foo", %s' % etag})
+                self.assertEqual(request.code, 304)
+                self.assertEqual(request.getWrittenData(), '')
+
+        etags = get_etags()
+        assertNotModified(etags)
+
+        # flags only change the ETag when they remove a comment
+        flagged_uuid = self.objects[2].get('uuid').hex
+        request = self.post('/flags/', dict(
+            flag_data, comment_uuid=flagged_uuid))
+        self.assertEqual(request.code, 201)
+        self.assertEqual(get_etags(), etags)
+        app.config = mk_config(community_moderation_threshold=2)
+        request = self.post('/flags/', dict(
+            flag_data, comment_uuid=flagged_uuid,
+            user_uuid=uuid.uuid4().hex))
+        self.assertEqual(request.code, 201)
+        new_etags = get_etags()
+        for etag, new_etag in zip(etags, new_etags):
+            self.assertNotEqual(etag, new_etag)
+        etags = new_etags
+
+        # comments changed through the API change the ETag
+        for method, path, body in (
+                ('PUT', '/comments/%s/' % comment.get('uuid').hex, dict(
+                    self.schema.serialize(comment.to_dict()),
+                    comment='edited')),
+                ('DELETE', '/comments/%s/' % (
+                    self.objects[1].get('uuid').hex, ), None)):
+            request = self.request(method, path, body=body)
+            self.assertIn(request.code, (200, 201))
+            new_etags = get_etags()
+            for etag, new_etag in zip(etags, new_etags):
+                self.assertNotEqual(etag, new_etag)
+            assertNotModified(new_etags)
+            etags = new_etags
+
+        # so does stream metadata
+        metadata = StreamMetadata(self.connection, streammetadata_data)
+        self.successResultOf(metadata.insert())
+        app.stream_metadata_cache.invalidate()
+        self.assertNotEqual(get_etags()[1], etags[1])
+
+    def test_export(self):
+
+        def export(url):
+            request = self.get(url)
+            self.assertEqual(request.code, 200)
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('Content-Type'),
+                ['application/x-ndjson'])
+            lines = request.getWrittenData().split('\n')
+            self.assertEqual(lines.pop(), '')
+            return [json.loads(line) for line in lines]
+
+        expected = sorted(
+            self.schema.serialize(obj.to_dict()) for obj in self.objects)
+        with mock.patch.object(comment_views, 'EXPORT_CHUNK_SIZE', 3):
+            self.assertEqual(
+                sorted(export('/comments/export/')), expected)
+        self.assertEqual(sorted(export('/comments/export/')), expected)
+
+        comment = self.objects[0]
+        data = export('/comments/export/?uuid=%s&app_uuid=%s' % (
+            comment.get('uuid').hex, comment.get('app_uuid').hex))
+        self.assertEqual(data, [self.schema.serialize(comment.to_dict())])
+        self.assertEqual(
+            export('/comments/export/?app_uuid=%s' % uuid.uuid4().hex), [])
+
+        request = self.get('/comments/export/?submit_datetime_gt=foo')
+        self.assertEqual(request.code, 400)
+
+    def test_search(self):
+        data = comment_data.copy()
+        for comment, locale, hours in (
+                (u'The dog was running', u'eng_ZA', 1),
+                (u'Dogs run, dogs run fast', u'eng_GB', 2),
+                (u'Les chiens courent', u'fra_FR', 3),
+                (u'Mbwa anakimbia, dog', u'swa_KE', 4)):
+            data.update(
+                uuid=uuid.uuid4(), comment=comment, locale=locale,
+                submit_datetime=datetime.now(pytz.utc) - timedelta(
+                    hours=hours))
+            self.successResultOf(Comment(self.connection, data).insert())
+
+        def search(query):
+            data = self.get_json('/comments/?%s' % query)
+            return [o['comment'] for o in data['objects']], data['total']
+
+        # stemmed in the comment's language, ranked by relevance
+        self.assertEqual(search('q=runs+dogs'), (
+            [u'Dogs run, dogs run fast', u'The dog was running'], 2))
+        self.assertEqual(search('q=chien'), ([u'Les chiens courent'], 1))
+        self.assertEqual(search('q=dog'), ([
+            u'Dogs run, dogs run fast', u'The dog was running',
+            u'Mbwa anakimbia, dog'], 3))
+        self.assertEqual(search('q=cat'), ([], 0))
+
+        # with other filters and pagination
+        app_uuid = comment_data['app_uuid']
+        self.assertEqual(
+            search('q=dog&app_uuid=%s' % uuid.uuid4().hex), ([], 0))
+        self.assertEqual(
+            search('q=dog&app_uuid=%s&limit=1&offset=1' % app_uuid),
+            ([u'The dog was running'], 3))
+        self.assertEqual(search('q=dog&cursor=&limit=2'), ([
+            u'The dog was running', u'Dogs run, dogs run fast'], 3))
+
+        lines = self.get('/comments/export/?q=chien').getWrittenData()
+        self.assertEqual(
+            [json.loads(line)['comment'] for line in lines.splitlines()],
+            [u'Les chiens courent'])
+
+        request = self.get('/comments/?q=%s' % ('x' * 3001))
+        self.assertEqual(request.code, 400)
+
+    def test_streams(self):
+        app_uuid = self.objects[0].get('app_uuid')
+        content_uuids = [
+            self.objects[0].get('content_uuid'), uuid.uuid4(), uuid.uuid4()]
+        for i in range(2):
+            data = dict(self.objects[0].to_dict(),
+                        uuid=uuid.uuid4(), content_uuid=content_uuids[1])
+            del data['path']
+            self.successResultOf(Comment(self.connection, data).insert())
+            self.successResultOf(CommentCount.increment(
+                self.connection, app_uuid, content_uuids[1], u'visible'))
+        metadata = StreamMetadata(self.connection, dict(
+            streammetadata_data, content_uuid=content_uuids[1]))
+        self.successResultOf(metadata.insert())
+        app.stream_metadata_cache.invalidate()
+
+        url = '/comments/streams/?app_uuid=%s&content_uuid_in=%s' % (
+            app_uuid.hex, ','.join(c.hex for c in content_uuids))
+        data = self.get_json(url + '&per_stream_limit=3&total=exact')
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(data['per_stream_limit'], 3)
+        streams = dict((o['content_uuid'], o) for o in data['objects'])
+        self.assertEqual(
+            sorted(streams), sorted(c.hex for c in content_uuids))
+
+        stream = streams[content_uuids[0].hex]
+        objects_sorted = sorted(
+            self.objects,
+            key=lambda o: (o.get('submit_datetime'), o.get('uuid').hex),
+            reverse=True)
+        self.assertEqual(
+            [o['uuid'] for o in stream['objects']],
+            [o.get('uuid').hex for o in objects_sorted[:3]])
+        self.assertEqual(
+            (stream['count'], stream['total'], stream['metadata']),
+            (3, 10, {}))
+        stream = streams[content_uuids[1].hex]
+        self.assertEqual(
+            (stream['count'], stream['total'], stream['metadata']),
+            (2, 2, metadata.get('metadata')))
+        stream = streams[content_uuids[2].hex]
+        self.assertEqual(
+            (stream['count'], stream['total'], stream['objects']),
+            (0, 0, []))
+
+        # totals that can't be read from comment_counts
+        data = self.get_json(url + '&user_name=foo&total=exact')
+        self.assertEqual(
+            sorted(o['total'] for o in data['objects']), [0, 2, 10])
+        data = self.get_json(url + '&user_name=bar')
+        self.assertEqual(
+            [(o['count'], o['total']) for o in data['objects']],
+            [(0, None)] * 3)
+
+        request = self.get(url)
+        etag = request.responseHeaders.getRawHeaders('ETag')[0]
+        request = self.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(request.code, 304)
+
+        for limit in ('0', '-1', 'abc'):
+            request = self.get(url + '&per_stream_limit=%s' % limit)
+            self.assertEqual(request.code, 400)
+            self.assertIn(
+                'per_stream_limit',
+                json.loads(request.getWrittenData())['error_dict'])
+
+        for url in ('/comments/streams/',
+                    '/comments/streams/?app_uuid=%s' % app_uuid.hex,
+                    '/comments/streams/?app_uuid=%s&content_uuid_in=%s' % (
+                        app_uuid.hex,
+                        ','.join(uuid.uuid4().hex for i in range(101)))):
+            request = self.get(url)
+            self.assertEqual(request.code, 400)
+
+    def test_moderate(self):
+        comment = self.objects[0]
+        key = dict(
+            app_uuid=comment.get('app_uuid'),
+            content_uuid=comment.get('content_uuid'))
+
+        def get_count(moderation_state):
+            count = self.successResultOf(CommentCount.get_by_pk(
+                self.connection, moderation_state=moderation_state, **key))
+            return count.get('count') if count else 0
+
+        # flag some comments
+        for obj in self.objects[:3]:
+            obj.set('flag_count', 2)
+            self.successResultOf(obj.update())
+        body = {'moderation_state': 'removed_by_moderator',
+                'is_removed': True}
+        url = '/comments/?content_uuid=%s&flag_count_gte=1' % (
+            key['content_uuid'].hex, )
+
+        request = self.put(url + '&dry_run=true', body)
+        self.assertEqual(request.code, 200)
+        data = json.loads(request.getWrittenData())
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(get_count('visible'), 10)
+
+        request = self.put(url, body)
+        self.assertEqual(request.code, 200)
+        data = json.loads(request.getWrittenData())
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(
+            sorted(data['uuids']),
+            sorted(o.get('uuid').hex for o in self.objects[:3]))
+        self.assertEqual(get_count('visible'), 7)
+        self.assertEqual(get_count('removed_by_moderator'), 3)
+        for obj in self.objects[:3]:
+            obj = self.successResultOf(
+                Comment.get_by_pk(self.connection, uuid=obj.get('uuid')))
+            self.assertEqual(obj.get('moderation_state'),
+                             'removed_by_moderator')
+            self.assertTrue(obj.get('is_removed'))
+
+        # an explicit list of comments
+        request = self.put('/comments/?uuid_in=%s,%s' % (
+            self.objects[0].get('uuid').hex, self.objects[5].get('uuid').hex),
+            {'moderation_state': 'visible'})
+        self.assertEqual(json.loads(request.getWrittenData())['count'], 2)
+        self.assertEqual(get_count('visible'), 8)
+        self.assertEqual(get_count('removed_by_moderator'), 2)
+
+        # bad requests
+        for url, body in (('/comments/', {'is_removed': True}),
+                          (url, {}),
+                          (url, {'moderation_state': 'foo'})):
+            request = self.put(url, body)
+            self.assertEqual(request.code, 400)
+
+
+class ResultProducerTestCase(ViewTestCase):
+
+    def setUp(self):
+        super(ResultProducerTestCase, self).setUp()
+        self.fetches = []
+        patcher = mock.patch(
+            'unicore.comments.service.db.fetchmany',
+            new=lambda result, size: self.fetches.append(Deferred()) or
+            self.fetches[-1])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.request = mock.Mock()
+        self.producer = ResultProducer(
+            self.request, None, lambda row: row, 2)
+
+    def test_backpressure(self):
+        d = self.producer.start()
+        self.request.registerProducer.assert_called_with(
+            self.producer, True)
+        self.assertEqual(len(self.fetches), 1)
+
+        # the producer is paused while the chunk is written
+        self.request.write.side_effect = \
+            lambda data: self.producer.pauseProducing()
+        self.fetches[0].callback([{'a': 1}, {'a': 2}])
+        written = self.request.write.call_args[0][0]
+        self.assertEqual(
+            [json.loads(line) for line in written.splitlines()],
+            [{'a': 1}, {'a': 2}])
+        self.assertTrue(written.endswith('\n'))
+        self.assertEqual(len(self.fetches), 1)
+
+        self.producer.resumeProducing()
+        self.producer.resumeProducing()
+        self.assertEqual(len(self.fetches), 2)
+        self.fetches[1].callback([])
+        self.assertIsNone(self.successResultOf(d))
+        self.request.unregisterProducer.assert_called_once_with()
+        self.assertIsNone(self.successResultOf(self.producer.wait()))
+
+    def test_stop_while_fetching(self):
+        d = self.producer.start()
+        self.producer.stopProducing()
+        self.assertNoResult(d)
+        wait_d = self.producer.wait()
+        self.assertNoResult(wait_d)
+
+        self.fetches[0].callback([{'a': 1}])
+        self.assertIsNone(self.successResultOf(d))
+        self.assertIsNone(self.successResultOf(wait_d))
+        self.request.write.assert_not_called()
+        self.assertEqual(len(self.fetches), 1)
+
+        # cancelled, e.g. by klein when the client disconnects
+        producer = ResultProducer(self.request, None, lambda row: row, 2)
+        d = producer.start()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertNoResult(producer.wait())
+        self.fetches[1].callback([{'a': 1}])
+        self.successResultOf(producer.wait())
+
+    def test_fetch_error(self):
+        d = self.producer.start()
+        self.fetches[0].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.request.unregisterProducer.assert_called_once_with()
 
 
 class FlagListTestCase(ViewTestCase, ListTests):
@@ -374,6 +1356,257 @@ class FlagListTestCase(ViewTestCase, ListTests):
             self.successResultOf(obj.insert())
             self.objects.append(obj)
 
+    def get_key(self, obj):
+        return (obj.get('comment_uuid').hex, obj.get('user_uuid').hex)
+
+    def test_cursor_pagination(self):
+        # identical submit_datetimes are ordered by primary key
+        dt = datetime.now(pytz.utc)
+        for obj in self.objects[5:]:
+            obj.set('submit_datetime', dt)
+            self.successResultOf(obj.update())
+        objects_sorted = sorted(
+            self.objects,
+            key=lambda o: (o.get('submit_datetime'),) + self.get_key(o),
+            reverse=True)
+
+        keys = []
+        data = self.get_json('/flags/?cursor=&limit=4')
+        while True:
+            self.assertEqual(data['total'], None)
+            self.assertEqual(data['count'], len(data['objects']))
+            self.assertNotIn('offset', data)
+            keys.extend((o['comment_uuid'], o['user_uuid'])
+                        for o in data['objects'])
+            if data['next_cursor'] is None:
+                break
+            data = self.get_json('/flags/?cursor=%s&limit=4' % (
+                data['next_cursor'], ))
+        self.assertEqual([self.get_key(o) for o in objects_sorted], keys)
+
+        # the offset listing has the same order
+        data = self.get_json('/flags/')
+        self.assertEqual(
+            [(o['comment_uuid'], o['user_uuid']) for o in data['objects']],
+            keys)
+
+        request = self.get('/flags/?cursor=foo')
+        self.assertEqual(request.code, 400)
+        for limit in ('-1', 'abc'):
+            request = self.get('/flags/?cursor=&limit=%s' % limit)
+            self.assertEqual(request.code, 400)
+            self.assertIn(
+                'limit', json.loads(request.getWrittenData())['error_dict'])
+
+    def test_summaries(self):
+        other = Comment(self.connection, dict(
+            comment_data, uuid=uuid.uuid4()))
+        self.successResultOf(other.insert())
+        flags = sorted(self.objects, key=lambda o: o.get('submit_datetime'))
+        obj = flags[-1]
+        # the other comment's latest flag is older
+        self.successResultOf(Flag(self.connection, dict(
+            obj.to_dict(), comment_uuid=other.get('uuid'),
+            submit_datetime=flags[0].get('submit_datetime'))).insert())
+
+        data = self.get_json('/flags/summaries/')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['offset'], 0)
+        summary, other_summary = data['objects']
+        self.assertEqual(summary['comment_uuid'], self.comment.get('uuid').hex)
+        self.assertEqual(summary['count'], '10')
+        self.assertEqual(
+            summary['first_submit_datetime'],
+            flags[0].get('submit_datetime').isoformat())
+        self.assertEqual(
+            summary['last_submit_datetime'],
+            flags[-1].get('submit_datetime').isoformat())
+        self.assertNotIn('user_uuids', summary)
+        self.assertEqual(
+            summary['comment'],
+            CommentSchema(include_all=True).serialize(
+                self.comment.to_dict()))
+        self.assertEqual(other_summary['count'], '1')
+        self.assertEqual(
+            other_summary['comment']['uuid'], other.get('uuid').hex)
+
+        # filters apply to the flags, and user uuids are ordered
+        data = self.get_json(
+            '/flags/summaries/?user_uuids=true&user_uuid_in=%s,%s' % (
+                flags[3].get('user_uuid').hex, obj.get('user_uuid').hex))
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['objects'][0]['user_uuids'], [
+            flags[3].get('user_uuid').hex, obj.get('user_uuid').hex])
+        self.assertEqual(
+            data['objects'][1]['user_uuids'], [obj.get('user_uuid').hex])
+
+        # cursors
+        data = self.get_json('/flags/summaries/?cursor=&limit=1')
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(
+            data['objects'][0]['comment_uuid'], self.comment.get('uuid').hex)
+        data = self.get_json('/flags/summaries/?cursor=%s&limit=1' % (
+            data['next_cursor'], ))
+        self.assertEqual(
+            data['objects'][0]['comment_uuid'], other.get('uuid').hex)
+        data = self.get_json('/flags/summaries/?cursor=%s&limit=1' % (
+            data['next_cursor'], ))
+        self.assertEqual(data['objects'], [])
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_totals(self):
+        data = self.get_json('/flags/')
+        self.assertEqual(data['total'], None)
+
+        url = '/flags/?cursor=&limit=2&user_uuid=%s&total=%s'
+        data = self.get_json(url % (
+            self.objects[0].get('user_uuid').hex, 'exact'))
+        self.assertEqual(data['total'], 1)
+        data = self.get_json('/flags/?total=exact&limit=2')
+        self.assertEqual(data['total'], 10)
+        self.assertEqual(data['count'], 2)
+        data = self.get_json('/flags/?cursor=&total=estimate')
+        self.assertIsInstance(data['total'], int)
+
+        request = self.get('/flags/?total=foo')
+        self.assertEqual(request.code, 400)
+
+
+class BannedUserCacheTestCase(ViewTestCase):
+
+    def setUp(self):
+        super(BannedUserCacheTestCase, self).setUp()
+        self.comment_data = comment_data.copy()
+        del self.comment_data['uuid']
+
+    def test_invalidated_by_views(self):
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 201)
+
+        ban_url = '/bannedusers/%(user_uuid)s/%(app_uuid)s/' % \
+            self.comment_data
+        self.post('/bannedusers/', {
+            'user_uuid': self.comment_data['user_uuid'],
+            'app_uuid': self.comment_data['app_uuid']})
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 403)
+
+        self.delete(ban_url)
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 201)
+
+        self.post('/bannedusers/', {
+            'user_uuid': self.comment_data['user_uuid']})
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 403)
+
+        self.delete('/bannedusers/%(user_uuid)s/' % self.comment_data)
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 201)
+
+    def test_ttl(self):
+        self.post('/comments/', self.comment_data)
+        self.post('/comments/', self.comment_data)
+        stats = self.get_json('/stats/')['caches']['banned_users']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 0)
+
+        # bans made elsewhere are seen once the ttl has passed
+        user = BannedUser(self.connection, {
+            'user_uuid': self.comment_data['user_uuid'],
+            'app_uuid': None})
+        self.successResultOf(user.insert())
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 201)
+
+        self.clock.advance(self.config.banned_user_cache_ttl)
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 403)
+        stats = self.get_json('/stats/')['caches']['banned_users']
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 1)
+
+
+class StreamMetadataCacheTestCase(ViewTestCase):
+
+    def setUp(self):
+        super(StreamMetadataCacheTestCase, self).setUp()
+        self.url = '/streammetadata/%(app_uuid)s/%(content_uuid)s/' % \
+            streammetadata_data
+        self.comment_data = comment_data.copy()
+        del self.comment_data['uuid']
+
+    def get_stats(self):
+        return self.get_json('/stats/')['caches']['stream_metadata']
+
+    def test_invalidated_by_views(self):
+        # negative entry
+        self.assertEqual(self.get_json(self.url)['metadata'], {})
+        self.assertEqual(self.get_stats()['size'], 1)
+
+        request = self.put(self.url, dict(
+            streammetadata_data, metadata={'state': 'closed'}))
+        self.assertEqual(request.code, 200)
+        self.assertEqual(self.get_stats()['size'], 0)
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 403)
+
+        self.put('/streammetadata/?app_uuid=%(app_uuid)s&'
+                 'content_uuid=%(content_uuid)s' % streammetadata_data,
+                 {'metadata': {'state': 'open'}})
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 201)
+
+        self.put('/streammetadata/', {'metadata': {'state': 'disabled'}})
+        self.assertEqual(self.get_stats()['size'], 0)
+        request = self.post('/comments/', self.comment_data)
+        self.assertEqual(request.code, 403)
+
+    def test_ttl_and_size(self):
+        self.get(self.url)
+        self.get(self.url)
+        stats = self.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+        metadata = StreamMetadata(self.connection, streammetadata_data)
+        self.successResultOf(metadata.insert())
+        self.assertEqual(self.get_json(self.url)['metadata'], {})
+        self.clock.advance(self.config.stream_metadata_cache_ttl)
+        self.assertEqual(
+            self.get_json(self.url)['metadata'],
+            streammetadata_data['metadata'])
+
+        app.stream_metadata_cache.size = 2
+        for i in range(3):
+            self.get('/streammetadata/%s/%s/' % (
+                uuid.uuid4().hex, uuid.uuid4().hex))
+        self.assertEqual(self.get_stats()['size'], 2)
+
+    def test_get_many(self):
+        app_uuids = [uuid.uuid4() for i in range(2)]
+        content_uuids = [uuid.uuid4() for i in range(2)]
+        # the streams' uuids cross, but only the requested ones are read
+        for app_uuid, content_uuid, state in (
+                (app_uuids[0], content_uuids[0], 'open'),
+                (app_uuids[0], content_uuids[1], 'closed'),
+                (app_uuids[1], content_uuids[1], 'disabled')):
+            self.successResultOf(StreamMetadata(self.connection, dict(
+                streammetadata_data, app_uuid=app_uuid,
+                content_uuid=content_uuid,
+                metadata={'state': state})).insert())
+
+        keys = [(app_uuids[0], content_uuids[0]),
+                (app_uuids[1], content_uuids[1]),
+                (app_uuids[1], content_uuids[0])]
+        found = self.successResultOf(
+            app.stream_metadata_cache.get_many(self.connection, keys))
+        self.assertEqual(
+            dict((k, v and v['state']) for k, v in found.iteritems()),
+            dict(zip(keys, ['open', 'disabled', None])))
+        self.assertEqual(self.get_stats()['size'], 3)
+
 
 class BannedUserListTestCase(ViewTestCase):
 
@@ -1,10 +1,11 @@
 from unicore.comments.service.views import (
-    comments, flags, bannedusers, streammetadata)
+    comments, flags, bannedusers, streammetadata, stats)
 
 
 __all__ = [
     'comments',
     'flags',
     'bannedusers',
-    'streammetadata'
+    'streammetadata',
+    'stats'
 ]
@@ -5,6 +5,7 @@ from werkzeug.exceptions import NotFound
 from sqlalchemy.exc import IntegrityError
 
 from unicore.comments.service import db, app
+from unicore.comments.service.cache import invalidates
 from unicore.comments.service.views.base import (
     make_json_response, deserialize_or_raise)
 from unicore.comments.service.models import BannedUser
@@ -20,6 +21,7 @@ Banned Users resource
 
 
 @app.route('/bannedusers/', methods=['POST'])
+@invalidates('banned_user_cache')
 @db.in_transaction
 @inlineCallbacks
 def create_banneduser(request, connection):
@@ -60,6 +62,7 @@ def get_banneduser(request, user_uuid, app_uuid):
 
 
 @app.route('/bannedusers/<user_uuid>/<app_uuid>/', methods=['DELETE'])
+@invalidates('banned_user_cache')
 @db.in_transaction
 @inlineCallbacks
 def delete_banneduser(request, user_uuid, app_uuid, connection):
@@ -87,6 +90,7 @@ Banned Users collection resource
 
 
 @app.route('/bannedusers/<user_uuid>/', methods=['DELETE'])
+@invalidates('banned_user_cache')
 @db.in_transaction
 @inlineCallbacks
 def delete_banneduser_all_apps(request, user_uuid, connection):
@@ -1,16 +1,30 @@
 import json
+import hashlib
 
 import colander
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.interfaces import IPushProducer
 from werkzeug.exceptions import NotFound, BadRequest, Forbidden
+from zope.interface import implementer
 
-from unicore.comments.service import app
+from unicore.comments.service import app, db
 
 
-def deserialize_or_raise(schema, req):
+def load_json_or_raise(req):
     try:
         if req.getHeader('Content-Type') != 'application/json':
             raise ValueError
-        data = json.loads(req.content.read())
+        return app.json_codec.loads(req.content.read())
+
+    except (TypeError, ValueError):
+        raise BadRequest(
+            ('NOT_JSON', 'Not valid JSON. Is Content-Type '
+             'set to application/json?'))
+
+
+def deserialize_or_raise(schema, req):
+    data = load_json_or_raise(req)
+    try:
         return schema.deserialize(data)
 
     except (TypeError, ValueError):
@@ -19,22 +33,152 @@ def deserialize_or_raise(schema, req):
              'set to application/json?'))
 
 
-def make_json_response(request, data, schema=None):
+def make_etag(*values):
+    ''' Returns an ETag that identifies the JSON-serializable `values`.
+    '''
+    data = json.dumps(values, sort_keys=True, default=str)
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+
+def is_not_modified(request, etag):
+    ''' Sets the response's ETag. If the request's If-None-Match header
+    matches it, sets the response code to 304 and returns True, in
+    which case the response should have no body.
+    '''
+    request.setHeader('ETag', etag)
+    if_none_match = request.getHeader('If-None-Match')
+    if not if_none_match:
+        return False
+
+    tags = set(tag.strip() for tag in if_none_match.split(','))
+    # If-None-Match uses weak comparison
+    tags.update(tag[2:] for tag in list(tags) if tag.startswith('W/'))
+    if etag in tags or '*' in tags:
+        request.setResponseCode(304)
+        return True
+    return False
+
+
+def make_json_response(request, data, schema=None, etag=None):
+    ''' If `etag` is given and matches the request's If-None-Match
+    header, the response is a 304 Not Modified without a body.
+    '''
     request.setHeader('Content-Type', 'application/json')
+    if etag is not None and is_not_modified(request, etag):
+        return ''
     if schema:
         data = schema.serialize(data)
-    return json.dumps(data)
+    body = app.json_codec.dumps(data)
+    request.setHeader('Content-Length', str(len(body)))
+    return body
 
 
-def make_error_response(request, status_code, error_code,
-                        error_dict=None, error_message=None):
-    request.setResponseCode(status_code)
-    return make_json_response(request, {
+@implementer(IPushProducer)
+class ResultProducer(object):
+    ''' Writes the rows of `result` to `request` as newline-delimited
+    JSON, `chunk_size` rows at a time. The next chunk is only fetched
+    once the previous one has been written and the transport isn't
+    paused, so at most one chunk is held in memory.
+    '''
+
+    def __init__(self, request, result, serialize, chunk_size):
+        self.request = request
+        self.result = result
+        self.serialize = serialize
+        self.chunk_size = chunk_size
+        self._paused = False
+        self._stopped = False
+        self._fetching = None
+        self._deferred = None
+        self._registered = False
+
+    def start(self):
+        ''' Returns a Deferred that fires when all rows have been
+        written, or the connection has been lost.
+        '''
+        self._deferred = Deferred(lambda d: self.stopProducing())
+        self.request.setHeader('Content-Type', 'application/x-ndjson')
+        self._registered = True
+        self.request.registerProducer(self, True)
+        self._fetch()
+        return self._deferred
+
+    def wait(self):
+        ''' Returns a Deferred that fires once no rows are being
+        fetched. The result must not be closed before then.
+        '''
+        if self._fetching is None:
+            return succeed(None)
+        d = Deferred()
+        self._fetching.addBoth(d.callback)
+        return d
+
+    def _fetch(self):
+        if self._paused or self._stopped or self._fetching is not None:
+            return
+        self._fetching = db.fetchmany(self.result, self.chunk_size)
+        self._fetching.addCallbacks(self._write, self._fail)
+
+    def _write(self, rows):
+        self._fetching = None
+        if self._stopped:
+            self._finish()
+            return
+        if not rows:
+            self._stopped = True
+            self._finish()
+            return
+
+        dumps = app.json_codec.dumps
+        serialize = self.serialize
+        self.request.write(
+            ''.join([dumps(serialize(row)) + '\n' for row in rows]))
+        # writing may have paused the producer
+        self._fetch()
+
+    def _fail(self, failure):
+        self._fetching = None
+        self._stopped = True
+        self._finish(failure)
+
+    def _finish(self, failure=None):
+        if self._registered:
+            self._registered = False
+            self.request.unregisterProducer()
+        if self._deferred.called:
+            return
+        if failure is not None:
+            self._deferred.errback(failure)
+        else:
+            self._deferred.callback(None)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._fetch()
+
+    def stopProducing(self):
+        self._stopped = True
+        if self._fetching is None:
+            self._finish()
+
+
+def make_error_dict(error_code, error_dict=None, error_message=None):
+    return {
         'status': 'error',
         'error_code': error_code,
         'error_dict': error_dict,
         'error_message': error_message,
-    })
+    }
+
+
+def make_error_response(request, status_code, error_code,
+                        error_dict=None, error_message=None):
+    request.setResponseCode(status_code)
+    return make_json_response(request, make_error_dict(
+        error_code, error_dict=error_dict, error_message=error_message))
 
 
 @app.handle_errors(colander.Invalid)
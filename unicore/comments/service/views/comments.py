@@ -1,27 +1,39 @@
 from uuid import UUID
+from collections import Counter
 
 import colander
-from sqlalchemy import or_, and_
+from sqlalchemy import (
+    or_, and_, not_, true, false, null, literal, case, union_all, tuple_)
 from sqlalchemy.sql import exists, select, func
-from twisted.internet.defer import inlineCallbacks, returnValue
-from werkzeug.exceptions import NotFound, Forbidden
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from werkzeug.exceptions import NotFound, Forbidden, BadRequest
 
 from unicore.comments.service import db, app
 from unicore.comments.service.views.base import (
-    make_json_response, deserialize_or_raise)
+    make_json_response, deserialize_or_raise, make_etag, is_not_modified,
+    load_json_or_raise, make_error_dict, ResultProducer)
 from unicore.comments.service.views import pagination
-from unicore.comments.service.models import Comment, BannedUser, StreamMetadata
-from unicore.comments.service.schema import Comment as CommentSchema, UUIDType
+from unicore.comments.service.models import (
+    Comment, BannedUser, StreamMetadata, CommentCount, PATH_SEPARATOR,
+    MAX_REPLY_DEPTH, COMMENT_MAX_LENGTH, COMMENT_TRIGRAM_COLUMNS)
+from unicore.comments.service.schema import (
+    Comment as CommentSchema, CommentModeration as CommentModerationSchema,
+    UUIDType)
+from unicore.comments.service.serializers import compile_serializer
 from unicore.comments.service.views.filtering import (
     FilterSchema, ALL)
 from unicore.comments.service.views.streammetadata import (
-    schema as smd_schema, get_stream_primary_keys)
+    schema as smd_schema, get_stream_primary_keys, is_bounded)
 
 
 schema = CommentSchema()
 schema_all = CommentSchema(include_all=True)
+schema_moderation = CommentModerationSchema()
+serialize_all = compile_serializer(schema_all)
 schema_metadata = smd_schema['metadata']
 comment_filters = FilterSchema.from_schema(schema_all, {
+    'uuid': ALL,
     'content_uuid': ALL,
     'content_type': ALL,
     'content_title': ALL,
@@ -31,74 +43,503 @@ comment_filters = FilterSchema.from_schema(schema_all, {
     'submit_datetime': ALL,
     'is_removed': ALL,
     'moderation_state': ALL,
-    'flag_count': ALL
-})
+    'flag_count': ALL,
+    'parent_uuid': ALL
+}, indexed_like=COMMENT_TRIGRAM_COLUMNS)
 extra_filters = FilterSchema(children=[
     colander.SchemaNode(UUIDType(), name='before'),
     colander.SchemaNode(UUIDType(), name='after')])
+dry_run_node = colander.SchemaNode(
+    colander.Boolean(),
+    name='dry_run',
+    missing=False)
+search_node = colander.SchemaNode(
+    colander.String(encoding='utf-8'),
+    name='q',
+    missing=None,
+    validator=colander.Length(max=COMMENT_MAX_LENGTH))
+COUNT_KEY_COLUMNS = ('app_uuid', 'content_uuid', 'moderation_state')
+MAX_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 500
+MAX_STREAMS = 100
+DEFAULT_PER_STREAM_LIMIT = 3
+REPLY_TOO_DEEP_MESSAGE = \
+    'replies can only be nested %d deep' % MAX_REPLY_DEPTH
+per_stream_limit_node = colander.SchemaNode(
+    colander.Integer(),
+    name='per_stream_limit',
+    missing=DEFAULT_PER_STREAM_LIMIT,
+    validator=colander.Range(min=1))
 
 
-def is_banned_user(connection, user_uuid, app_uuid):
+@inlineCallbacks
+def get_banned_users(connection, user_uuids):
+    ''' Returns a set of (user_uuid, app_uuid) bans that includes all
+    bans of `user_uuids`. app_uuid is None for bans from all apps.
+    '''
+    if app.banned_user_cache.enabled:
+        banned = yield app.banned_user_cache.get_banned(connection)
+        returnValue(banned)
+
     cols = BannedUser.__table__.c
-    expression = cols.user_uuid == user_uuid
-    expression = and_(
-        expression,
-        or_(cols.app_uuid == app_uuid, cols.app_uuid.is_(None)))
+    query = select([cols.user_uuid, cols.app_uuid]) \
+        .where(cols.user_uuid.in_(user_uuids))
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    returnValue(set((row['user_uuid'], row['app_uuid']) for row in result))
+
+
+def get_stream_metadata(connection, app_uuid, content_uuid):
+    d = app.stream_metadata_cache.get_metadata(
+        connection, app_uuid, content_uuid)
+    d.addCallback(lambda metadata: metadata or {})
+    return d
+
+
+def get_streams_metadata(connection, stream_keys):
+    ''' Returns a dict mapping each (app_uuid, content_uuid) in
+    `stream_keys` to the stream's serialized metadata, which is empty
+    if the stream isn't in the database. Streams that aren't cached
+    are selected with one query.
+    '''
+    d = app.stream_metadata_cache.get_many(connection, stream_keys)
+    d.addCallback(lambda metadata: dict(
+        (key, schema_metadata.serialize(value or {}))
+        for key, value in metadata.iteritems()))
+    return d
+
+
+def get_request_stream_keys(request):
+    ''' Returns the (app_uuid, content_uuid) of each stream specified
+    by the request's filters.
+    '''
+    stream_keys = get_stream_primary_keys(request)
+    if len(stream_keys) > MAX_STREAMS:
+        raise BadRequest((
+            'TOO_MANY_STREAMS',
+            'at most %d streams can be listed at once' % MAX_STREAMS))
+    return stream_keys
+
+
+def nest_stream_metadata(metadata):
+    ''' Returns the metadata in the dict `metadata`, which is keyed by
+    (app_uuid, content_uuid), as nested dicts keyed by app_uuid and then
+    content_uuid.
+    '''
+    nested = {}
+    for (app_uuid, content_uuid), value in metadata.iteritems():
+        nested.setdefault(app_uuid.hex, {})[content_uuid.hex] = value
+    return nested
+
+
+def get_search_query(args):
+    ''' Returns the text search query for the `q` argument, or None if
+    there is none.
+    '''
+    text = search_node.deserialize(args.get('q', [colander.null])[0])
+    if text is None:
+        return None
+    return Comment.get_search_query(text)
+
+
+def apply_search(args, query):
+    ''' Restricts `query` to comments matching the `q` argument, if
+    there is one. The comment_search_index is used.
+    '''
+    search_query = get_search_query(args)
+    if search_query is None:
+        return query
+    return query.where(
+        Comment.get_search_vector().op('@@')(search_query))
+
+
+def get_count_key(comment):
+    return tuple(comment.get(name) for name in COUNT_KEY_COLUMNS)
+
+
+def count_comments(connection, request, query_all, total_mode):
+    ''' Counts the comments matched by `query_all`. The comment_counts
+    table is used if the filters only involve its columns. Otherwise,
+    depending on `total_mode`, the comments are counted or the planner's
+    estimate is used.
+    '''
+    if total_mode == pagination.TOTAL_NONE:
+        return succeed(None)
+
+    counter_columns = CommentCount.__table__.c
+    filter_columns = comment_filters.get_filter_columns(request.args)
+    is_search = get_search_query(request.args) is not None
+
+    if filter_columns.issubset(counter_columns.keys()) and not is_search:
+        filter_expr = comment_filters.get_filter_expression(
+            request.args, counter_columns)
+        query = select([func.coalesce(func.sum(counter_columns.count), 0)]) \
+            .where(filter_expr)
+    elif total_mode == pagination.TOTAL_ESTIMATE:
+        return db.estimate_count(connection, query_all)
+    else:
+        query = query_all.alias().count()
 
-    query = BannedUser.__table__.select(exists().where(expression))
     d = connection.execute(query)
     d.addCallback(lambda result: result.scalar())
-    d.addCallback(lambda count: bool(count))
+    d.addCallback(int)
     return d
 
 
-def get_stream_metadata(connection, request=None, app_uuid=None,
-                        content_uuid=None):
-    if request:
-        primary_key = get_stream_primary_keys(request)
-        if not primary_key or len(primary_key) > 1:
-            return {}
-        app_uuid, content_uuid = primary_key.pop()
+def is_app_scoped(request):
+    ''' Returns True if the request's filters restrict comments to
+    specific apps, in which case `get_comments_version` only sums the
+    versions of those apps' streams.
+    '''
+    return 'app_uuid' in request.args or 'app_uuid_in' in request.args
+
 
-    elif not (app_uuid and content_uuid):
-        raise ValueError(
-            'either request must be provided, or '
-            'app_uuid and content_uuid must be provided')
+def get_comments_version(connection, request):
+    ''' Returns a number that increases whenever a comment that the
+    request's filters could match changes. It is the sum of the versions
+    of the comment_counts rows matched by the filters on its columns.
+    '''
+    counter_columns = CommentCount.__table__.c
+    args = dict(
+        (name, value) for name, value in request.args.iteritems()
+        if comment_filters.get(name) is not None and
+        comment_filters.get_column_name(comment_filters.get(name))
+        in counter_columns)
+    filter_expr = comment_filters.get_filter_expression(
+        args, counter_columns)
+    query = select([func.coalesce(func.sum(counter_columns.version), 0)]) \
+        .where(filter_expr)
 
-    d = StreamMetadata.get_by_pk(
-        connection, app_uuid=app_uuid, content_uuid=content_uuid)
-    d.addCallback(lambda o: o.get('metadata') if o else {})
+    d = connection.execute(query)
+    d.addCallback(lambda result: result.scalar())
+    d.addCallback(int)
     return d
 
 
+def get_insert_comment_query(data, check_banned=True,
+                             check_stream_state=True):
+    ''' Returns a single statement that inserts the comment in `data`,
+    unless the user is banned, the stream is not open or the comment's
+    parent isn't in the stream or is nested MAX_REPLY_DEPTH deep, and
+    increments the comment's count and its parent's reply count. The row
+    returned contains `is_banned`, `stream_state`, `parent_path` and the
+    inserted comment's columns, which are all NULL if the comment wasn't
+    inserted.
+
+    If `check_banned` or `check_stream_state` is False the ban list or
+    stream state isn't checked, because the caller has already checked it.
+    '''
+    comment_table = Comment.__table__
+    banned_cols = BannedUser.__table__.c
+    smd_cols = StreamMetadata.__table__.c
+    data = Comment.with_defaults(data)
+    parent_uuid = data.get('parent_uuid')
+
+    if check_banned:
+        is_banned = exists().where(and_(
+            banned_cols.user_uuid == data['user_uuid'],
+            or_(banned_cols.app_uuid == data['app_uuid'],
+                banned_cols.app_uuid.is_(None))))
+    else:
+        is_banned = false()
+    if check_stream_state:
+        stream_state = select([
+            func.json_extract_path_text(smd_cols.metadata, 'state')]) \
+            .where(and_(
+                smd_cols.app_uuid == data['app_uuid'],
+                smd_cols.content_uuid == data['content_uuid'])) \
+            .as_scalar()
+    else:
+        stream_state = null()
+    if parent_uuid is not None:
+        parent_path = select([comment_table.c.path]) \
+            .where(and_(
+                comment_table.c.uuid == parent_uuid,
+                comment_table.c.app_uuid == data['app_uuid'],
+                comment_table.c.content_uuid == data['content_uuid'])) \
+            .as_scalar()
+    else:
+        parent_path = null()
+    checks = select([
+        is_banned.label('is_banned'),
+        func.coalesce(stream_state, u'open').label('stream_state'),
+        parent_path.label('parent_path')]) \
+        .cte('checks')
+
+    names = sorted(data.keys())
+    columns = [literal(data[name], type_=comment_table.c[name].type)
+               for name in names]
+    conditions = [not_(checks.c.is_banned), checks.c.stream_state == u'open']
+    if parent_uuid is not None:
+        names.append('path')
+        columns.append(checks.c.parent_path + literal(
+            PATH_SEPARATOR + Comment.get_path_component(data)))
+        conditions.append(checks.c.parent_path.isnot(None))
+        conditions.append(
+            func.length(checks.c.parent_path) -
+            func.length(func.replace(
+                checks.c.parent_path, PATH_SEPARATOR, u'')) <
+            MAX_REPLY_DEPTH)
+    values = select(columns) \
+        .select_from(checks) \
+        .where(and_(*conditions))
+    inserted = comment_table \
+        .insert() \
+        .from_select(names, values) \
+        .returning(*comment_table.c) \
+        .cte('inserted')
+
+    replied = comment_table \
+        .update() \
+        .values(reply_count=comment_table.c.reply_count + 1) \
+        .where(comment_table.c.uuid == inserted.c.parent_uuid) \
+        .returning(*[comment_table.c[name] for name in COUNT_KEY_COLUMNS]) \
+        .cte('replied')
+
+    # the parent's count is touched, since its reply count changed
+    amounts = union_all(
+        select([inserted.c[name] for name in COUNT_KEY_COLUMNS] +
+               [literal(1).label('amount')]),
+        select([replied.c[name] for name in COUNT_KEY_COLUMNS] +
+               [literal(0).label('amount')])) \
+        .alias('amounts')
+    counted = CommentCount \
+        .increment_from_select(
+            select([amounts.c[name] for name in COUNT_KEY_COLUMNS] +
+                   [func.sum(amounts.c.amount)])
+            .group_by(*[amounts.c[name] for name in COUNT_KEY_COLUMNS])) \
+        .returning(CommentCount.__table__.c.count) \
+        .cte('counted')
+
+    query = select([checks.c.is_banned,
+                    checks.c.stream_state,
+                    checks.c.parent_path] +
+                   [inserted.c[c.name] for c in comment_table.c]) \
+        .select_from(checks
+                     .outerjoin(inserted, true())
+                     .outerjoin(replied, true())
+                     .outerjoin(counted, true())) \
+        .execution_options(autocommit=True)
+    return query
+
+
+@inlineCallbacks
+def update_reply_counts(connection, amounts):
+    ''' Adds the values of the dict `amounts` to the reply counts of the
+    comments whose uuids are its keys, with one query. Returns the count
+    keys of the updated comments, whose counts should be touched.
+    '''
+    comments = Comment.__table__
+    query = comments \
+        .update() \
+        .values(reply_count=comments.c.reply_count + case(
+            [(comments.c.uuid == uuid, amount)
+             for uuid, amount in amounts.iteritems()])) \
+        .where(comments.c.uuid.in_(amounts.keys())) \
+        .returning(*[comments.c[name] for name in COUNT_KEY_COLUMNS])
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    returnValue([tuple(row) for row in result])
+
+
+@inlineCallbacks
+def get_parents(connection, uuids):
+    ''' Returns a dict of the comments with `uuids`, which replies are
+    being added to, by uuid.
+    '''
+    if not uuids:
+        returnValue({})
+    comments = Comment.__table__
+    query = select([comments.c.uuid,
+                    comments.c.app_uuid,
+                    comments.c.content_uuid,
+                    comments.c.path]) \
+        .where(comments.c.uuid.in_(uuids))
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    returnValue(dict((row['uuid'], row) for row in result))
+
+
 '''
 Comment resource
 '''
 
 
 @app.route('/comments/', methods=['POST'])
-@db.in_transaction
 @inlineCallbacks
-def create_comment(request, connection):
+def create_comment(request):
     data = deserialize_or_raise(schema.bind(), request)
+    # checks that can be answered from caches are left out of the query
+    check_banned = not app.banned_user_cache.enabled
+    check_stream_state = not app.stream_metadata_cache.enabled
 
-    is_banned = yield is_banned_user(
-        connection, data['user_uuid'], data['app_uuid'])
-    if is_banned:
-        raise Forbidden(('USER_BANNED', 'user is banned from commenting'))
+    try:
+        connection = yield app.db_engine.connect()
+        if not check_banned:
+            is_banned = yield app.banned_user_cache.is_banned(
+                connection, data['user_uuid'], data['app_uuid'])
+            if is_banned:
+                raise Forbidden(
+                    ('USER_BANNED', 'user is banned from commenting'))
+
+        if not check_stream_state:
+            metadata = yield get_stream_metadata(
+                connection, app_uuid=data['app_uuid'],
+                content_uuid=data['content_uuid'])
+            if metadata.get('state', 'open') != 'open':
+                raise Forbidden(
+                    ('STREAM_NOT_OPEN', 'comment stream is not open'))
 
-    metadata = yield get_stream_metadata(
-        connection, app_uuid=data['app_uuid'],
-        content_uuid=data['content_uuid'])
-    if metadata.get('state', 'open') != 'open':
+        query = get_insert_comment_query(
+            data, check_banned=check_banned,
+            check_stream_state=check_stream_state)
+        result = yield connection.execute(query)
+        result = yield result.first()
+    finally:
+        yield connection.close()
+
+    if result['is_banned']:
+        raise Forbidden(('USER_BANNED', 'user is banned from commenting'))
+    if result['stream_state'] != 'open':
         raise Forbidden(('STREAM_NOT_OPEN', 'comment stream is not open'))
+    if data.get('parent_uuid') is not None and result['parent_path'] is None:
+        raise colander.Invalid(
+            schema['parent_uuid'], 'parent comment not in this stream')
+    if data.get('parent_uuid') is not None and \
+            Comment.get_depth(result['parent_path']) >= MAX_REPLY_DEPTH:
+        raise colander.Invalid(schema['parent_uuid'], REPLY_TOO_DEEP_MESSAGE)
 
-    comment = Comment(connection, data)
-    yield comment.insert()
+    comment = dict((c.name, result[c.name]) for c in Comment.__table__.c)
 
     request.setResponseCode(201)
-    returnValue(make_json_response(
-        request, comment.to_dict(), schema=schema_all))
+    returnValue(make_json_response(request, comment, schema=schema_all))
+
+
+@inlineCallbacks
+def insert_comments(connection, comments):
+    ''' Inserts `comments`, which must have paths, and increments their
+    counts and their parents' reply counts, with one query each.
+    Comments whose uuids already exist aren't inserted, and only the
+    inserted comments are returned.
+    '''
+    columns = Comment.__table__.c
+    rows = []
+    for data in comments:
+        data = Comment.with_defaults(data)
+        rows.append(dict((c.name, data.get(c.name)) for c in columns))
+
+    query = pg_insert(Comment.__table__) \
+        .values(rows) \
+        .on_conflict_do_nothing(index_elements=[columns.uuid]) \
+        .returning(*columns)
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    result = [dict(row.items()) for row in result]
+
+    replies = Counter(
+        row['parent_uuid'] for row in result
+        if row['parent_uuid'] is not None)
+    amounts = Counter(get_count_key(row) for row in result)
+    if replies:
+        parent_keys = yield update_reply_counts(connection, replies)
+        for key in parent_keys:
+            amounts[key] += 0
+    yield CommentCount.increment_many(connection, amounts)
+    returnValue(result)
+
+
+@app.route('/comments/batch/', methods=['POST'])
+@db.in_transaction
+@inlineCallbacks
+def create_comment_batch(request, connection):
+    ''' Creates the comments in the JSON array in the request body.
+    Each comment is validated and checked against the ban list and its
+    stream's state, and `objects` has a result for each comment, in
+    order. The ban list, stream states, parents and insert need a
+    query each.
+    '''
+    items = load_json_or_raise(request)
+    if not isinstance(items, list):
+        raise BadRequest(('NOT_LIST', 'request body must be a JSON array'))
+    if len(items) > MAX_BATCH_SIZE:
+        raise BadRequest((
+            'BATCH_TOO_LARGE',
+            'at most %d comments can be created at once' % MAX_BATCH_SIZE))
+
+    results = [None] * len(items)
+    valid = []
+    bound_schema = schema.bind()
+    for i, item in enumerate(items):
+        try:
+            valid.append((i, bound_schema.deserialize(item)))
+        except colander.Invalid as e:
+            results[i] = make_error_dict('BAD_FIELDS', error_dict=e.asdict())
+
+    banned = yield get_banned_users(
+        connection, set(data['user_uuid'] for i, data in valid))
+    metadata = yield app.stream_metadata_cache.get_many(
+        connection,
+        [(data['app_uuid'], data['content_uuid']) for i, data in valid])
+    parents = yield get_parents(connection, set(
+        data['parent_uuid'] for i, data in valid
+        if data.get('parent_uuid') is not None))
+
+    to_insert = {}
+    for i, data in valid:
+        stream_metadata = metadata[(data['app_uuid'], data['content_uuid'])]
+        if ((data['user_uuid'], data['app_uuid']) in banned or
+                (data['user_uuid'], None) in banned):
+            results[i] = make_error_dict(
+                'USER_BANNED', error_message='user is banned from commenting')
+        elif (stream_metadata or {}).get('state', 'open') != 'open':
+            results[i] = make_error_dict(
+                'STREAM_NOT_OPEN', error_message='comment stream is not open')
+        else:
+            parent_path = None
+            if data.get('parent_uuid') is not None:
+                parent = parents.get(data['parent_uuid'])
+                if (parent is None or
+                        parent['app_uuid'] != data['app_uuid'] or
+                        parent['content_uuid'] != data['content_uuid']):
+                    results[i] = make_error_dict('BAD_FIELDS', error_dict={
+                        'parent_uuid': 'parent comment not in this stream'})
+                    continue
+                if Comment.get_depth(parent['path']) >= MAX_REPLY_DEPTH:
+                    results[i] = make_error_dict('BAD_FIELDS', error_dict={
+                        'parent_uuid': REPLY_TOO_DEEP_MESSAGE})
+                    continue
+                parent_path = parent['path']
+            data = Comment.with_defaults(data)
+            if data['uuid'] in to_insert:
+                results[i] = make_error_dict(
+                    'DUPLICATE_UUID',
+                    error_message='uuid is used by another comment in '
+                                  'this batch')
+                continue
+            data['path'] = Comment.get_path(data, parent_path)
+            to_insert[data['uuid']] = (i, data)
+
+    created = 0
+    if to_insert:
+        comments = yield insert_comments(
+            connection, [item[1] for item in to_insert.itervalues()])
+        created = len(comments)
+        for comment in comments:
+            i, _ = to_insert.pop(comment['uuid'])
+            results[i] = {
+                'status': 'created',
+                'object': serialize_all(comment)}
+        # the rest conflicted with existing comments
+        for i, _ in to_insert.itervalues():
+            results[i] = make_error_dict(
+                'DUPLICATE_UUID',
+                error_message='a comment with this uuid already exists')
+
+    returnValue(make_json_response(request, {
+        'count': len(results),
+        'created': created,
+        'objects': results
+    }))
 
 
 @app.route('/comments/<uuid>/', methods=['GET'])
@@ -127,12 +568,36 @@ def view_comment(request, uuid):
 @inlineCallbacks
 def update_comment(request, uuid, connection):
     data = deserialize_or_raise(schema.bind(comment_uuid=uuid), request)
-    comment = Comment(connection, data)
-    count = yield comment.update()
+    try:
+        uuid = UUID(uuid)
+    except ValueError:
+        raise NotFound
 
-    if count == 0:
+    # lock the existing row so that its counter can be updated
+    comment = yield Comment.get_one(connection, for_update=True, uuid=uuid)
+    if comment is None:
         raise NotFound
 
+    # replies can't be moved to another thread
+    parent_uuid = data.pop('parent_uuid', comment.get('parent_uuid'))
+    if parent_uuid != comment.get('parent_uuid'):
+        raise colander.Invalid(
+            schema['parent_uuid'], 'parent_uuid cannot be changed')
+
+    old_key = get_count_key(comment)
+    for name, value in data.iteritems():
+        comment.set(name, value)
+
+    # only changed columns are written, and the row is already loaded
+    if comment.dirty:
+        yield comment.update(returning=())
+        new_key = get_count_key(comment)
+        if old_key != new_key:
+            yield CommentCount.decrement(connection, *old_key)
+            yield CommentCount.increment(connection, *new_key)
+        else:
+            yield CommentCount.touch(connection, *new_key)
+
     returnValue(make_json_response(
         request, comment.to_dict(), schema=schema_all))
 
@@ -152,10 +617,90 @@ def delete_comment(request, uuid, connection):
     if count == 0:
         raise NotFound
 
+    amounts = Counter({get_count_key(comment): -1})
+    if comment.get('parent_uuid') is not None:
+        parent_keys = yield update_reply_counts(
+            connection, {comment.get('parent_uuid'): -1})
+        for key in parent_keys:
+            amounts[key] += 0
+    yield CommentCount.increment_many(connection, amounts)
+
     returnValue(make_json_response(
         request, comment.to_dict(), schema=schema_all))
 
 
+@app.route('/comments/<uuid>/replies/', methods=['GET'])
+@inlineCallbacks
+def list_replies(request, uuid):
+    ''' Lists the replies to a comment, depth first in submission order.
+    Pages are made up of whole threads, one for each direct reply, and
+    `limit` and `cursor` apply to the direct replies. Each page is one
+    range scan over the path index.
+    '''
+    try:
+        uuid = UUID(uuid)
+    except ValueError:
+        raise NotFound
+
+    limit = pagination.get_limit(request.args)
+    values = None
+    token = request.args.get('cursor', [''])[0]
+    if token:
+        values = pagination.decode_cursor(token, app.config.cursor_secret)
+        if len(values) != 1 or not isinstance(values[0], unicode):
+            raise BadRequest(
+                ('BAD_CURSOR', 'Not a valid pagination cursor.'))
+
+    try:
+        connection = yield app.db_engine.connect()
+        root = yield Comment.get_by_pk(connection, uuid=uuid)
+        if root is None:
+            raise NotFound
+
+        comments = Comment.__table__
+        page = select([comments.c.path]) \
+            .where(comments.c.parent_uuid == uuid) \
+            .order_by(comments.c.path) \
+            .limit(limit)
+        if values is not None:
+            # the cursor holds the last thread's path component, since
+            # paths don't change when submit_datetime does
+            boundary = u'%s%s%s' % (
+                root.get('path'), PATH_SEPARATOR, values[0])
+            page = page.where(comments.c.path > boundary)
+        page = page.alias('page')
+
+        # a thread's paths sort between its root's path and the root's
+        # path followed by a character that sorts after the separator
+        bounds = select([func.min(page.c.path).label('first'),
+                         func.max(page.c.path).label('last')]) \
+            .cte('bounds')
+        query = select(comments.c) \
+            .select_from(comments.join(bounds, and_(
+                comments.c.path >= bounds.c.first,
+                comments.c.path < bounds.c.last + literal(
+                    chr(ord(PATH_SEPARATOR) + 1))))) \
+            .order_by(comments.c.path)
+        result = yield connection.execute(query)
+        result = yield result.fetchall()
+    finally:
+        yield connection.close()
+
+    threads = [row for row in result if row['parent_uuid'] == uuid]
+    next_cursor = None
+    if threads and len(threads) == limit:
+        next_cursor = pagination.encode_cursor(
+            [threads[-1]['path'].rsplit(PATH_SEPARATOR, 1)[-1]],
+            app.config.cursor_secret)
+
+    returnValue(make_json_response(request, {
+        'count': len(threads),
+        'limit': limit,
+        'objects': map(serialize_all, result),
+        'next_cursor': next_cursor
+    }))
+
+
 '''
 Comment collection resource
 '''
@@ -195,22 +740,44 @@ def apply_extra_filters(extra, query):
     return query
 
 
-@app.route('/comments/', methods=['GET'])
 @inlineCallbacks
-def list_comments(request):
-    columns = Comment.__table__.c
-    filter_expr = comment_filters.get_filter_expression(request.args, columns)
+def cursor_list_comments(request, query_all, total_mode, connection):
+    columns = query_all.froms[0].c
+    order_columns = (columns.submit_datetime, columns.uuid)
+    query, limit = pagination.paginate_cursor(
+        request.args, query_all, order_columns, app.config.cursor_secret)
+
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    total = yield count_comments(connection, request, query_all, total_mode)
+
+    data = {
+        'total': total,
+        'count': len(result),
+        'limit': limit,
+        'objects': [serialize_all(row) for row in result],
+        'next_cursor': pagination.get_next_cursor(
+            result, order_columns, limit, app.config.cursor_secret)
+    }
+    returnValue(data)
+
+
+@inlineCallbacks
+def offset_list_comments(request, query_all, total_mode, connection):
+    columns = query_all.froms[0].c
     extra = extra_filters.convert_lists(request.args)
     extra = extra_filters.deserialize(extra)
 
-    query_all = Comment.__table__ \
-        .select() \
-        .where(filter_expr)
+    order_by = (columns.submit_datetime.desc(), columns.uuid.desc())
+    search_query = get_search_query(request.args)
+    # before/after seek on submit_datetime, so they can't be ranked
+    if search_query is not None and not extra:
+        rank = func.ts_rank(Comment.get_search_vector(), search_query)
+        order_by = (rank.desc(), ) + order_by
+
     query = query_all \
         .column(func.row_number()
-                .over(order_by=(
-                    columns.submit_datetime.desc(),
-                    columns.uuid.desc()))
+                .over(order_by=order_by)
                 .label('row_number')) \
         .alias() \
         .select() \
@@ -218,24 +785,332 @@ def list_comments(request):
     query = apply_extra_filters(extra, query)
     query, limit, offset = pagination.paginate(request.args, query)
 
-    try:
-        connection = yield app.db_engine.connect()
-        result = yield connection.execute(query)
-        result = yield result.fetchall()
-        total = yield connection.execute(query_all.alias().count())
-        total = yield total.scalar()
-        metadata = yield get_stream_metadata(connection, request=request)
-
-    finally:
-        yield connection.close()
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    total = yield count_comments(connection, request, query_all, total_mode)
 
     data = {
         'total': total,
         'count': len(result),
-        'objects': [schema_all.serialize(row) for row in
+        'objects': [serialize_all(row) for row in
                     sorted(result, key=lambda r: r['row_number'])],
-        'metadata': schema_metadata.serialize(metadata),
         'start': result[0]['row_number'] if result else None,
         'end': result[-1]['row_number'] if result else None
     }
+    returnValue(data)
+
+
+@app.route('/comments/', methods=['GET'])
+@inlineCallbacks
+def list_comments(request):
+    ''' If a `cursor` argument is provided (an empty cursor requests the
+    first page), comments are paged using the opaque `next_cursor` token
+    returned with each page. This seeks on (submit_datetime, uuid) and so
+    the cost of a page doesn't depend on its depth. `before`, `after` and
+    `offset` are ignored in this mode.
+
+    Otherwise comments are paged using `offset` or `before`/`after`.
+
+    The `q` argument searches the comments' text in the language of
+    their locale. Search results paged with `offset` are ordered by
+    rank, then submit_datetime; with a cursor or `before`/`after`, they
+    are ordered by submit_datetime only.
+
+    The `total` argument is one of `exact` (the default), `estimate` or
+    `none`. When the filters only involve app_uuid, content_uuid and
+    moderation_state, the total is read from the comment_counts table.
+    Otherwise `exact` counts the matching comments, `estimate` returns the
+    query planner's estimate and `none` omits the total.
+
+    If the filters specify streams, i.e. UUIDs for both app_uuid and
+    content_uuid, `stream_metadata` maps each stream's app_uuid and then
+    content_uuid to its metadata, read with one query. If they specify
+    a single stream, its metadata is also returned as `metadata`. Listings
+    of more than MAX_STREAMS streams have no `stream_metadata`.
+
+    Responses to listings filtered on app_uuid(_in) have an ETag derived
+    from the comment_counts versions and the stream metadata, which are
+    checked before the comments are queried. If it matches If-None-Match,
+    a 304 is returned instead. Other listings have no ETag, since their
+    version would be the sum over the whole comment_counts table. Flags
+    only change the version when they remove a comment, so flag_count
+    may be stale in a cached page.
+    '''
+
+    columns = Comment.__table__.c
+    filter_expr = comment_filters.get_filter_expression(request.args, columns)
+    total_mode = pagination.get_total_mode(request.args)
+    stream_keys = get_stream_primary_keys(request)
+    if len(stream_keys) > MAX_STREAMS:
+        stream_keys = None
+
+    query_all = Comment.__table__ \
+        .select() \
+        .where(filter_expr)
+    query_all = apply_search(request.args, query_all)
+
+    view_func = (cursor_list_comments
+                 if pagination.is_cursor_request(request.args)
+                 else offset_list_comments)
+    try:
+        connection = yield app.db_engine.connect()
+        # the version is read first, so that a change made while the
+        # page is queried results in a stale ETag rather than a stale page
+        version = None
+        if is_app_scoped(request):
+            version = yield get_comments_version(connection, request)
+        stream_metadata = None
+        if stream_keys is not None:
+            stream_metadata = yield get_streams_metadata(
+                connection, stream_keys)
+            stream_metadata = nest_stream_metadata(stream_metadata)
+        metadata = {}
+        if stream_keys is not None and len(stream_keys) == 1:
+            app_uuid, content_uuid = next(iter(stream_keys))
+            metadata = stream_metadata[app_uuid.hex][content_uuid.hex]
+        not_modified = version is not None and is_not_modified(
+            request, make_etag(version, stream_metadata))
+        if not not_modified:
+            data = yield view_func(
+                request, query_all, total_mode, connection)
+            data['metadata'] = metadata
+            if stream_metadata is not None:
+                data['stream_metadata'] = stream_metadata
+    finally:
+        yield connection.close()
+
+    if not_modified:
+        returnValue('')
     returnValue(make_json_response(request, data))
+
+
+def get_per_stream_limit(args):
+    return pagination.get_limit(args, node=per_stream_limit_node)
+
+
+def get_streams_query(stream_keys, filter_expr, limit):
+    ''' Returns a query for the latest `limit` comments matching
+    `filter_expr` in each of the streams in `stream_keys`. The comments
+    of each stream are read by a LATERAL subquery, which is a scan of
+    the stream's listing index that stops after `limit` rows.
+    '''
+    columns = Comment.__table__.c
+    streams = union_all(*[
+        select([literal(app_uuid, type_=columns.app_uuid.type)
+                .label('app_uuid'),
+                literal(content_uuid, type_=columns.content_uuid.type)
+                .label('content_uuid')])
+        for app_uuid, content_uuid in stream_keys]) \
+        .alias('streams')
+    latest = Comment.__table__ \
+        .select() \
+        .where(and_(
+            filter_expr,
+            columns.app_uuid == streams.c.app_uuid,
+            columns.content_uuid == streams.c.content_uuid)) \
+        .order_by(columns.submit_datetime.desc(), columns.uuid.desc()) \
+        .limit(limit) \
+        .lateral('latest')
+    return select(latest.c) \
+        .select_from(streams.join(latest, true()))
+
+
+def count_stream_comments(connection, request, stream_keys, filter_expr,
+                          total_mode):
+    ''' Returns a dict mapping each stream in `stream_keys` that has
+    matching comments to its number of matching comments, with one
+    query. Like `count_comments`, the comment_counts table is used if
+    the filters only involve its columns. The comments are only counted
+    if `total_mode` is `exact`.
+    '''
+    if total_mode == pagination.TOTAL_NONE:
+        return succeed(None)
+
+    counter_columns = CommentCount.__table__.c
+    filter_columns = comment_filters.get_filter_columns(request.args)
+
+    if filter_columns.issubset(counter_columns.keys()):
+        columns = counter_columns
+        filter_expr = comment_filters.get_filter_expression(
+            request.args, counter_columns)
+        total = func.sum(counter_columns.count)
+    elif total_mode == pagination.TOTAL_EXACT:
+        columns = Comment.__table__.c
+        total = func.count()
+    else:
+        return succeed(None)
+
+    query = select([columns.app_uuid, columns.content_uuid, total]) \
+        .where(and_(
+            filter_expr,
+            tuple_(columns.app_uuid, columns.content_uuid).in_([
+                tuple_(literal(app_uuid, type_=columns.app_uuid.type),
+                       literal(content_uuid, type_=columns.content_uuid.type))
+                for app_uuid, content_uuid in stream_keys]))) \
+        .group_by(columns.app_uuid, columns.content_uuid)
+
+    d = connection.execute(query)
+    d.addCallback(lambda result: result.fetchall())
+    d.addCallback(lambda rows: dict(
+        ((row[0], row[1]), int(row[2])) for row in rows))
+    return d
+
+
+@app.route('/comments/streams/', methods=['GET'])
+@inlineCallbacks
+def list_stream_comments(request):
+    ''' Lists the latest `per_stream_limit` comments of each of several
+    streams, which are specified like bounded stream metadata listings,
+    i.e. with app_uuid(_in) and content_uuid(_in). Other comment filters
+    apply to each stream.
+
+    The comments of all streams are selected with one query, and so are
+    the streams' metadata. The `total` argument is one of `none` (the
+    default), `exact` or `estimate`, as for comment listings, except
+    that `estimate` omits totals that can't be read from the
+    comment_counts table.
+    '''
+    if not is_bounded(request):
+        raise BadRequest((
+            'STREAMS_NOT_BOUNDED',
+            'app_uuid and content_uuid must both be specified'))
+    stream_keys = sorted(get_request_stream_keys(request))
+
+    columns = Comment.__table__.c
+    filter_expr = comment_filters.get_filter_expression(request.args, columns)
+    total_mode = pagination.get_total_mode(
+        request.args, default=pagination.TOTAL_NONE)
+    limit = get_per_stream_limit(request.args)
+
+    try:
+        connection = yield app.db_engine.connect()
+        version = yield get_comments_version(connection, request)
+        metadata = yield get_streams_metadata(connection, stream_keys)
+        not_modified = is_not_modified(request, make_etag(
+            version, [metadata[key] for key in stream_keys]))
+        if not not_modified:
+            result = yield connection.execute(
+                get_streams_query(stream_keys, filter_expr, limit))
+            result = yield result.fetchall()
+            totals = yield count_stream_comments(
+                connection, request, stream_keys, filter_expr, total_mode)
+    finally:
+        yield connection.close()
+
+    if not_modified:
+        returnValue('')
+
+    comments = dict((key, []) for key in stream_keys)
+    for row in result:
+        comments[(row['app_uuid'], row['content_uuid'])].append(
+            serialize_all(row))
+    objects = []
+    for key in stream_keys:
+        objects.append({
+            'app_uuid': key[0].hex,
+            'content_uuid': key[1].hex,
+            'metadata': metadata[key],
+            'total': None if totals is None else totals.get(key, 0),
+            'count': len(comments[key]),
+            'objects': comments[key]})
+
+    returnValue(make_json_response(request, {
+        'count': len(objects),
+        'per_stream_limit': limit,
+        'objects': objects
+    }))
+
+
+@app.route('/comments/export/', methods=['GET'])
+@db.in_transaction
+@inlineCallbacks
+def export_comments(request, connection):
+    ''' Streams all comments matched by the filters as newline-delimited
+    JSON, one comment per line. Rows are read from a server-side cursor
+    in chunks, and a chunk is only read once the previous one has been
+    written to the client, so memory use doesn't depend on the number
+    of comments. The comments are in no particular order.
+    '''
+    columns = Comment.__table__.c
+    filter_expr = comment_filters.get_filter_expression(request.args, columns)
+    query = Comment.__table__ \
+        .select() \
+        .where(filter_expr) \
+        .execution_options(stream_results=True)
+    query = apply_search(request.args, query)
+
+    result = yield connection.execute(query)
+    producer = ResultProducer(
+        request, result, serialize_all, EXPORT_CHUNK_SIZE)
+    try:
+        yield producer.start()
+    finally:
+        # the connection can't be closed while a chunk is being fetched
+        yield producer.wait()
+
+
+@app.route('/comments/', methods=['PUT'])
+@db.in_transaction
+@inlineCallbacks
+def moderate_comments(request, connection):
+    ''' Sets `is_removed` and/or `moderation_state` on all comments
+    matched by the filters (e.g. `content_uuid`, `flag_count_gte` or
+    `uuid_in`), with one query. At least one filter is required.
+
+    If `dry_run` is true, nothing is updated and `count` is the number
+    of comments that would be updated.
+    '''
+    data = deserialize_or_raise(schema_moderation.bind(), request)
+    dry_run = dry_run_node.deserialize(
+        request.args.get('dry_run', [colander.null])[0])
+    if not comment_filters.get_filter_columns(request.args):
+        raise BadRequest(('NO_FILTERS', 'at least one filter is required'))
+
+    comments = Comment.__table__
+    filter_expr = comment_filters.get_filter_expression(
+        request.args, comments.c)
+
+    if dry_run:
+        query = comments.select().where(filter_expr).alias().count()
+        result = yield connection.execute(query)
+        count = yield result.scalar()
+        returnValue(make_json_response(request, {
+            'dry_run': True,
+            'count': count,
+            'uuids': None
+        }))
+
+    # the old rows are locked, in the same order as flags lock them, so
+    # that their counts can be moved
+    old = select([comments.c.uuid, comments.c.moderation_state]) \
+        .where(filter_expr) \
+        .order_by(comments.c.uuid) \
+        .with_for_update() \
+        .alias('old')
+    query = comments \
+        .update() \
+        .values(**data) \
+        .where(comments.c.uuid == old.c.uuid) \
+        .returning(
+            comments.c.uuid,
+            comments.c.app_uuid,
+            comments.c.content_uuid,
+            comments.c.moderation_state,
+            old.c.moderation_state.label('old_moderation_state'))
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+
+    # keys whose count doesn't change still have their versions bumped
+    amounts = Counter()
+    for row in result:
+        stream = (row['app_uuid'], row['content_uuid'])
+        amounts[stream + (row['moderation_state'], )] += 1
+        amounts[stream + (row['old_moderation_state'], )] -= 1
+    if amounts:
+        yield CommentCount.increment_many(connection, amounts)
+
+    returnValue(make_json_response(request, {
+        'dry_run': False,
+        'count': len(result),
+        'uuids': [row['uuid'].hex for row in result]
+    }))
@@ -27,12 +27,25 @@ class DelimitedSequenceSchema(colander.SequenceSchema):
         return super(DelimitedSequenceSchema, self).deserialize(cstruct)
 
 
+def unindexed_like_validator(node, value):
+    raise colander.Invalid(
+        node, '%s is not supported because the column is not indexed' % (
+            node.name, ))
+
+
 class FilterSchema(colander.MappingSchema):
+    ''' `filter_spec` maps the names of child nodes to the filter types
+    generated for them, or ALL. If `indexed_like` is given, it names the
+    columns that have indexes for like filters (e.g. trigram indexes),
+    and like filters on other columns are rejected. Otherwise all like
+    filters are allowed, which is only sensible for small tables.
+    '''
 
     def __init__(self, *args, **kwargs):
         super(FilterSchema, self).__init__(*args, **kwargs)
 
         filter_spec = kwargs.get('filter_spec', {})
+        self.indexed_like = kwargs.get('indexed_like')
         new_nodes = []
         old_nodes = []
 
@@ -62,11 +75,12 @@ class FilterSchema(colander.MappingSchema):
             del self[node.name]
 
     @classmethod
-    def from_schema(self, schema, filter_spec):
+    def from_schema(self, schema, filter_spec, indexed_like=None):
         children = map(
             lambda c: c.clone(),
             filter(lambda c: c.name in filter_spec, schema.children))
-        return FilterSchema(children=children, filter_spec=filter_spec)
+        return FilterSchema(children=children, filter_spec=filter_spec,
+                            indexed_like=indexed_like)
 
     def get_range_nodes(self, node):
         if not isinstance(node.typ, (colander.Integer, colander.DateTime)):
@@ -100,6 +114,9 @@ class FilterSchema(colander.MappingSchema):
         # validator for exact_match node cannot
         # generally be applied to like node
         like_node.validator = None
+        if (self.indexed_like is not None and
+                node.name not in self.indexed_like):
+            like_node.validator = unindexed_like_validator
         like_node.name = '%s_like' % node.name
         like_node.filter_type = 'like'
         return [like_node]
@@ -131,24 +148,34 @@ class FilterSchema(colander.MappingSchema):
             for key, value in data.iteritems()]
         return and_(*expressions)
 
+    def get_column_name(self, node):
+        if node.filter_type == 'exact_match':
+            return node.name
+        return node.name.rsplit('_', 1)[0]
+
+    def get_filter_columns(self, cstruct):
+        ''' Returns the names of the columns that the filters
+        in `cstruct` apply to.
+        '''
+        cstruct = self.convert_lists(cstruct)
+        data = self.deserialize(cstruct)
+        return set(self.get_column_name(self.get(key)) for key in data)
+
     def get_expression_for_node(self, node, cols, value):
         expr = None
+        column = cols.get(self.get_column_name(node))
 
         if node.filter_type == 'exact_match':
-            column = cols.get(node.name)
             expr = column == value
 
         elif node.filter_type == 'in':
-            column = cols.get(node.name[:-3])
             expr = column.in_(value)
 
         elif node.filter_type == 'like':
-            column = cols.get(node.name[:-5])
             expr = column.ilike('%' + value + '%')
 
         elif node.filter_type == 'range':
-            name, suffix = node.name.rsplit('_', 1)
-            column = cols.get(name)
+            suffix = node.name.rsplit('_', 1)[1]
             if suffix == 'gt':
                 expr = column > value
             elif suffix == 'gte':
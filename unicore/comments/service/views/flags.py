@@ -1,26 +1,255 @@
 from uuid import UUID
 
 import colander
-from twisted.internet.defer import inlineCallbacks, returnValue
+from sqlalchemy import literal, true, and_, case, cast, Integer
+from sqlalchemy.sql import select, exists, func, union_all
+from sqlalchemy.dialects.postgresql import (
+    insert as pg_insert, aggregate_order_by, ARRAY)
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from werkzeug.exceptions import NotFound
-from sqlalchemy.exc import IntegrityError
 
 from unicore.comments.service import db, app
 from unicore.comments.service.views.base import (
     make_json_response, deserialize_or_raise)
 from unicore.comments.service.views import pagination
-from unicore.comments.service.models import Flag, Comment
-from unicore.comments.service.schema import Flag as FlagSchema
+from unicore.comments.service.models import (
+    Flag, Comment, CommentCount, StreamMetadata, FlagCountDelta)
+from unicore.comments.service.schema import (
+    Flag as FlagSchema, FlagSummary as FlagSummarySchema)
+from unicore.comments.service.serializers import compile_serializer
 from unicore.comments.service.views.filtering import FilterSchema, ALL
+from unicore.comments.service.views.comments import (
+    COUNT_KEY_COLUMNS, serialize_all as serialize_comment)
 
 
+FOLD_BATCH_SIZE = 1000
 schema = FlagSchema()
+serialize = compile_serializer(schema)
 flag_filters = FilterSchema.from_schema(schema, {
     'comment_uuid': ALL,
     'user_uuid': ALL,
     'app_uuid': ALL,
     'submit_datetime': ALL
 })
+serialize_summary = compile_serializer(FlagSummarySchema())
+user_uuids_node = colander.SchemaNode(
+    colander.Boolean(),
+    name='user_uuids',
+    missing=False)
+
+
+def get_count_key_columns():
+    return [Comment.__table__.c[name] for name in COUNT_KEY_COLUMNS]
+
+
+def get_order_columns():
+    columns = Flag.__table__.c
+    return (columns.submit_datetime, columns.comment_uuid, columns.user_uuid)
+
+
+def get_flag_threshold(comments):
+    ''' Returns an expression for the number of flags at which a comment
+    in `comments` is removed by the community. This is its stream's
+    `flag_threshold` metadata if set, otherwise the
+    community_moderation_threshold config, and NULL if neither is set.
+    '''
+    smd_cols = StreamMetadata.__table__.c
+    stream_threshold = select([cast(
+        func.json_extract_path_text(smd_cols.metadata, 'flag_threshold'),
+        Integer)]) \
+        .where(and_(
+            smd_cols.app_uuid == comments.c.app_uuid,
+            smd_cols.content_uuid == comments.c.content_uuid)) \
+        .as_scalar()
+    return func.coalesce(
+        stream_threshold,
+        literal(app.config.community_moderation_threshold, Integer))
+
+
+def apply_flag_counts_cte(flagged, amount):
+    ''' Returns a CTE that adds `amount`, a number or a column of
+    `flagged`, to the flag counts of the comments whose uuids are in
+    `flagged.c.comment_uuid`, and updates their comment counts.
+
+    Visible comments whose flag count goes up to their threshold are
+    removed by the community, and moved to the removed_by_community
+    comment count. Comment counts are only updated, and their versions
+    bumped, for these removals.
+    '''
+    comments = Comment.__table__
+    if isinstance(amount, (int, long)):
+        amount = literal(amount)
+    # the old rows are locked, in a consistent order, so that their
+    # counts can be moved
+    old = select([comments.c.uuid,
+                  comments.c.moderation_state,
+                  amount.label('amount')]) \
+        .where(comments.c.uuid == flagged.c.comment_uuid) \
+        .order_by(comments.c.uuid) \
+        .with_for_update(of=comments) \
+        .alias('old')
+
+    flag_count = comments.c.flag_count + old.c.amount
+    moderation_state = case(
+        [(and_(old.c.amount > 0,
+               comments.c.moderation_state == u'visible',
+               flag_count >= get_flag_threshold(comments)),
+          u'removed_by_community')],
+        else_=comments.c.moderation_state)
+
+    updated = comments \
+        .update() \
+        .values(flag_count=flag_count, moderation_state=moderation_state) \
+        .where(comments.c.uuid == old.c.uuid) \
+        .returning(
+            *(get_count_key_columns() +
+              [old.c.moderation_state.label('old_moderation_state')])) \
+        .cte('updated')
+
+    # only removals change comment counts. Other flags don't touch the
+    # stream's counts, so that flags in a stream don't wait on its rows.
+    changed = updated.c.moderation_state != updated.c.old_moderation_state
+    amounts = union_all(
+        select([updated.c.app_uuid,
+                updated.c.content_uuid,
+                updated.c.moderation_state,
+                literal(1)])
+        .where(changed),
+        select([updated.c.app_uuid,
+                updated.c.content_uuid,
+                updated.c.old_moderation_state,
+                literal(-1)])
+        .where(changed)) \
+        .alias('amounts')
+    counted = CommentCount \
+        .increment_from_select(select([amounts])) \
+        .returning(*CommentCount.pk_columns) \
+        .cte('counted')
+    return counted
+
+
+def defer_flag_counts_cte(flagged, amount):
+    ''' Returns a CTE that records `amount` as a change to the flag
+    counts of the comments in `flagged`, to be applied by
+    `fold_flag_counts`.
+    '''
+    deltas = FlagCountDelta.__table__
+    recorded = deltas \
+        .insert() \
+        .from_select(
+            ['comment_uuid', 'delta'],
+            select([flagged.c.comment_uuid, literal(amount)])) \
+        .returning(deltas.c.id) \
+        .cte('recorded')
+    return recorded
+
+
+def get_flag_count_cte(flagged, amount):
+    ''' Flag counts are deferred if flag_count_interval is set, so that
+    flags on the same comment don't wait for each other's locks.
+    '''
+    if app.config.flag_count_interval:
+        return defer_flag_counts_cte(flagged, amount)
+    return apply_flag_counts_cte(flagged, amount)
+
+
+def get_fold_flag_counts_query(limit):
+    ''' Returns a single statement that deletes up to `limit` flag
+    count deltas and applies them to the comments' flag counts. Deltas
+    locked by a concurrent fold are skipped. The row returned contains
+    the number of deltas folded.
+    '''
+    deltas = FlagCountDelta.__table__
+    batch = select([deltas.c.id]) \
+        .order_by(deltas.c.id) \
+        .limit(limit) \
+        .with_for_update(skip_locked=True)
+    folded = deltas \
+        .delete() \
+        .where(deltas.c.id.in_(batch)) \
+        .returning(deltas.c.comment_uuid, deltas.c.delta) \
+        .cte('folded')
+    sums = select([folded.c.comment_uuid,
+                   func.sum(folded.c.delta).label('delta')]) \
+        .group_by(folded.c.comment_uuid) \
+        .cte('sums')
+    counted = apply_flag_counts_cte(sums, sums.c.delta)
+
+    query = select([
+        select([func.count()]).select_from(folded).as_scalar()
+        .label('folded'),
+        select([func.count()]).select_from(counted).as_scalar()
+        .label('counted')]) \
+        .execution_options(autocommit=True)
+    return query
+
+
+@inlineCallbacks
+def fold_flag_counts(connection, batch_size=FOLD_BATCH_SIZE):
+    ''' Applies all deferred flag counts, `batch_size` deltas at a time.
+    Returns the number of deltas folded.
+    '''
+    total = 0
+    while True:
+        result = yield connection.execute(
+            get_fold_flag_counts_query(batch_size))
+        result = yield result.first()
+        total += result['folded']
+        if result['folded'] < batch_size:
+            returnValue(total)
+
+
+def get_create_flag_query(data):
+    ''' Returns a single statement that inserts the flag in `data`,
+    unless it already exists or its comment doesn't, and increments
+    the comment's flag count (or records the increment) if it was
+    inserted. The row returned
+    contains `comment_exists` and the inserted flag's columns, which
+    are all NULL if the flag wasn't inserted.
+    '''
+    flag_table = Flag.__table__
+    comments = Comment.__table__
+
+    names = sorted(data.keys())
+    values = select([literal(data[name], type_=flag_table.c[name].type)
+                     for name in names]) \
+        .where(exists().where(comments.c.uuid == data['comment_uuid']))
+    inserted = pg_insert(flag_table) \
+        .from_select(names, values) \
+        .on_conflict_do_nothing() \
+        .returning(*flag_table.c) \
+        .cte('inserted')
+    counted = get_flag_count_cte(inserted, 1)
+
+    comment_exists = exists() \
+        .where(comments.c.uuid == data['comment_uuid'])
+    query = select([comment_exists.label('comment_exists')] +
+                   [inserted.c[c.name] for c in flag_table.c]) \
+        .select_from(select([literal(1)]).alias('one')
+                     .outerjoin(inserted, true())
+                     .outerjoin(counted, true())) \
+        .execution_options(autocommit=True)
+    return query
+
+
+def get_delete_flag_query(comment_uuid, user_uuid):
+    ''' Returns a single statement that deletes a flag and decrements
+    its comment's flag count (or records the decrement). The deleted
+    flag is returned.
+    '''
+    flag_table = Flag.__table__
+    deleted = flag_table \
+        .delete() \
+        .where(Flag._pk_expression({
+            'comment_uuid': comment_uuid, 'user_uuid': user_uuid})) \
+        .returning(*flag_table.c) \
+        .cte('deleted')
+    counted = get_flag_count_cte(deleted, -1)
+
+    query = select([deleted.c[c.name] for c in flag_table.c]) \
+        .select_from(deleted.outerjoin(counted, true())) \
+        .execution_options(autocommit=True)
+    return query
 
 
 '''
@@ -29,34 +258,37 @@ Flag resource
 
 
 @app.route('/flags/', methods=['POST'])
-@db.in_transaction
 @inlineCallbacks
-def create_flag(request, connection):
+def create_flag(request):
+    ''' Flagging is a single statement, so a comment's flag count can't
+    be incremented by duplicate flags, and concurrent duplicates don't
+    raise errors. If flag_count_interval is set, the flag count is
+    updated within that many seconds, by `FlagCountAggregator`.
+    '''
     data = deserialize_or_raise(schema.bind(), request)
+    data = Flag.with_defaults(data)
 
-    # increment flag count
-    query = Comment.__table__ \
-        .update() \
-        .values(flag_count=Comment.__table__.c.flag_count + 1) \
-        .where(Comment.__table__.c.uuid == data['comment_uuid'])
-    result = yield connection.execute(query)
+    try:
+        connection = yield app.db_engine.connect()
+        result = yield connection.execute(get_create_flag_query(data))
+        result = yield result.first()
+    finally:
+        yield connection.close()
 
-    if result.rowcount == 0:
+    if not result['comment_exists']:
         raise colander.Invalid(
             schema.get('comment_uuid'),
             'Comment with uuid %r does not exist' %
             data['comment_uuid'].hex)
 
-    flag = Flag(connection, data)
-    try:
-        yield flag.insert()
-    except IntegrityError:  # already exists
-        # NOTE: IntegrityError rolls back transaction
+    if result['comment_uuid'] is None:  # already exists
         request.setResponseCode(200)
+        flag = data
     else:
         request.setResponseCode(201)
+        flag = dict((c.name, result[c.name]) for c in Flag.__table__.c)
 
-    returnValue(make_json_response(request, flag.to_dict(), schema=schema))
+    returnValue(make_json_response(request, flag, schema=schema))
 
 
 @app.route('/flags/<comment_uuid>/<user_uuid>/', methods=['GET'])
@@ -97,30 +329,27 @@ def update_flag(request, comment_uuid, user_uuid, connection):
 
 
 @app.route('/flags/<comment_uuid>/<user_uuid>/', methods=['DELETE'])
-@db.in_transaction
 @inlineCallbacks
-def delete_flag(request, comment_uuid, user_uuid, connection):
+def delete_flag(request, comment_uuid, user_uuid):
     try:
         comment_uuid = UUID(comment_uuid)
         user_uuid = UUID(user_uuid)
     except ValueError:
         raise NotFound
 
-    flag = Flag(
-        connection, {'comment_uuid': comment_uuid, 'user_uuid': user_uuid})
-    count = yield flag.delete()
+    try:
+        connection = yield app.db_engine.connect()
+        result = yield connection.execute(
+            get_delete_flag_query(comment_uuid, user_uuid))
+        result = yield result.first()
+    finally:
+        yield connection.close()
 
-    if count == 0:
+    if result is None:
         raise NotFound
 
-    # decrement flag count
-    query = Comment.__table__ \
-        .update() \
-        .values(flag_count=Comment.__table__.c.flag_count - 1) \
-        .where(Comment.__table__.c.uuid == comment_uuid)
-    yield connection.execute(query)
-
-    returnValue(make_json_response(request, flag.to_dict(), schema=schema))
+    flag = dict((c.name, result[c.name]) for c in Flag.__table__.c)
+    returnValue(make_json_response(request, flag, schema=schema))
 
 
 '''
@@ -128,17 +357,136 @@ Flag collection resource
 '''
 
 
+def count_flags(connection, query_all, total_mode):
+    ''' Counts the flags matched by `query_all`, or returns the query
+    planner's estimate, depending on `total_mode`.
+    '''
+    if total_mode == pagination.TOTAL_NONE:
+        return succeed(None)
+    if total_mode == pagination.TOTAL_ESTIMATE:
+        return db.estimate_count(connection, query_all)
+
+    d = connection.execute(query_all.alias().count())
+    d.addCallback(lambda result: result.scalar())
+    d.addCallback(int)
+    return d
+
+
+@inlineCallbacks
+def cursor_list_flags(request, query_all, total_mode, connection):
+    query, limit = pagination.paginate_cursor(
+        request.args, query_all, get_order_columns(),
+        app.config.cursor_secret)
+
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    total = yield count_flags(connection, query_all, total_mode)
+
+    returnValue({
+        'total': total,
+        'count': len(result),
+        'limit': limit,
+        'objects': [serialize(row) for row in result],
+        'next_cursor': pagination.get_next_cursor(
+            result, get_order_columns(), limit, app.config.cursor_secret)
+    })
+
+
+@inlineCallbacks
+def offset_list_flags(request, query_all, total_mode, connection):
+    query = query_all.order_by(*[c.desc() for c in get_order_columns()])
+    query, limit, offset = pagination.paginate(request.args, query)
+
+    result = yield connection.execute(query)
+    result = yield result.fetchall()
+    total = yield count_flags(connection, query_all, total_mode)
+
+    returnValue({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'count': len(result),
+        'objects': [serialize(row) for row in result]
+    })
+
+
 @app.route('/flags/', methods=['GET'])
 @inlineCallbacks
 def list_flags(request):
+    ''' Flags are ordered by (submit_datetime, comment_uuid, user_uuid),
+    newest first. If a `cursor` argument is provided (an empty cursor
+    requests the first page), flags are paged using the opaque
+    `next_cursor` token returned with each page, otherwise using
+    `offset`.
+
+    The `total` argument is one of `none` (the default), `estimate`,
+    which returns the query planner's estimate, or `exact`.
+    '''
     columns = Flag.__table__.c
     filter_expr = flag_filters.get_filter_expression(request.args, columns)
+    total_mode = pagination.get_total_mode(
+        request.args, default=pagination.TOTAL_NONE)
 
-    query = Flag.__table__ \
+    query_all = Flag.__table__ \
         .select() \
+        .where(filter_expr)
+
+    view_func = (cursor_list_flags
+                 if pagination.is_cursor_request(request.args)
+                 else offset_list_flags)
+    try:
+        connection = yield app.db_engine.connect()
+        data = yield view_func(request, query_all, total_mode, connection)
+    finally:
+        yield connection.close()
+
+    returnValue(make_json_response(request, data))
+
+
+@app.route('/flags/summaries/', methods=['GET'])
+@inlineCallbacks
+def list_flag_summaries(request):
+    ''' Returns a summary of the flags matched by the filters for each
+    flagged comment, with the comment, in one query. Summaries are
+    ordered by their latest flag, newest first, and are paged by
+    `cursor` or `offset` like flags. If `user_uuids` is true, each
+    summary includes the uuids of the users who flagged the comment,
+    in the order they did so.
+    '''
+    flag_cols = Flag.__table__.c
+    filter_expr = flag_filters.get_filter_expression(
+        request.args, flag_cols)
+    include_user_uuids = user_uuids_node.deserialize(
+        request.args.get('user_uuids', [colander.null])[0])
+
+    summary_cols = [
+        flag_cols.comment_uuid,
+        func.count().label('count'),
+        func.min(flag_cols.submit_datetime).label('first_submit_datetime'),
+        func.max(flag_cols.submit_datetime).label('last_submit_datetime')]
+    if include_user_uuids:
+        summary_cols.append(func.array_agg(
+            aggregate_order_by(
+                flag_cols.user_uuid, flag_cols.submit_datetime),
+            type_=ARRAY(flag_cols.user_uuid.type)).label('user_uuids'))
+    summaries = select(summary_cols) \
         .where(filter_expr) \
-        .order_by(columns.submit_datetime.desc())
-    query, limit, offset = pagination.paginate(request.args, query)
+        .group_by(flag_cols.comment_uuid) \
+        .alias('summaries')
+
+    comments = Comment.__table__
+    query = select([summaries, comments]) \
+        .select_from(summaries.join(
+            comments, comments.c.uuid == summaries.c.comment_uuid))
+    order_columns = (
+        summaries.c.last_submit_datetime, summaries.c.comment_uuid)
+
+    if pagination.is_cursor_request(request.args):
+        query, limit = pagination.paginate_cursor(
+            request.args, query, order_columns, app.config.cursor_secret)
+    else:
+        query = query.order_by(*[c.desc() for c in order_columns])
+        query, limit, offset = pagination.paginate(request.args, query)
 
     try:
         connection = yield app.db_engine.connect()
@@ -147,10 +495,20 @@ def list_flags(request):
     finally:
         yield connection.close()
 
+    objects = []
+    for row in result:
+        summary = serialize_summary(row)
+        summary['comment'] = serialize_comment(row)
+        objects.append(summary)
+
     data = {
-        'offset': offset,
+        'count': len(objects),
         'limit': limit,
-        'count': len(result),
-        'objects': [schema.serialize(row) for row in result]
+        'objects': objects
     }
+    if pagination.is_cursor_request(request.args):
+        data['next_cursor'] = pagination.get_next_cursor(
+            result, order_columns, limit, app.config.cursor_secret)
+    else:
+        data['offset'] = offset
     returnValue(make_json_response(request, data))
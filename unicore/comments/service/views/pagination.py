@@ -1,14 +1,149 @@
+import hmac
+import hashlib
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import pytz
+import colander
+from sqlalchemy import tuple_, literal
+from werkzeug.exceptions import BadRequest
+
+
 MAX_LIMIT = 100
 DEFAULT_LIMIT = 50
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+TOTAL_EXACT = 'exact'
+TOTAL_ESTIMATE = 'estimate'
+TOTAL_NONE = 'none'
+TOTAL_MODES = (TOTAL_EXACT, TOTAL_ESTIMATE, TOTAL_NONE)
+
+
+total_mode_node = colander.SchemaNode(
+    colander.String(),
+    name='total',
+    missing=TOTAL_EXACT,
+    validator=colander.OneOf(TOTAL_MODES))
+limit_node = colander.SchemaNode(
+    colander.Integer(),
+    name='limit',
+    missing=DEFAULT_LIMIT,
+    validator=colander.Range(min=1))
+offset_node = colander.SchemaNode(
+    colander.Integer(),
+    name='offset',
+    missing=0,
+    validator=colander.Range(min=0))
+
+
+def get_limit(args, node=limit_node):
+    ''' Returns the limit in the argument named by `node`, which
+    deserializes it so that invalid limits are reported as bad fields.
+    '''
+    limit = node.deserialize(args.get(node.name, [colander.null])[0])
+    return min(limit, MAX_LIMIT)
 
 
 def paginate(args, query):
-    limit = args.get('limit', [DEFAULT_LIMIT])[0]
-    limit = min(int(limit), MAX_LIMIT)
-    offset = args.get('offset', [0])[0]
-    offset = int(offset)
+    limit = get_limit(args)
+    offset = offset_node.deserialize(args.get('offset', [colander.null])[0])
 
     query = query.limit(limit)
     if offset:
         query = query.offset(offset)
     return query, limit, offset
+
+
+def get_total_mode(args, default=TOTAL_EXACT):
+    return total_mode_node.deserialize(args.get('total', [default])[0])
+
+
+'''
+Keyset (cursor) pagination
+'''
+
+
+def is_cursor_request(args):
+    return 'cursor' in args
+
+
+def _sign(payload, secret):
+    return hmac.new(str(secret), payload, hashlib.sha256).hexdigest()
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        delta = value - EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+            delta.microseconds
+        return 'd%d' % micros
+    if isinstance(value, UUID):
+        return 'u%s' % value.hex
+    if isinstance(value, basestring) and ',' not in value:
+        return 's%s' % value.encode('utf-8')
+    raise TypeError('%r cannot be encoded in a cursor' % (value, ))
+
+
+def _decode_value(value):
+    if value.startswith('d'):
+        return EPOCH + timedelta(microseconds=int(value[1:]))
+    if value.startswith('u'):
+        return UUID(value[1:])
+    if value.startswith('s'):
+        return value[1:].decode('utf-8')
+    raise ValueError('%r is not a valid cursor value' % (value, ))
+
+
+def encode_cursor(values, secret):
+    ''' Returns an opaque, signed token encoding `values`, which
+    may be datetimes, UUIDs or strings without commas.
+    '''
+    payload = ','.join(_encode_value(v) for v in values)
+    token = '%s.%s' % (payload, _sign(payload, secret))
+    return urlsafe_b64encode(token).rstrip('=')
+
+
+def decode_cursor(token, secret):
+    try:
+        token = str(token)
+        token = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload, signature = token.rsplit('.', 1)
+        if not hmac.compare_digest(signature, _sign(payload, secret)):
+            raise ValueError
+        return tuple(_decode_value(v) for v in payload.split(','))
+
+    except (TypeError, ValueError):
+        raise BadRequest(('BAD_CURSOR', 'Not a valid pagination cursor.'))
+
+
+def paginate_cursor(args, query, columns, secret):
+    ''' Orders `query` descending on `columns` and seeks past the
+    position in the `cursor` argument, if one is given. `columns`
+    must uniquely identify a row so that the ordering is absolute.
+
+    Returns the query and the limit applied to it.
+    '''
+    limit = get_limit(args)
+    token = args.get('cursor', [''])[0]
+
+    if token:
+        values = decode_cursor(token, secret)
+        if len(values) != len(columns):
+            raise BadRequest(
+                ('BAD_CURSOR', 'Not a valid pagination cursor.'))
+        boundary = [literal(v, type_=c.type) for c, v in zip(columns, values)]
+        query = query.where(tuple_(*columns) < tuple_(*boundary))
+
+    query = query \
+        .order_by(*[c.desc() for c in columns]) \
+        .limit(limit)
+    return query, limit
+
+
+def get_next_cursor(rows, columns, limit, secret):
+    ''' Returns the cursor for the page after `rows`, or None if
+    `rows` is the last page.
+    '''
+    if not rows or len(rows) < limit:
+        return None
+    return encode_cursor([rows[-1][c.name] for c in columns], secret)
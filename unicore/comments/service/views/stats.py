@@ -0,0 +1,15 @@
+from unicore.comments.service import app
+from unicore.comments.service.views.base import make_json_response
+
+
+@app.route('/stats/', methods=['GET'])
+def view_stats(request):
+    data = {
+        'caches': {
+            'banned_users': app.banned_user_cache.to_dict(),
+            'stream_metadata': app.stream_metadata_cache.to_dict()
+        },
+        'flag_counts': (app.flag_count_aggregator.to_dict()
+                        if app.flag_count_aggregator else None)
+    }
+    return make_json_response(request, data)
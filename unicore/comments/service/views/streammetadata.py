@@ -5,16 +5,19 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from werkzeug.exceptions import NotFound
 
 from unicore.comments.service import db, app
+from unicore.comments.service.cache import invalidates
 from unicore.comments.service.views.base import (
-    make_json_response, deserialize_or_raise)
+    make_json_response, deserialize_or_raise, make_etag)
 from unicore.comments.service.views import pagination
 from unicore.comments.service.models import StreamMetadata
 from unicore.comments.service.schema import (
     StreamMetadata as StreamMetadataSchema)
+from unicore.comments.service.serializers import compile_serializer
 from unicore.comments.service.views.filtering import FilterSchema, ALL
 
 
 schema = StreamMetadataSchema()
+serialize = compile_serializer(schema)
 schema_no_uuids = schema.clone()
 del schema_no_uuids['app_uuid']
 del schema_no_uuids['content_uuid']
@@ -43,22 +46,27 @@ def view_streammetadata(request, app_uuid, content_uuid):
 
     try:
         connection = yield app.db_engine.connect()
-        metadata = yield StreamMetadata.get_by_pk(
-            connection, app_uuid=app_uuid, content_uuid=content_uuid)
+        metadata = yield app.stream_metadata_cache.get_metadata(
+            connection, app_uuid, content_uuid)
     finally:
         yield connection.close()
 
-    if metadata is None:
-        data = {
-            'app_uuid': app_uuid,
-            'content_uuid': content_uuid}
-    else:
-        data = metadata.to_dict()
+    data = {
+        'app_uuid': app_uuid,
+        'content_uuid': content_uuid}
+    if metadata is not None:
+        data['metadata'] = metadata
+
+    returnValue(make_json_response(
+        request, data, schema=schema, etag=make_etag(metadata)))
 
-    returnValue(make_json_response(request, data, schema=schema))
+
+def get_updated_stream(request, app_uuid, content_uuid):
+    return [(UUID(app_uuid), UUID(content_uuid))]
 
 
 @app.route('/streammetadata/<app_uuid>/<content_uuid>/', methods=['PUT'])
+@invalidates('stream_metadata_cache', get_keys=get_updated_stream)
 @db.in_transaction
 @inlineCallbacks
 def update_streammetadata(request, app_uuid, content_uuid, connection):
@@ -76,7 +84,7 @@ def update_streammetadata(request, app_uuid, content_uuid, connection):
         yield metadata.insert()
     else:
         metadata.set('metadata', data['metadata'])
-        yield metadata.update()
+        yield metadata.update(returning=())
 
     returnValue(make_json_response(request, metadata.to_dict(), schema=schema))
 
@@ -122,7 +130,7 @@ def unbounded_list_streammetadata(request, query):
         'offset': offset,
         'limit': limit,
         'count': len(result),
-        'objects': [schema.serialize(row) for row in result]
+        'objects': [serialize(row) for row in result]
     }
     returnValue(data)
 
@@ -143,7 +151,7 @@ def bounded_list_streammetadata(request, query):
 
     data = {
         'count': len(primary_keys),
-        'objects': [schema.serialize(row)
+        'objects': [serialize(row)
                     for row in chain(result, non_db_objects)]
     }
     returnValue(data)
@@ -170,7 +178,7 @@ def list_streammetadata(request):
     view_func = (bounded_list_streammetadata if is_bounded(request)
                  else unbounded_list_streammetadata)
     data = yield view_func(request, query)
-    returnValue(make_json_response(request, data))
+    returnValue(make_json_response(request, data, etag=make_etag(data)))
 
 
 @inlineCallbacks
@@ -213,7 +221,14 @@ def bounded_update_streammetadata(request, query, data, connection):
     returnValue(data)
 
 
+def get_updated_streams(request):
+    if is_bounded(request):
+        return get_stream_primary_keys(request)
+    return None
+
+
 @app.route('/streammetadata/', methods=['PUT'])
+@invalidates('stream_metadata_cache', get_keys=get_updated_streams)
 @db.in_transaction
 @inlineCallbacks
 def update_list_streammetadata(request, connection):